@@ -1,10 +1,21 @@
+import contextlib
 import datetime
+import gzip
+import hmac
+import json
+import multiprocessing
 import secrets
 from io import BytesIO
 from zipfile import ZipFile
 import os
-from flask import Flask, request, render_template, send_file
-from imputation import apply_grim, apply_grim_file
+import time
+from flask import Flask, request, render_template, send_file, jsonify, url_for, g, Response, stream_with_context
+import columnar
+import imputation
+from imputation import (apply_grim, apply_grim_file, apply_grim_json, impute_stream, request_workspace, get_job_queue, get_result_cache, warm_up, artifact_manager,
+                        pin_artifacts, unpin_artifacts)
+from profiling import RequestProfiler, profile_reason, PROFILE_HEADER, PROFILE_PARAM
+from metrics import REQUEST_SECONDS, ARTIFACTS_INFO, stage_timer, render as render_metrics
 import traceback
 import subprocess
 import sys
@@ -46,8 +57,7 @@ def run_setup_if_needed():
     if not graph_exists:
         paths_to_check = [
             "data/graph.pkl",
-            "data/pop_ratio.txt",
-            "data/freqs_dicts"
+            "data/pop_ratio.txt"
         ]
         if not paths_exist(paths_to_check, app_dir, conf_dir):
             subprocess.run(
@@ -59,7 +69,14 @@ def run_setup_if_needed():
 
 
 def create_app() -> Flask:
-    run_setup_if_needed()
+    # build the graph if needed, then load py-ard, the graph and the frequencies and build the imputation engine,
+    # once. In the background, so the server binds at once and answers /healthz and /readyz meanwhile, unless
+    # GRIMMARD_BACKGROUND_WARM_UP=0 (the pre-fork server loads everything in the master, before forking).
+    background = os.environ.get("GRIMMARD_BACKGROUND_WARM_UP", "1") == "1"
+    # (the imputation processes import the main module again, and this one with it, see runfile.ImputationEngine.pool,
+    # they only impute the chunks of files)
+    if multiprocessing.parent_process() is None:
+        warm_up(setup=run_setup_if_needed, background=background)
     app = Flask(__name__, static_folder='static', template_folder="templates")
     return app
 
@@ -75,6 +92,127 @@ app.config["PERMANENT_SESSION_LIFETIME"] = datetime.timedelta(hours=1)
 app.config["SECRET_KEY"] = secrets.token_hex()
 
 
+# the routes that are answered before the warm-up is done
+HEALTH_ROUTES = ("/healthz", "/readyz")
+# the routes that can be profiled, see profiling.py
+PROFILED_ROUTES = ("/impute-form", "/impute-file", "/api/v1/impute")
+# the loci of the results when none are requested
+ALL_LOCI = "A;B;C;DRB1;DQB1;DRB3;DRB4;DRB5;DRBX;DPB1;DPA1;DQA1"
+# the smallest JSON response that is gzipped
+GZIP_MIN_BYTES = 1024
+
+
+def parse_loci(loci):
+    """
+        Returns the list of the requested loci.
+
+        Parameters:
+        loci (str): The loci, separated by ';'. Empty - all the loci.
+
+        Returns:
+        List[str]: The loci, DRB3/4/5 replaced by DRB3, DRB4, DRB5 and DRBX.
+        """
+    # If user hasn't entered any loci, choose all.
+    loci_list = (loci or ALL_LOCI).split(";")
+    # If DRB3/4/5 has been selected, replace it with ["DRB3", "DRB4", "DRB5"].
+    if "DRB3/4/5" in loci_list:
+        loci_list.remove("DRB3/4/5")
+        loci_list += ["DRB3", "DRB4", "DRB5", "DRBX"]
+    return loci_list
+
+
+# each request is served by the version of the artifacts that is active when it starts, even if a new version is
+# loaded meanwhile
+@app.before_request
+def before_request():
+    g.start_time = time.perf_counter()
+    if request.url_rule and request.url_rule.rule in HEALTH_ROUTES:
+        return None
+    if not imputation.startup.ready.is_set():
+        response = jsonify(imputation.startup.status())
+        response.status_code = 503
+        response.headers["Retry-After"] = "5"
+        return response
+    g.artifacts = pin_artifacts()
+    if request.url_rule and request.url_rule.rule in PROFILED_ROUTES:
+        token = request.headers.get(PROFILE_HEADER) or request.args.get(PROFILE_PARAM)
+        g.profile_reason = profile_reason(g.artifacts.engine.json_conf, token)
+        if g.profile_reason:
+            g.profiler = RequestProfiler().start()
+
+
+def _save_profile(profiler, json_conf, endpoint, tag, reason):
+    path = profiler.save(json_conf.get("profiling_dir", "profiles"), endpoint, tag, reason)
+    print(f"Saved the profile of {endpoint} ({reason}) to {path}")
+    return path
+
+
+# a streamed response is done when it is closed, not when its view returns, see finish_on_close
+@app.after_request
+def save_profile(response):
+    if "profiler" in g and not g.get("streaming"):
+        path = _save_profile(g.profiler, g.artifacts.engine.json_conf, request.url_rule.rule, g.get("profile_tag"),
+                             g.profile_reason)
+        response.headers[PROFILE_HEADER] = os.path.basename(path)
+    return response
+
+
+@app.after_request
+def add_artifacts_version(response):
+    if "artifacts" in g:
+        response.headers["X-Grimmard-Version"] = g.artifacts.version
+    return response
+
+
+@app.after_request
+def record_request_time(response):
+    if "start_time" in g and not g.get("streaming"):
+        # the route, not the path, so the job ids do not make a metric each
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_SECONDS.observe(time.perf_counter() - g.start_time, endpoint=endpoint, status=response.status_code)
+    return response
+
+
+@app.teardown_request
+def teardown_request(exception):
+    # (the teardown of a streamed response runs before it is sent, it is finished when it is closed)
+    if g.get("streaming"):
+        return
+    # a request that failed before its profile was saved
+    if "profiler" in g:
+        g.profiler.stop()
+    unpin_artifacts()
+
+
+def finish_on_close(response):
+    """
+        Finishes a streamed response when it is closed, after its last line is sent (or the client is gone), instead
+        of when its view returns: its profile is saved, its time is recorded and its version of the artifacts is
+        unpinned then.
+
+        Parameters:
+        response (Response): The streamed response.
+
+        Returns:
+        Response: The response.
+        """
+    g.streaming = True
+    endpoint = request.url_rule.rule
+    start_time = g.start_time
+    profiler = g.get("profiler")
+    profile_args = (g.artifacts.engine.json_conf, endpoint, g.get("profile_tag"), g.get("profile_reason"))
+
+    # called by the server in the thread that sent the response, the one that is profiled
+    def finish():
+        if profiler:
+            _save_profile(profiler, *profile_args)
+        REQUEST_SECONDS.observe(time.perf_counter() - start_time, endpoint=endpoint, status=response.status_code)
+        unpin_artifacts()
+
+    response.call_on_close(finish)
+    return response
+
+
 # create a route for handling file upload and imputation, with the HTTP method POST
 @app.route('/impute-file', methods=['POST'])
 def impute_file():
@@ -83,21 +221,31 @@ def impute_file():
         file = request.files.get("genofile", None)
 
         if file:
-            # apply the GRIM algorithm to the file
-            genotype_path, haplotype_path = apply_grim_file(file)
-
-            # write the results to a ZIP file and send it as a response
+            g.profile_tag = file.filename
+            if request.args.get("format") == "ndjson":
+                return stream_results(file)
+            output_format = request.args.get("format", "csv")
+            compression = request.args.get("compression", "none")
+            # an unknown format or compression, or zstd without the zstandard package, fails before the imputation
+            try:
+                columnar.check_format(output_format)
+                columnar.check_compression(compression)
+            except ValueError as e:
+                return render_template("error.html", active="", error=str(e)), 400
+            # write the results (and the malformed lines, if any) to a ZIP file and send it as a response, the
+            # intermediate files are removed with the workspace of the request
             stream = BytesIO()
-
-            with ZipFile(stream, 'w') as zf:
-                zf.write(genotype_path, os.path.basename(genotype_path))
-                zf.write(haplotype_path, os.path.basename(haplotype_path))
+            with request_workspace() as workspace:
+                # apply the GRIM algorithm to the file
+                genotype_path, haplotype_path, errors_path = apply_grim_file(file, workspace, output_format,
+                                                                             compression)
+                result_paths = [genotype_path, haplotype_path] + ([errors_path] if errors_path else [])
+
+                with ZipFile(stream, 'w') as zf:
+                    for path in result_paths:
+                        zf.write(path, os.path.basename(path))
             stream.seek(0)
 
-            # remove the intermediate files
-            os.remove(genotype_path)
-            os.remove(haplotype_path)
-
             return send_file(stream, as_attachment=True, download_name='grimmard_results.zip')
 
     # render an error template if an exception occurs
@@ -106,6 +254,47 @@ def impute_file():
         return render_template("error.html", active="", error=str(e))
 
 
+def job_response(status):
+    # the status of a job, with the urls to poll it and to download its results
+    return dict(status,
+                status_url=url_for("job_status", job_id=status["job_id"]),
+                result_url=url_for("job_result", job_id=status["job_id"]))
+
+
+# create a route for submitting a file for asynchronous imputation, it returns the job id immediately
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    file = request.files.get("genofile", None)
+    if not file:
+        return jsonify(error="No genofile was uploaded"), 400
+
+    status = get_job_queue().submit(file)
+    return jsonify(job_response(status)), 202, {"Location": url_for("job_status", job_id=status["job_id"])}
+
+
+# create a route for the status and progress (subjects done / total) of a job
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    try:
+        status = get_job_queue().status(job_id)
+    except KeyError:
+        return jsonify(error=f"No job {job_id}, it may have expired"), 404
+    return jsonify(job_response(status))
+
+
+# create a route for downloading the results zip of a finished job
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job_queue = get_job_queue()
+    try:
+        result_path = job_queue.result_path(job_id)
+    except KeyError:
+        return jsonify(error=f"No job {job_id}, it may have expired"), 404
+    if result_path is None:
+        return jsonify(job_response(job_queue.status(job_id))), 409
+    return send_file(os.path.abspath(result_path), as_attachment=True, download_name='grimmard_results.zip')
+
+
 @app.route('/impute-form', methods=['POST'])
 def impute_form():
     try:
@@ -113,16 +302,7 @@ def impute_form():
         race = request.form.get("race", "UNK;")[:-1]
         race_list = race.split(";")
 
-        loci = request.form.get("luci", "")[:-1]
-        # If user hasn't entered any loci, choose all.
-        if loci == "":
-            loci = "A;B;C;DRB1;DQB1;DRB3;DRB4;DRB5;DRBX;DPB1;DPA1;DQA1"
-        # Split the string into a list.
-        loci_list = loci.split(";")
-        # If DRB3/4/5 has been selected, replace it with ["DRB3", "DRB4", "DRB5"].
-        if "DRB3/4/5" in loci_list:
-            loci_list.remove("DRB3/4/5")
-            loci_list += ["DRB3", "DRB4", "DRB5", "DRBX"]
+        loci_list = parse_loci(request.form.get("luci", "")[:-1])
 
         form_dict = request.form.to_dict()
 
@@ -134,20 +314,54 @@ def impute_form():
 
         is_genetic = a_race == "01"
 
+        # the number of results, the configured one if not given
+        num_res = request.form.get("num_results", "") or None
+
         # apply the GRIM algorithm to the input data
         genotypes, haplotypes, haplotypes_pairs, glstring, ard_string = apply_grim(form_dict, race, loci_list,
-                                                                                   is_genetic=is_genetic)
+                                                                                   is_genetic=is_genetic,
+                                                                                   num_res=num_res)
+        g.profile_tag = ard_string
 
         # render a template with the imputation results
-        return render_template("results.html", active="Home",
-                               haplotypes=haplotypes, genotypes=genotypes, races=race_list,
-                               ard_string=ard_string, glstring=glstring, imputation_race=race,
-                               haplotypes_pairs=haplotypes_pairs)
+        with stage_timer("render"):
+            return render_template("results.html", active="Home",
+                                   haplotypes=haplotypes, genotypes=genotypes, races=race_list,
+                                   ard_string=ard_string, glstring=glstring, imputation_race=race,
+                                   haplotypes_pairs=haplotypes_pairs)
     #render an error template if an exception occurs
     except Exception as e:
         traceback.print_exc()
         return render_template("error.html", active="", error=str(e))
 
+def stream_results(file):
+    """
+        Streams the results of an uploaded file as newline-delimited JSON, a line per subject as its chunk is imputed.
+
+        Parameters:
+        file (FileStorage): The uploaded file.
+
+        Returns:
+        Response: The chunked response.
+        """
+    def generate():
+        with open(upload_path, encoding="utf-8", newline="") as lines:
+            for result in impute_stream(lines):
+                yield json.dumps(result, separators=(",", ":")) + "\n"
+
+    with contextlib.ExitStack() as cleanup:
+        # the uploaded file is closed with the request, before the response is sent, so it is read from a copy in a
+        # workspace of the request
+        upload_path = os.path.join(cleanup.enter_context(request_workspace()), "upload.txt")
+        file.save(upload_path)
+
+        # the request, and the version of the artifacts it started with, are kept until the last line is sent
+        response = finish_on_close(Response(stream_with_context(generate()), mimetype="application/x-ndjson"))
+        # the workspace is removed when the response is closed, even if the client is gone before it started
+        response.call_on_close(cleanup.pop_all().close)
+    return response
+
+
 # create a route for handling form submission and imputation, with the HTTP method POST
 # @app.route('/impute-form', methods=['POST'])
 # def impute_form():
@@ -179,6 +393,118 @@ def impute_form():
 #         return render_template("error.html", active="", error=str(e))
 
 
+def impute_api_subject(number, subject):
+    """
+        Imputes a subject of a /api/v1/impute request.
+
+        Parameters:
+        number (int): The number of the subject in the request, its id if it has none.
+        subject (dict): The subject, with a glstring or the alleles of the form fields (e.g. {"A1": "A*02:01"}), and
+        optionally its id, race (e.g. "AFA;CAU" or ["AFA", "CAU"]), loci, num_results and serology.
+
+        Returns:
+        dict: The id and the results of the subject (see apply_grim_json), or its id and the error.
+        """
+    if not isinstance(subject, dict):
+        return {"id": str(number), "error": "Expected a JSON object"}
+    subject_id = str(subject.get("id", number))
+    try:
+        race = subject.get("race") or "UNK"
+        race = ";".join(race) if isinstance(race, list) else race
+        loci = subject.get("loci") or ""
+        loci = parse_loci(";".join(loci) if isinstance(loci, list) else loci)
+        if subject.get("glstring"):
+            alleles = {"glstring": subject["glstring"]}
+        elif isinstance(subject.get("alleles"), dict):
+            alleles = subject["alleles"]
+        else:
+            return {"id": subject_id, "error": "Expected a glstring or alleles"}
+        result = apply_grim_json(alleles, race, loci, is_genetic=not subject.get("serology", False),
+                                 num_res=subject.get("num_results"))
+        return {"id": subject_id, **result}
+    except Exception as e:
+        traceback.print_exc()
+        return {"id": subject_id, "error": str(e) or type(e).__name__}
+
+
+# create a route for imputing a batch of subjects, sent and answered as JSON
+@app.route('/api/v1/impute', methods=['POST'])
+def api_impute():
+    try:
+        body = request.get_data()
+        if request.content_encoding == "gzip":
+            body = gzip.decompress(body)
+        subjects = json.loads(body)
+    except (OSError, EOFError, ValueError) as e:
+        return jsonify(error=f"Invalid JSON body: {e}"), 400
+    if not isinstance(subjects, list):
+        return jsonify(error="Expected a JSON array of subjects"), 400
+    max_subjects = g.artifacts.engine.json_conf.get("api_max_subjects", 1000)
+    if len(subjects) > max_subjects:
+        return jsonify(error=f"At most {max_subjects} subjects per request, got {len(subjects)}"), 413
+
+    g.profile_tag = f"{len(subjects)} subjects"
+    results = [impute_api_subject(number, subject) for number, subject in enumerate(subjects, start=1)]
+
+    # compact JSON, gzipped when the client accepts it
+    payload = json.dumps({"version": g.artifacts.version, "results": results}, separators=(",", ":")).encode()
+    response = Response(payload, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if len(payload) >= GZIP_MIN_BYTES and "gzip" in request.accept_encodings:
+        response.set_data(gzip.compress(payload, compresslevel=6))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+# create a route for the hit/miss counters of the result cache of this worker process
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify(get_result_cache().stats())
+
+
+# create a route for the active version of the artifacts of this worker process
+@app.route('/version', methods=['GET'])
+def version():
+    return jsonify(artifact_manager.status())
+
+
+ADMIN_HEADER = "X-Grimmard-Admin"
+
+
+# create a route to load the artifacts of this worker process again now, if they changed, instead of at the next check.
+# It needs the configured admin_token in the X-Grimmard-Admin header, and does not exist without one.
+@app.route('/reload', methods=['POST'])
+def reload():
+    admin_token = artifact_manager.active.engine.json_conf.get("admin_token")
+    if not admin_token:
+        return jsonify(error="Not found"), 404
+    if not hmac.compare_digest(request.headers.get(ADMIN_HEADER, "").encode(), admin_token.encode()):
+        return jsonify(error=f"The {ADMIN_HEADER} header does not have the admin token"), 403
+    artifact_manager.reload()
+    return jsonify(artifact_manager.status()), 202
+
+
+# create a route for the liveness of this worker process
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify(status="ok")
+
+
+# create a route for the readiness of this worker process, 503 until its warm-up is done
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    status = imputation.startup.status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+
+# create a route for the metrics of this worker process, in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    ARTIFACTS_INFO.clear()
+    ARTIFACTS_INFO.set(1, version=g.artifacts.version)
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route('/impute', methods=['GET'])
 def impute():
     return render_template("index.html", active="Home")
@@ -205,4 +531,6 @@ def about():
     return render_template("about.html", active="About")
 
 if __name__ == "__main__":
-    app.run(debug=True, host='0.0.0.0', port=5000, use_reloader=True)
+    # the debugger runs code sent to it, and the reloader restarts on every change, so both are off unless asked for
+    debug = os.environ.get("GRIMMARD_DEBUG", "0") == "1"
+    app.run(debug=debug, host='0.0.0.0', port=5000, use_reloader=debug)
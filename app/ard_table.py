@@ -0,0 +1,102 @@
+"""
+An in-memory allele reduction table in front of py-ard.
+
+py-ard reduces a GL string by splitting it on its delimiters and reducing each allele, with SQLite backed lookups
+and a bounded cache. The table holds the reduction of every allele of the frequency graph, built once at startup,
+and memoizes the reduction of any other allele and of the locus genotypes in bounded LRU caches, so the alleles of
+the requests do not grow the table of a long-lived worker. GL strings are split and put back
+together the same way py-ard does, so the reduced strings are the same.
+"""
+import functools
+
+from pyard.smart_sort import smart_sort_comparator
+
+# the GL string delimiters, in the order of precedence py-ard splits by
+GL_DELIMITERS = ("^", "|", "+", "~", "/")
+# the number of alleles that are not in the table, and of locus genotypes, whose reductions are memoized
+MEMO_SIZE = 100000
+
+
+class ReductionTable:
+    """
+        Reduces GL strings token-wise against a table of allele reductions.
+
+        Parameters:
+        ard (pyard.ARD): The py-ard instance to reduce the alleles that are not in the table with.
+        redux_type (str): The py-ard reduction type.
+        memo_size (int): The number of other alleles, and of locus genotypes, whose reductions are memoized.
+        """
+
+    def __init__(self, ard, redux_type="lgx", memo_size=MEMO_SIZE):
+        self.ard = ard
+        self.redux_type = redux_type
+        # the reductions of the alleles of the frequency graph, see build
+        self.alleles = {}
+        self._reduce_other_allele = functools.lru_cache(memo_size)(self._redux)
+        # reductions of locus genotypes (e.g. 'A*01:01+A*02:01'), the parts of a GL string that repeat the most
+        self.reduce_genotype = functools.lru_cache(memo_size)(self._reduce)
+        ignore_suffixes = getattr(getattr(ard, "config", None), "ignore_allele_with_suffixes", ())
+        self._sort_key = functools.cmp_to_key(lambda a, b: smart_sort_comparator(a, b, ignore_suffixes))
+
+    def build(self, alleles):
+        """
+            Adds the reductions of the given alleles to the table.
+
+            Parameters:
+            alleles (Iterable[str]): The alleles, e.g. those of the frequency graph.
+
+            Returns:
+            int: The number of alleles in the table.
+            """
+        for allele in alleles:
+            if allele not in self.alleles:
+                try:
+                    self.alleles[allele] = self.ard.redux(allele, self.redux_type)
+                except Exception:
+                    # e.g. DRBX*NNNN, it is not an allele py-ard knows
+                    pass
+        return len(self.alleles)
+
+    def _redux(self, allele):
+        return self.ard.redux(allele, self.redux_type)
+
+    def reduce_allele(self, allele):
+        reduced = self.alleles.get(allele)
+        if reduced is None:
+            reduced = self._reduce_other_allele(allele)
+        return reduced
+
+    def _join(self, gls, delim):
+        # put the reduced parts back together like py-ard's GL string handler
+        if delim == "~":
+            return delim.join(gls)
+        if delim == "+":
+            return delim.join(sorted((gl for gl in gls if gl != ""), key=self._sort_key))
+        all_gls = set()
+        for gl in gls:
+            all_gls.update(gl.split(delim))
+        all_gls.discard("")
+        return delim.join(sorted(all_gls, key=self._sort_key))
+
+    def _reduce(self, gl):
+        for delim in GL_DELIMITERS:
+            if delim in gl:
+                return self._join([self._reduce(part) for part in gl.split(delim)], delim)
+        return self.reduce_allele(gl)
+
+    def reduce(self, glstring):
+        """
+            Reduces a GL string, as ard.redux(glstring, redux_type) does.
+
+            Parameters:
+            glstring (str): The GL string.
+
+            Raises:
+            Exception: py-ard's exception, if the GL string has an invalid allele.
+
+            Returns:
+            str: The reduced GL string.
+            """
+        if "^" in glstring:
+            return self._join([self.reduce_genotype(gl) for gl in glstring.split("^")], "^")
+        return self.reduce_genotype(glstring)
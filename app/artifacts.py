@@ -0,0 +1,126 @@
+"""
+Versioned artifacts: the configuration, the graph and the frequencies, loaded together.
+
+A version of the artifacts is loaded and validated as a whole, and then replaces the active version with a single
+reference swap. Requests take the active version when they start and use it until they finish, so a new frequency
+release is put in service without restarting the workers, and the requests in flight finish on the version they
+started with. The files are checked for changes at most every poll interval, and a changed version is loaded in a
+background thread while the active version keeps serving.
+"""
+import threading
+import time
+import traceback
+
+
+class Artifacts:
+    """
+        One loaded version of the artifacts.
+
+        Parameters:
+        version (str): The version, see cache.artifacts_version.
+        components (dict): The loaded components by name (e.g. 'engine', 'graph', 'hap_index').
+        """
+
+    def __init__(self, version, **components):
+        self.version = version
+        self.loaded_at = time.time()
+        self.__dict__.update(components)
+
+
+class ArtifactManager:
+    """
+        Holds the active version of the artifacts, and loads new versions in the background.
+
+        Parameters:
+        load (Callable[[str], Artifacts]): Loads and validates the artifacts of a version. Raises if they are not
+        valid.
+        current_version (Callable[[], str]): Returns the version of the artifacts on disk.
+        poll_interval (Callable[[Artifacts], float]): Returns the seconds between checks of the files, by the active
+        version (so it is configurable), or 0 to never check.
+        """
+
+    def __init__(self, load, current_version, poll_interval=lambda artifacts: 30):
+        self._load = load
+        self._current_version = current_version
+        self._poll_interval = poll_interval
+        self._active = None
+        self._lock = threading.Lock()
+        self._loading = None
+        self._last_check = 0.0
+        self._failed_version = None
+        self.last_error = None
+
+    @property
+    def active(self):
+        """The active version of the artifacts, loaded on first use."""
+        active = self._active
+        if active is None:
+            with self._lock:
+                if self._active is None:
+                    self._active = self._load(self._current_version())
+                    self._last_check = time.time()
+                active = self._active
+        return active
+
+    def check_for_update(self):
+        """
+            Starts loading the artifacts in the background if they changed on disk, at most every poll interval.
+
+            Returns:
+            bool: Whether a new version is being loaded.
+            """
+        active = self.active
+        interval = self._poll_interval(active)
+        if not interval or time.time() - self._last_check < interval:
+            return self._loading is not None
+        self._last_check = time.time()
+        return self.reload()
+
+    def reload(self):
+        """
+            Starts loading the artifacts in the background, if their version is not the active one.
+
+            Returns:
+            bool: Whether a new version is being loaded.
+            """
+        with self._lock:
+            if self._loading is not None:
+                return True
+            version = self._current_version()
+            if version == self._failed_version or (self._active is not None and version == self._active.version):
+                return False
+            self._loading = threading.Thread(target=self._reload, args=(version,), name="grimmard-artifacts",
+                                             daemon=True)
+            self._loading.start()
+            return True
+
+    def _reload(self, version):
+        try:
+            artifacts = self._load(version)
+            print(f"Loaded artifacts version {version}")
+            with self._lock:
+                self._active = artifacts
+            self._failed_version = None
+            self.last_error = None
+        except Exception as e:
+            # keep serving the active version, the load is tried again when the files change
+            traceback.print_exc()
+            self._failed_version = version
+            self.last_error = f"version {version}: {e}"
+        finally:
+            self._loading = None
+
+    def status(self):
+        """
+            Returns the active version, and whether a new one is being loaded.
+
+            Returns:
+            dict: The status.
+            """
+        active = self.active
+        return {
+            "version": active.version,
+            "loaded_at": active.loaded_at,
+            "loading": self._loading is not None,
+            "last_error": self.last_error,
+        }
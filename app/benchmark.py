@@ -0,0 +1,297 @@
+"""
+Benchmarks of the stages of the imputation request path, on the bundled example data.
+
+The subjects are sampled, with a fixed seed, from the haplotype frequencies of the populations in data/freq_9loci, so
+every run imputes the same GL strings. Each stage is timed over a number of repeats, and the results are saved as JSON
+with the machine and the commit they ran on. Two runs are compared stage by stage, and a stage whose median time grew
+by more than the threshold is flagged as a regression.
+
+Run from the app directory:
+    python3 benchmark.py run --output bench.json [--repeats 5] [--subjects 50] [--stages ard_form,impute_one]
+    python3 benchmark.py compare base.json bench.json [--threshold 0.1]
+"""
+import argparse
+import io
+import json
+import os
+import pickle
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from synthetic_donors import FREQ_DATA_DIR, generate_donors, load_haplotypes, to_glstring
+
+SEED = 2024
+# the loci of the reduce_loci stage and of the web form requests
+REDUCED_LOCI = ["A", "B", "C", "DRB1"]
+
+
+def sample_subjects(n, freq_data_dir=FREQ_DATA_DIR, populations=("AFA", "CAU"), seed=SEED):
+    """
+        Samples fully typed subjects from the haplotype frequencies of the populations, see synthetic_donors.py.
+
+        Parameters:
+        n (int): The number of subjects.
+        freq_data_dir (str): The directory of the frequency files.
+        populations (Iterable[str]): The populations to sample from.
+        seed (int): The random seed.
+
+        Returns:
+        List[tuple[str, str, str]]: The id, GL string and race of each subject.
+        """
+    haplotypes = load_haplotypes(populations, freq_data_dir)
+    return [(donor["id"], to_glstring(donor), donor["race1"]) for donor in generate_donors(n, haplotypes, seed)]
+
+
+def timed(function, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+class Benchmark:
+    """
+        The stages of the request path, with their inputs prepared in a temporary directory.
+
+        Parameters:
+        subjects (List[tuple[str, str, str]]): The subjects, see sample_subjects.
+        work_dir (str): The temporary directory.
+        """
+
+    def __init__(self, subjects, work_dir):
+        import imputation
+
+        self.imputation = imputation
+        self.subjects = subjects
+        self.work_dir = work_dir
+        self.engine = imputation.get_engine()
+        self.donor_path = self.path("donors.csv")
+        with open(self.donor_path, "w") as f:
+            for subject_id, gl, race in subjects:
+                f.write(f"{subject_id},{gl},{race},{race}\n")
+        self.ard_path = self.path("donors_ard.csv")
+        imputation.apply_ard_on_file(self.donor_path, self.ard_path)
+        self.genotype_path = self.path("genotype.csv")
+        self.haplotype_path = self.path("haplotype.csv")
+        self.engine.impute_file(self.ard_path, self.haplotype_path, self.genotype_path)
+        self._next_form = 0
+
+    def path(self, name):
+        return os.path.join(self.work_dir, name)
+
+    def ard_form(self):
+        # the web form GL strings, reduced by the in-memory allele table
+        for _, gl, _ in self.subjects:
+            self.imputation.apply_ard({"glstring": gl}, True)
+
+    def ard_file(self):
+        self.imputation.apply_ard_on_file(self.donor_path, self.path("ard_file.csv"))
+
+    def donor_file(self):
+        # the single subject input file of a form request (formerly change_donor_file)
+        for _, gl, race in self.subjects:
+            os.remove(self.imputation.string_to_file(gl, race, race))
+
+    def impute_file(self):
+        # run_impute: grim on the reduced input file, in this process
+        self.engine.impute_file(self.ard_path, self.path("impute_haps.csv"), self.path("impute_genos.csv"))
+
+    def impute_file_parallel(self):
+        self.engine.impute_file_parallel(self.ard_path, self.path("parallel_haps.csv"),
+                                         self.path("parallel_genos.csv"))
+
+    def impute_one(self):
+        from grim.filter_top_3 import split_gl
+
+        for subject_id, gl, race in self.subjects:
+            self.engine.impute_one(subject_id, split_gl(gl)[0], race, race)
+
+    def filter_extra_gl(self):
+        # filtering the results of the 3 dominant loci by the rest of the GL string (formerly change_output_by_extra_gl)
+        from grim.filter_by_rest import filter_results
+
+        for res_haps, extra_gl in self._filter_inputs():
+            filter_results(res_haps, extra_gl)
+
+    def _filter_inputs(self):
+        if not hasattr(self, "_filter_cache"):
+            from grim.filter_top_3 import split_gl
+
+            self._filter_cache = []
+            for subject_id, gl, race in self.subjects:
+                short_gl, extra_gl = split_gl(gl)
+                _, res_haps = self.engine.impute_one(subject_id, short_gl, race, race)
+                if extra_gl and isinstance(res_haps["Haps"], list):
+                    self._filter_cache.append((res_haps, extra_gl))
+        return self._filter_cache
+
+    def reduce_loci(self):
+        from reduce_loci import reduce_loci
+
+        genotype_path = shutil.copy(self.genotype_path, self.path("reduce_genos.csv"))
+        haplotype_path = shutil.copy(self.haplotype_path, self.path("reduce_haps.csv"))
+        reduce_loci(REDUCED_LOCI, genotype_path, haplotype_path)
+
+    def read_results(self):
+        self.imputation.read_genos(self.genotype_path)
+        self.imputation.read_haps(self.haplotype_path, "AFA;CAU")
+
+    def graph_unpickle(self):
+        with open(self.imputation.PATH_TO_GRIM_GRAPH, "rb") as f:
+            pickle.load(f)
+
+    def graph_store_load(self):
+        from graph_store import load_graph
+
+        load_graph(self.imputation.PATH_TO_GRIM_GRAPH_STORE)
+
+    def _client(self):
+        if not hasattr(self, "_test_client"):
+            from app import app
+
+            self.imputation.startup.ready.wait()
+            self._test_client = app.test_client()
+        return self._test_client
+
+    def e2e_impute_form(self):
+        # a subject not asked before in this run, so the result cache misses
+        _, gl, race = self.subjects[self._next_form % len(self.subjects)]
+        self._next_form += 1
+        data = {"race": f"{race};", "luci": ";".join(REDUCED_LOCI) + ";", "glstring": gl}
+        response = self._client().post("/impute-form", data=data)
+        assert response.status_code == 200, response.status_code
+
+    def e2e_impute_file(self):
+        with open(self.donor_path, "rb") as f:
+            data = {"genofile": (io.BytesIO(f.read()), "donors.csv")}
+        response = self._client().post("/impute-file", data=data, content_type="multipart/form-data")
+        assert response.status_code == 200, response.status_code
+
+
+STAGES = ["ard_form", "ard_file", "donor_file", "impute_file", "impute_file_parallel", "impute_one", "filter_extra_gl",
+          "reduce_loci", "read_results", "graph_unpickle", "graph_store_load", "e2e_impute_form", "e2e_impute_file"]
+
+
+def machine_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "commit": commit or None,
+    }
+
+
+def run(stages=STAGES, repeats=5, n_subjects=50):
+    """
+        Runs the benchmarks.
+
+        Parameters:
+        stages (List[str]): The stages to time, see STAGES.
+        repeats (int): The number of times each stage is timed.
+        n_subjects (int): The number of subjects.
+
+        Returns:
+        dict: The machine info, the settings and the times of each stage, in seconds.
+        """
+    subjects = sample_subjects(n_subjects)
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        benchmark = Benchmark(subjects, work_dir)
+        for stage in stages:
+            stage_function = getattr(benchmark, stage)
+            if stage == "filter_extra_gl":
+                benchmark._filter_inputs()
+            times = timed(stage_function, repeats)
+            results[stage] = {
+                "median": statistics.median(times),
+                "min": min(times),
+                "mean": statistics.mean(times),
+                "max": max(times),
+                "times": times,
+            }
+            print(f"{stage:22s} median {results[stage]['median'] * 1000:10.2f} ms  min {min(times) * 1000:10.2f} ms")
+    return {
+        "machine": machine_info(),
+        "created": time.time(),
+        "settings": {"repeats": repeats, "subjects": n_subjects, "seed": SEED},
+        "results": results,
+    }
+
+
+def compare(base, new, threshold=0.1):
+    """
+        Compares the median times of two runs.
+
+        Parameters:
+        base (dict): The base run.
+        new (dict): The new run.
+        threshold (float): The relative growth of the median time that is a regression.
+
+        Returns:
+        List[str]: The stages that regressed.
+        """
+    regressions = []
+    print(f"{'stage':22s} {'base ms':>12s} {'new ms':>12s} {'change':>8s}")
+    for stage, result in new["results"].items():
+        if stage not in base["results"]:
+            print(f"{stage:22s} {'-':>12s} {result['median'] * 1000:12.2f}")
+            continue
+        base_median = base["results"][stage]["median"]
+        change = result["median"] / base_median - 1 if base_median else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(stage)
+        print(f"{stage:22s} {base_median * 1000:12.2f} {result['median'] * 1000:12.2f} {change:+8.1%}{flag}")
+    if base["machine"] != new["machine"]:
+        print("Note: the runs are of different machines or commits:")
+        for key in new["machine"]:
+            if base["machine"].get(key) != new["machine"][key]:
+                print(f"\t{key}: {base['machine'].get(key)} -> {new['machine'][key]}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the imputation request path.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("-o", "--output", default="bench.json", help="Output JSON file", type=str)
+    run_parser.add_argument("-r", "--repeats", default=5, help="Times each stage is timed", type=int)
+    run_parser.add_argument("-n", "--subjects", default=50, help="Number of subjects", type=int)
+    run_parser.add_argument("-s", "--stages", default=",".join(STAGES), help="Comma separated stages", type=str)
+    compare_parser = commands.add_parser("compare", help="Compare two runs")
+    compare_parser.add_argument("base", help="Base run JSON file", type=str)
+    compare_parser.add_argument("new", help="New run JSON file", type=str)
+    compare_parser.add_argument("-t", "--threshold", default=0.1, help="Relative slowdown that is a regression",
+                                type=float)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        stages = [stage for stage in args.stages.split(",") if stage]
+        unknown = set(stages) - set(STAGES)
+        if unknown:
+            parser.error(f"Unknown stages {sorted(unknown)}, the stages are {STAGES}")
+        report = run(stages, args.repeats, args.subjects)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved {args.output}")
+    else:
+        with open(args.base) as f_base, open(args.new) as f_new:
+            regressions = compare(json.load(f_base), json.load(f_new), args.threshold)
+        if regressions:
+            sys.exit(f"Regressions: {regressions}")
@@ -0,0 +1,148 @@
+"""
+Builds the HPF file, the population ratios and the frequency dictionaries from the frequency files, in one pass.
+
+Each population's frequency file (<freq_data_dir>/<pop>.freqs.gz) is read by a separate process, which streams its
+rows and writes the population's part of the HPF file and its frequency dictionary. The parts are then put together
+in the order of the configured populations, so the HPF file and pop_ratio.txt are the same as produce_hpf writes.
+No process holds more than one population's haplotypes.
+
+The frequency dictionaries, of the haplotypes (their alleles sorted, joined by '~') to their frequency, are written
+one pickle per population and then put together in a frequencies store, see freqs_store.py.
+
+Run from the app directory:
+    python3 build_freqs.py --config conf/conf.json
+"""
+import argparse
+import csv
+import gzip
+import json
+import multiprocessing
+import os
+import pathlib
+import pickle
+import shutil
+import tempfile
+
+from freqs_store import save_freqs
+
+HPF_HEADER = ["hap", "pop", "freq"]
+
+
+def read_freq_file(path):
+    """
+        Streams the rows of a frequency file.
+
+        Parameters:
+        path (str): The gzipped frequency file, with 'Haplo,Count,Freq' rows.
+
+        Returns:
+        Iterator[tuple[str, float, float]]: The haplotype, count and frequency of each row.
+        """
+    with gzip.open(path, "rt", encoding="utf8") as f:
+        for line in f:
+            haplotype, count, freq = line.strip().split(",")
+            if haplotype == "Haplo":
+                continue
+            yield haplotype, float(count), float(freq)
+
+
+def _build_population(task):
+    """Reads the frequency file of one population, and writes its HPF part and its frequency dictionary."""
+    pop, freq_path, part_path, freqs_path = task
+    print(f"Reading Frequency File:\t {freq_path}")
+
+    # the haplotypes of the population with their frequency, the last row of a repeated haplotype wins
+    hpf_freqs = {}
+    freqs = {}
+    count_pop = 0
+    for haplotype, count, freq in read_freq_file(freq_path):
+        freqs["~".join(sorted(haplotype.split("~")))] = freq
+        # Ignore lines with 0 freq
+        if freq == 0.0:
+            continue
+        hpf_freqs[haplotype] = freq
+        count_pop += count
+
+    with open(part_path, "w") as f:
+        csv_writer = csv.writer(f, delimiter=",", quoting=csv.QUOTE_NONE)
+        for haplotype, freq in hpf_freqs.items():
+            csv_writer.writerow([haplotype, pop, freq])
+
+    if freqs_path:
+        with open(freqs_path, "wb") as f:
+            pickle.dump(freqs, f)
+    return count_pop
+
+
+def build_frequencies(conf_file, freqs_dir="data/freqs_dicts", hpf_path=None, pop_ratio_path=None, processes=None):
+    """
+        Builds the HPF file, pop_ratio.txt and the frequency dictionaries of the configured populations.
+
+        Parameters:
+        conf_file (str): The configuration JSON file, with populations, freq_data_dir, freq_file and
+        pops_count_file.
+        freqs_dir (str): The directory of the frequencies store, or None to not write it.
+        hpf_path (str): The HPF file, instead of the configured freq_file.
+        pop_ratio_path (str): The population ratios file, instead of the configured pops_count_file.
+        processes (int): The number of processes reading the frequency files. Default - the number of cores.
+
+        Returns:
+        dict: The haplotype count of each population.
+        """
+    with open(conf_file) as f:
+        conf = json.load(f)
+
+    pops = conf.get("populations")
+    freq_data_dir = conf.get("freq_data_dir")
+    hpf_path = hpf_path or conf.get("freq_file")
+    pop_ratio_path = pop_ratio_path or conf.get("pops_count_file")
+    if conf.get("graph_files_path"):
+        pathlib.Path(conf.get("graph_files_path")).mkdir(parents=True, exist_ok=True)
+    for path in (hpf_path, pop_ratio_path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    print(f"Building the frequencies of {pops} from {freq_data_dir}")
+    processes = min(processes or os.cpu_count(), len(pops))
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(hpf_path) or ".") as tmp_dir:
+        tasks = [(pop, os.path.join(freq_data_dir, f"{pop}.freqs.gz"), os.path.join(tmp_dir, f"{pop}.csv"),
+                  os.path.join(tmp_dir, f"{pop}.pickle") if freqs_dir else None) for pop in pops]
+        if processes > 1:
+            with multiprocessing.get_context("fork").Pool(processes) as pool:
+                counts = pool.map(_build_population, tasks, chunksize=1)
+        else:
+            counts = [_build_population(task) for task in tasks]
+
+        print(f"Writing hpf File:\t {hpf_path}")
+        with open(hpf_path, "w") as f_out:
+            csv.writer(f_out, delimiter=",", quoting=csv.QUOTE_NONE).writerow(HPF_HEADER)
+            f_out.flush()
+            for _, _, part_path, _ in tasks:
+                with open(part_path, "rb") as f_part:
+                    shutil.copyfileobj(f_part, f_out.buffer)
+
+        if freqs_dir:
+            def load_pickle(pop):
+                with open(os.path.join(tmp_dir, f"{pop}.pickle"), "rb") as f:
+                    return pickle.load(f)
+
+            print(f"Writing frequencies store:\t {freqs_dir}")
+            save_freqs(pops, load_pickle, freqs_dir)
+
+    sum_pops = sum(counts)
+    with open(pop_ratio_path, "w") as f:
+        for pop, ratio in zip(pops, counts):
+            f.write("{},{},{}\n".format(pop, ratio, (ratio / sum_pops)))
+    return dict(zip(pops, counts))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the HPF file, pop_ratio.txt and the frequency dictionaries.")
+    parser.add_argument("-c", "--config", default="conf/conf.json", help="Configuration JSON file", type=str)
+    parser.add_argument("-f", "--freqs-dir", default="data/freqs_dicts", help="Frequencies store directory",
+                        type=str)
+    parser.add_argument("-p", "--processes", default=None, help="Number of processes, default: number of cores",
+                        type=int)
+    args = parser.parse_args()
+
+    build_frequencies(args.config, freqs_dir=args.freqs_dir, processes=args.processes)
@@ -0,0 +1,211 @@
+"""
+A cache of imputation results.
+
+Results are cached by their ARD reduced GL string, race(s), requested loci, number of results and the version of
+the configuration and the graph they were imputed with. The cache has an in-memory LRU tier, bounded by the size of
+the pickled results, and an optional SQLite tier that survives restarts and is shared by all the worker processes.
+"""
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+# the disk tier is trimmed to its size after this number of writes
+DISK_TRIM_INTERVAL = 100
+
+
+def artifacts_version(paths):
+    """
+        Returns a hash that changes when any of the given files or directories change.
+
+        Small files are hashed by their content, and large files by their size and modification time.
+
+        Parameters:
+        paths (Iterable[str]): The configuration, graph and frequencies files.
+
+        Returns:
+        str: The version hash.
+        """
+    version = hashlib.sha256()
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+        for file_path in files:
+            if not os.path.isfile(file_path):
+                continue
+            stat = os.stat(file_path)
+            version.update(file_path.encode())
+            if stat.st_size < 1 << 20:
+                with open(file_path, "rb") as f:
+                    version.update(f.read())
+            else:
+                version.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return version.hexdigest()[:16]
+
+
+class ResultCache:
+    """
+        A two tier (memory LRU and optional SQLite) cache of imputation results.
+
+        Parameters:
+        version (str): The version of the configuration and the graph, part of every key.
+        max_bytes (int): The maximum size of the pickled results in the memory tier.
+        db_path (str): The path to the SQLite database of the disk tier, or None to disable it.
+        max_disk_bytes (int): The maximum size of the pickled results in the disk tier.
+        """
+
+    def __init__(self, version, max_bytes=64 << 20, db_path=None, max_disk_bytes=1 << 30):
+        self.version = version
+        self.max_bytes = max_bytes
+        self.db_path = db_path
+        self.max_disk_bytes = max_disk_bytes
+
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+        self._disk_writes = 0
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+    def key(self, ard_string, race, loci, num_res, kind="form"):
+        """
+            Returns the cache key of a query.
+
+            Parameters:
+            ard_string (str): The ARD reduced GL string.
+            race (str): The race(s), separated by ';'.
+            loci (List[str]): The requested loci.
+            num_res (int): The requested number of results.
+            kind (str): The kind of result, for results of the same query in other formats. Default - the results
+            of the web form.
+
+            Returns:
+            str: The key.
+            """
+        # the races are a set of populations to grim, "CAU;AFA;" is the same query as "AFA;CAU"
+        race = ";".join(sorted(filter(None, race.split(";"))))
+        query = json.dumps([self.version, ard_string.strip(), race, sorted(set(loci)), num_res, kind])
+        return hashlib.sha256(query.encode()).hexdigest()
+
+    def _connection(self):
+        # an sqlite connection must not be used across a fork, each process opens its own
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS results "
+                             "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, accessed REAL)")
+            self._db_pid = os.getpid()
+        return self._db
+
+    def _put_memory(self, key, value):
+        if key in self._entries:
+            self._size -= len(self._entries.pop(key))
+        if len(value) > self.max_bytes:
+            return
+        self._entries[key] = value
+        self._size += len(value)
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            self.counters["evictions"] += 1
+
+    def get(self, key):
+        """
+            Returns the cached result of a key, or None.
+
+            Parameters:
+            key (str): The key, see ResultCache.key.
+
+            Returns:
+            Any: The result.
+            """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return pickle.loads(value)
+
+            if self.db_path:
+                try:
+                    db = self._connection()
+                    row = db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                    if row is not None:
+                        db.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+                        db.commit()
+                        value = row[0]
+                        self._put_memory(key, value)
+                        self.counters["disk_hits"] += 1
+                        return pickle.loads(value)
+                except sqlite3.Error:
+                    traceback.print_exc()
+
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, key, result):
+        """
+            Caches a result.
+
+            Parameters:
+            key (str): The key, see ResultCache.key.
+            result (Any): The result, it must be picklable.
+
+            Returns:
+            None
+            """
+        value = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._put_memory(key, value)
+            if self.db_path:
+                try:
+                    db = self._connection()
+                    db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                               (key, value, len(value), time.time()))
+                    db.commit()
+                    self._disk_writes += 1
+                    if self._disk_writes % DISK_TRIM_INTERVAL == 0:
+                        self._trim_disk(db)
+                except sqlite3.Error:
+                    traceback.print_exc()
+
+    def _trim_disk(self, db):
+        # remove the least recently used results until the disk tier fits in its size
+        size = db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if size <= self.max_disk_bytes:
+            return
+        removed = 0
+        keys = []
+        for key, value_size in db.execute("SELECT key, size FROM results ORDER BY accessed"):
+            if size - removed <= self.max_disk_bytes:
+                break
+            keys.append((key,))
+            removed += value_size
+        db.executemany("DELETE FROM results WHERE key = ?", keys)
+        db.commit()
+
+    def stats(self):
+        """
+            Returns the hit/miss counters and the sizes of the cache, of this process.
+
+            Returns:
+            dict: The counters and sizes.
+            """
+        with self._lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = lookups - self.counters["misses"]
+            return dict(self.counters,
+                        hit_ratio=hits / lookups if lookups else 0.0,
+                        memory_entries=len(self._entries),
+                        memory_bytes=self._size,
+                        max_bytes=self.max_bytes,
+                        disk=bool(self.db_path),
+                        version=self.version,
+                        pid=os.getpid())
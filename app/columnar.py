@@ -0,0 +1,177 @@
+"""
+A compact columnar format of the imputation results, for loaders of large batches that would otherwise parse the CSV
+results again.
+
+The genotype and haplotype CSV results (id,result,probability,rank, one row per candidate) are written as a numpy
+.npz archive of columns. The subject ids, genotypes and haplotypes, which repeat over the rows, are dictionary
+encoded: each is stored once in a dictionary array, and the rows hold their int32 indices. The probabilities are
+float64, so nothing is lost to the text formatting. The columns are deflated in the archive, unless the whole file is
+compressed with zstd.
+
+    genotypes:  ids, genotypes (dictionaries), subject, genotype, prob, rank (columns)
+    haplotypes: ids, haplotypes (dictionaries), subject, hap1, hap2, prob, rank (columns)
+
+Read them with load, and decode a column with its dictionary, e.g. results["genotypes"][results["genotype"]].
+
+The files of a results archive can also be compressed with zstd, which needs the optional zstandard package.
+"""
+import array
+import io
+import os
+
+import numpy as np
+
+FORMATS = ("csv", "npz")
+COMPRESSIONS = ("none", "zstd")
+ZSTD_EXTENSION = ".zst"
+ZSTD_LEVEL = 3
+
+
+def _columns(csv_path, split_pairs):
+    # the dictionaries and the index columns of a results CSV file
+    ids, values = {}, {}
+    subject, first, second, rank = array.array("i"), array.array("i"), array.array("i"), array.array("i")
+    prob = array.array("d")
+    with open(csv_path) as f:
+        for line in f:
+            subject_id, result, probability, result_rank = line.rstrip("\n").rsplit(",", 3)
+            subject.append(ids.setdefault(subject_id, len(ids)))
+            if split_pairs:
+                hap1, hap2 = result.split("+")
+                first.append(values.setdefault(hap1, len(values)))
+                second.append(values.setdefault(hap2, len(values)))
+            else:
+                first.append(values.setdefault(result, len(values)))
+            prob.append(float(probability))
+            rank.append(int(result_rank))
+    return (np.array(list(ids), dtype=str), np.array(list(values), dtype=str), np.frombuffer(subject, np.int32),
+            np.frombuffer(first, np.int32), np.frombuffer(second, np.int32), np.frombuffer(prob, np.float64),
+            np.frombuffer(rank, np.int32))
+
+
+def _save(npz_path, compressed, **columns):
+    with open(npz_path, "wb") as f:
+        (np.savez_compressed if compressed else np.savez)(f, **columns)
+
+
+def write_genotypes(csv_path, npz_path, compressed=True):
+    """
+        Writes genotype results (id,genotype,probability,rank) in the columnar format.
+
+        Parameters:
+        csv_path (str): The path to the genotypes CSV file.
+        npz_path (str): The path to write the columnar genotypes to.
+        compressed (bool): False to store the columns uncompressed, e.g. when the file is compressed later.
+
+        Returns:
+        int: The number of rows.
+        """
+    ids, genotypes, subject, genotype, _, prob, rank = _columns(csv_path, split_pairs=False)
+    _save(npz_path, compressed, ids=ids, genotypes=genotypes, subject=subject, genotype=genotype, prob=prob,
+          rank=rank)
+    return len(subject)
+
+
+def write_haplotypes(csv_path, npz_path, compressed=True):
+    """
+        Writes haplotype pair results (id,haplotype1+haplotype2,probability,rank) in the columnar format.
+
+        Parameters:
+        csv_path (str): The path to the haplotypes CSV file.
+        npz_path (str): The path to write the columnar haplotypes to.
+        compressed (bool): False to store the columns uncompressed, e.g. when the file is compressed later.
+
+        Returns:
+        int: The number of rows.
+        """
+    ids, haplotypes, subject, hap1, hap2, prob, rank = _columns(csv_path, split_pairs=True)
+    _save(npz_path, compressed, ids=ids, haplotypes=haplotypes, subject=subject, hap1=hap1, hap2=hap2, prob=prob,
+          rank=rank)
+    return len(subject)
+
+
+def to_columnar(genotype_path, haplotype_path, compressed=True):
+    """
+        Converts genotype and haplotype CSV results to the columnar format, next to them, and removes the CSV files.
+
+        Parameters:
+        genotype_path (str): The path to the genotypes CSV file.
+        haplotype_path (str): The path to the haplotypes CSV file.
+        compressed (bool): False to store the columns uncompressed, e.g. when the files are compressed later.
+
+        Returns:
+        tuple[str, str]: The paths to the columnar genotypes and haplotypes.
+        """
+    paths = []
+    for path, write in ((genotype_path, write_genotypes), (haplotype_path, write_haplotypes)):
+        npz_path = os.path.splitext(path)[0] + ".npz"
+        if os.path.exists(path):
+            write(path, npz_path, compressed)
+            os.remove(path)
+        else:
+            # grim writes no file when no subject was imputed
+            write(os.devnull, npz_path, compressed)
+        paths.append(npz_path)
+    return tuple(paths)
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd compression needs the zstandard package (pip install zstandard)")
+    return zstandard
+
+
+def check_format(output_format):
+    """Raises a ValueError if the given format of the results is unknown."""
+    if output_format not in FORMATS:
+        raise ValueError(f"Unknown output format {output_format}, the formats are {', '.join(FORMATS)}")
+
+
+def check_compression(compression):
+    """Raises a ValueError if the given compression of the results archive is unknown or unavailable."""
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}, the compressions are {', '.join(COMPRESSIONS)}")
+    if compression == "zstd":
+        _zstandard()
+
+
+def compress(path, compression):
+    """
+        Compresses a file of a results archive, and removes the uncompressed file.
+
+        Parameters:
+        path (str): The path to the file.
+        compression (str): One of COMPRESSIONS.
+
+        Returns:
+        str: The path to the compressed file, or path itself for no compression.
+        """
+    check_compression(compression)
+    if compression == "none":
+        return path
+    compressed_path = path + ZSTD_EXTENSION
+    with open(path, "rb") as f_in, open(compressed_path, "wb") as f_out:
+        _zstandard().ZstdCompressor(level=ZSTD_LEVEL).copy_stream(f_in, f_out)
+    os.remove(path)
+    return compressed_path
+
+
+def load(path):
+    """
+        Reads columnar results, zstd compressed or not.
+
+        Parameters:
+        path (str): The path to the .npz (or .npz.zst) file.
+
+        Returns:
+        dict: The dictionaries and columns, by name.
+        """
+    if path.endswith(ZSTD_EXTENSION):
+        with open(path, "rb") as f:
+            data = io.BytesIO(_zstandard().ZstdDecompressor().stream_reader(f).read())
+    else:
+        data = path
+    with np.load(data) as results:
+        return {name: results[name] for name in results.files}
@@ -0,0 +1,85 @@
+"""
+Shared fixtures of the tests.
+
+The tests build the example graph (conf/conf.json and data/freq_9loci) in temporary directories, and serve it with
+the app. Run from the app directory:
+    python3 -m pytest -q
+"""
+import json
+import os
+import shutil
+
+import pytest
+
+# (before grim is imported by a graph build, which puts its own imputation package first on sys.path)
+import imputation
+from build_freqs import build_frequencies
+from graph_build import build_graph
+from test_ard_table import TwoFieldARD
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+CONF_FILE = os.path.join(APP_DIR, "conf", "conf.json")
+
+
+@pytest.fixture(autouse=True)
+def app_dir(monkeypatch):
+    # the configuration has paths relative to the app directory
+    monkeypatch.chdir(APP_DIR)
+
+
+def example_conf(directory):
+    """Writes the example configuration with its frequencies, HPF file and graph files in the given directory."""
+    with open(CONF_FILE) as f:
+        conf = json.load(f)
+    freqs_dir = os.path.join(directory, "freqs")
+    shutil.copytree(os.path.join(APP_DIR, conf["freq_data_dir"]), freqs_dir)
+    conf.update(freq_data_dir=freqs_dir, freq_file=os.path.join(directory, "hpf.csv"),
+                pops_count_file=os.path.join(directory, "pop_ratio.txt"),
+                graph_files_path=os.path.join(directory, "csv") + "/")
+    conf_file = os.path.join(directory, "conf.json")
+    with open(conf_file, "w") as f:
+        json.dump(conf, f)
+    return conf_file, conf
+
+
+def build_example_graph(directory):
+    """Builds the example graph in the given directory, returns its configuration file, configuration and store."""
+    conf_file, conf = example_conf(directory)
+    store_dir = os.path.join(directory, "graph_store")
+    build_frequencies(conf_file, freqs_dir=None)
+    build_graph(conf_file, store_dir, pickle_path=None)
+    return conf_file, conf, store_dir
+
+
+@pytest.fixture(scope="session")
+def example_graph(tmp_path_factory):
+    """The example graph, shared by the tests that do not change it."""
+    return build_example_graph(str(tmp_path_factory.mktemp("graph")))
+
+
+@pytest.fixture(scope="session")
+def client(example_graph, tmp_path_factory):
+    """
+        A test client of the app, serving the example graph. py-ard is replaced by TwoFieldARD, the alleles of the
+        example graph have two fields already.
+        """
+    conf_file, conf, store_dir = example_graph
+    directory = str(tmp_path_factory.mktemp("app"))
+    app_conf_file = os.path.join(directory, "conf.json")
+    with open(app_conf_file, "w") as f:
+        json.dump(dict(conf, loci_graphs=[], jobs_dir=os.path.join(directory, "jobs"),
+                       profiling_dir=os.path.join(directory, "profiles")), f)
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(APP_DIR)
+        mp.setattr(imputation, "PATH_TO_CONFIG", app_conf_file)
+        mp.setattr(imputation, "PATH_TO_GRIM_GRAPH_STORE", store_dir)
+        mp.setattr(imputation, "ARTIFACT_PATHS", [app_conf_file, store_dir])
+        mp.setattr(imputation, "_ard", TwoFieldARD())
+        # the app warms up when it is imported, on the graph of data/, it is warmed up on the test graph instead
+        warm_up = imputation.warm_up
+        mp.setattr(imputation, "warm_up", lambda setup=None, background=False: None)
+        import app
+        startup = warm_up()
+        assert startup.ready.is_set(), startup.error
+        yield app.app.test_client()
@@ -0,0 +1,248 @@
+"""
+A compact memory-mappable store of the haplotype frequencies of the populations.
+
+The frequency dictionaries map each haplotype (its alleles sorted, joined by '~') to its frequency, one dictionary per
+population. As python dicts, every entry costs a string, a boxed float and a hash table slot, in every process that
+loads them. The store keeps every haplotype once, as its row in a sorted array of fixed width names (its id), and the
+frequencies as one float32 column per population, memory-mapped read-only so all the processes share them.
+
+A store is a directory with:
+    keys.npy    the haplotypes of all the populations, sorted, as fixed width bytes.
+    freqs.npy   the frequency of each haplotype in each population, NaN if it is not in the population.
+and a meta.json file with the populations.
+
+Convert the frequency dictionaries of the populations and report the memory used, from the app directory:
+    python3 freqs_store.py --config conf/conf.json --input all_freqs.pickle --output data/freqs_dicts
+"""
+import argparse
+import json
+import os
+import pickle
+import tracemalloc
+from collections.abc import Mapping
+
+import numpy as np
+
+STORE_FORMAT_VERSION = 1
+
+
+def haplotype_key(haplotype):
+    """Returns the key of a haplotype in the frequency dictionaries, its alleles sorted."""
+    return "~".join(sorted(haplotype.split("~")))
+
+
+def save_freqs(populations, get_freqs, store_dir, dtype=np.float32):
+    """
+        Saves the frequency dictionaries of the populations as a store.
+
+        Parameters:
+        populations (List[str]): The populations.
+        get_freqs (Callable[[str], dict]): Returns the frequency dictionary of a population. Called twice for each
+        population, so only one dictionary needs to be in memory at a time.
+        store_dir (str): The directory to write the store to.
+        dtype (numpy.dtype): The type of the frequencies.
+
+        Returns:
+        int: The number of haplotypes.
+        """
+    os.makedirs(store_dir, exist_ok=True)
+
+    keys = set()
+    for pop in populations:
+        keys.update(get_freqs(pop))
+    keys = np.array(sorted(key.encode("ascii") for key in keys), dtype=bytes)
+
+    freqs = np.full((len(keys), len(populations)), np.nan, dtype=dtype)
+    for column, pop in enumerate(populations):
+        pop_freqs = get_freqs(pop)
+        pop_keys = np.array([key.encode("ascii") for key in pop_freqs], dtype=bytes)
+        freqs[np.searchsorted(keys, pop_keys), column] = list(pop_freqs.values())
+
+    np.save(os.path.join(store_dir, "keys.npy"), keys)
+    np.save(os.path.join(store_dir, "freqs.npy"), freqs)
+    # meta.json is written last, a store without it is incomplete
+    with open(os.path.join(store_dir, "meta.json"), "w") as f:
+        json.dump({"format_version": STORE_FORMAT_VERSION, "populations": list(populations)}, f)
+    return len(keys)
+
+
+def store_exists(store_dir):
+    return os.path.isfile(os.path.join(store_dir, "meta.json"))
+
+
+class _PopulationFreqs(Mapping):
+    """A read-only view with the same items as the frequency dictionary of one population."""
+
+    def __init__(self, store, column):
+        self._store = store
+        self._column = column
+
+    def __getitem__(self, haplotype):
+        freq = self._store.frequency(haplotype, self._column)
+        if freq is None:
+            raise KeyError(haplotype)
+        return freq
+
+    def __contains__(self, haplotype):
+        return self._store.frequency(haplotype, self._column) is not None
+
+    def __iter__(self):
+        present = np.flatnonzero(~np.isnan(self._store.freqs[:, self._column]))
+        for key in self._store.keys[present]:
+            yield key.decode("ascii")
+
+    def __len__(self):
+        return int(np.count_nonzero(~np.isnan(self._store.freqs[:, self._column])))
+
+
+class FreqsStore(Mapping):
+    """
+        The frequency dictionaries of the populations, backed by a memory-mapped store.
+
+        store[pop] answers like the frequency dictionary of the population, and lookup answers a batch of
+        haplotypes at once.
+        """
+
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["format_version"] != STORE_FORMAT_VERSION:
+            raise Exception(f"Unsupported frequencies store version {meta['format_version']} in {store_dir}")
+        self.populations = meta["populations"]
+        self.columns = {pop: column for column, pop in enumerate(self.populations)}
+        self.keys = np.load(os.path.join(store_dir, "keys.npy"), mmap_mode="r")
+        self.freqs = np.load(os.path.join(store_dir, "freqs.npy"), mmap_mode="r")
+
+    def __getitem__(self, pop):
+        return _PopulationFreqs(self, self.columns[pop])
+
+    def __iter__(self):
+        return iter(self.populations)
+
+    def __len__(self):
+        return len(self.populations)
+
+    def ids(self, haplotypes):
+        """
+            Returns the ids of haplotypes.
+
+            Parameters:
+            haplotypes (List[str]): The haplotype keys, see haplotype_key.
+
+            Returns:
+            numpy.ndarray: The id of each haplotype, -1 if it is in none of the populations.
+            """
+        encoded = np.array([haplotype.encode("ascii", "replace") for haplotype in haplotypes], dtype=bytes)
+        positions = np.searchsorted(self.keys, encoded)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == encoded[found]
+        return np.where(found, positions, -1)
+
+    def frequency(self, haplotype, column):
+        haplotype_id = self.ids([haplotype])[0]
+        if haplotype_id < 0:
+            return None
+        freq = self.freqs[haplotype_id, column]
+        return None if np.isnan(freq) else float(freq)
+
+    def lookup(self, pop, haplotypes, default=0.0):
+        """
+            Returns the frequencies of haplotypes in a population, as store[pop].get(haplotype, default) does.
+
+            Parameters:
+            pop (str): The population.
+            haplotypes (List[str]): The haplotype keys, see haplotype_key.
+            default (float): The frequency of the haplotypes that are not in the population.
+
+            Returns:
+            numpy.ndarray: The frequencies.
+            """
+        haplotype_ids = self.ids(haplotypes)
+        freqs = np.full(len(haplotype_ids), default, dtype=np.float64)
+        found = haplotype_ids >= 0
+        freqs[found] = self.freqs[haplotype_ids[found], self.columns[pop]]
+        freqs[np.isnan(freqs)] = default
+        return freqs
+
+
+def load_freqs(store_dir):
+    """
+        Loads a frequencies store, memory-mapped read-only.
+
+        Parameters:
+        store_dir (str): The directory of the store.
+
+        Returns:
+        FreqsStore: The frequency dictionaries of the populations.
+        """
+    return FreqsStore(store_dir)
+
+
+def memory_report(load_all_freqs, store_dir):
+    """
+        Measures the memory of the frequency dictionaries and of the store, and checks they answer the same.
+
+        Parameters:
+        load_all_freqs (Callable[[], dict]): Loads the frequency dictionaries of the populations, by population.
+        store_dir (str): The store of the same dictionaries.
+
+        Returns:
+        dict: The bytes allocated by the dictionaries, the bytes of the store, and the largest relative difference
+        of a frequency.
+        """
+    tracemalloc.start()
+    all_freqs = load_all_freqs()
+    dicts_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    store = load_freqs(store_dir)
+    store_bytes = store.keys.nbytes + store.freqs.nbytes
+
+    max_error = 0.0
+    for pop, freqs in all_freqs.items():
+        if set(store[pop]) != set(freqs):
+            raise Exception(f"The haplotypes of {pop} in the store are not those of its dictionary")
+        expected = np.array(list(freqs.values()), dtype=np.float64)
+        found = store.lookup(pop, list(freqs))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            errors = np.where(expected != 0, np.abs(found - expected) / np.abs(expected), np.abs(found))
+        max_error = max(max_error, float(errors.max(initial=0.0)))
+    return {"dicts_bytes": dicts_bytes, "store_bytes": store_bytes, "max_relative_error": max_error}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert frequency dictionaries to a frequencies store.")
+    parser.add_argument("-c", "--config", default="conf/conf.json", help="Configuration JSON file, for the populations",
+                        type=str)
+    parser.add_argument("-i", "--input", required=True,
+                        help="The pickled dictionary of the frequency dictionaries of the populations (e.g. "
+                             "all_freqs.pickle), or a directory of pickled frequency dictionaries, <pop>.pickle",
+                        type=str)
+    parser.add_argument("-o", "--output", default="data/freqs_dicts", help="Output store directory", type=str)
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        pops = json.load(f)["populations"]
+
+    if os.path.isdir(args.input):
+        def load_pickle(pop):
+            with open(os.path.join(args.input, f"{pop}.pickle"), "rb") as f:
+                return pickle.load(f)
+
+        def load_all_freqs():
+            return {pop: load_pickle(pop) for pop in pops}
+    else:
+        def load_all_freqs():
+            with open(args.input, "rb") as f:
+                return pickle.load(f)
+
+        all_freqs = load_all_freqs()
+        load_pickle = all_freqs.__getitem__
+
+    print(f"Saved {save_freqs(pops, load_pickle, args.output)} haplotypes to {args.output}")
+    load_pickle = all_freqs = None
+    report = memory_report(load_all_freqs, args.output)
+    print(f"Dictionaries: {report['dicts_bytes'] / 2 ** 20:.1f} MB per process, "
+          f"store: {report['store_bytes'] / 2 ** 20:.1f} MB shared by all the processes "
+          f"({report['dicts_bytes'] / max(report['store_bytes'], 1):.1f}x smaller), "
+          f"largest relative difference of a frequency: {report['max_relative_error']:.2e}")
@@ -0,0 +1,395 @@
+"""
+Builds the grim graph, and updates it incrementally when only the frequency files of some populations change.
+
+A full build runs the whole chain: the HPF file, grim's nodes/edges csv files, the graph instance, the pickle and the
+graph store. It takes hours for 9 loci, mostly in grim. A build manifest is saved in the graph store, with a digest
+of each population's frequency file and of the configuration the graph depends on.
+
+The nodes and edges of the graph only depend on the ordered list of the full-locus haplotypes that pass the trim
+threshold in some population, not on their frequencies. So when some frequency files change and that list stays
+the same, the update only recomputes the frequency columns of the changed populations: the full-locus haplotype
+frequencies, and the sums of them for every sub-haplotype node, added in the same order as grim adds them, so the
+result is the same as a full rebuild to the bit. Otherwise (new or removed haplotypes, or a configuration change) it
+falls back to a full build. A full rebuild to a temporary directory can be compared with the update (--verify).
+
+Run from the app directory:
+    python3 graph_build.py --config conf/conf.json [--full] [--verify]
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import pickle
+import sys
+import tempfile
+
+import numpy as np
+
+from build_freqs import build_frequencies
+from graph_store import save_graph, store_exists, PREFIXES, _Nodes
+
+MANIFEST_FILE = "build_manifest.json"
+# the configuration the nodes, edges and frequencies of the graph depend on
+GRAPH_CONF_KEYS = ("populations", "loci_map", "Plan_A_Matrix", "Plan_B_Matrix", "freq_trim_threshold")
+# changes of the way the graph is built from grim's csv files, the stores of older builds are built again
+GRAPH_BUILD_VERSION = 2
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_manifest(conf):
+    """
+        Returns the build manifest of a configuration: the digests of the frequency files and of the configuration.
+
+        Parameters:
+        conf (dict): The configuration.
+
+        Returns:
+        dict: The manifest.
+        """
+    graph_conf = {key: conf.get(key) for key in GRAPH_CONF_KEYS}
+    graph_conf = json.dumps(dict(graph_conf, build_version=GRAPH_BUILD_VERSION), sort_keys=True)
+    return {
+        "config": hashlib.sha256(graph_conf.encode()).hexdigest(),
+        "freq_files": {pop: file_digest(os.path.join(conf.get("freq_data_dir"), f"{pop}.freqs.gz"))
+                       for pop in conf.get("populations")},
+    }
+
+
+def read_manifest(store_dir):
+    try:
+        with open(os.path.join(store_dir, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(store_dir, manifest):
+    tmp_path = os.path.join(store_dir, MANIFEST_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(store_dir, MANIFEST_FILE))
+
+
+def changed_populations(conf, store_dir):
+    """
+        Returns the populations whose frequency file changed since the graph store was built.
+
+        Parameters:
+        conf (dict): The configuration.
+        store_dir (str): The graph store.
+
+        Returns:
+        List[str]: The changed populations, or None if the graph has to be built from scratch (no store, no
+        manifest, or a change to the configuration of the graph).
+        """
+    manifest = read_manifest(store_dir) if store_exists(store_dir) else None
+    new_manifest = build_manifest(conf)
+    if manifest is None or manifest["config"] != new_manifest["config"]:
+        return None
+    return [pop for pop, digest in new_manifest["freq_files"].items() if manifest["freq_files"].get(pop) != digest]
+
+
+def complete_plan_b_nodes(config):
+    """
+        Lists every label of grim's nodes csv file in its nodes_for_plan_b.txt file.
+
+        grim's Graph numbers the whole graph vertices by the rows of the nodes file whose label is in that list, but
+        its whole graph edges keep the row ids of the file. The list grim generates leaves out the full haplotype and
+        the Plan A only labels, so every row after them pointed to another vertex. With all the labels listed, the
+        vertex of each row is its id.
+
+        Parameters:
+        config (dict): The configuration, as returned by generate_config_dict.generate_dict_config.
+
+        Returns:
+        None
+        """
+    if not config["nodes_for_plan_A"]:
+        # without the lists, grim puts every row in the whole graph
+        return
+    with open(config["node_file"]) as f:
+        rows = csv.reader(f)
+        next(rows)
+        labels = list(dict.fromkeys(row[2] for row in rows if row))
+    with open(os.path.join(os.path.dirname(config["node_file"]), "nodes_for_plan_b.txt"), "w") as f:
+        f.writelines(f"{label}\n" for label in labels)
+
+
+def build_graph(config_file, store_dir="data/graph_store", pickle_path="data/graph.pkl"):
+    """
+        Builds the graph from the HPF file: grim's nodes/edges csv files, the graph instance, its pickle and its graph
+        store, with the build manifest.
+
+        Parameters:
+        config_file (str): The configuration JSON file.
+        store_dir (str): The graph store directory.
+        pickle_path (str): The pickled graph file, or None to not pickle it.
+
+        Returns:
+        Graph: The graph.
+        """
+    from generate_config_dict import generate_dict_config
+    from grim import grim
+
+    with open(config_file) as f:
+        conf = json.load(f)
+
+    # grim parses the command line for its own --config, so it gets none of ours
+    argv, sys.argv = sys.argv, sys.argv[:1]
+    try:
+        grim.graph_freqs(config_file)
+    finally:
+        sys.argv = argv
+    config = generate_dict_config(config_file)
+    complete_plan_b_nodes(config)
+    graph = grim.graph_instance(config)
+
+    if pickle_path:
+        if os.path.dirname(pickle_path):
+            os.makedirs(os.path.dirname(pickle_path), exist_ok=True)
+        with open(pickle_path, "wb") as pickle_file:
+            pickle.dump(graph, pickle_file)
+    save_graph(graph, store_dir)
+    write_manifest(store_dir, build_manifest(conf))
+    return graph
+
+
+def read_full_haplotypes(conf):
+    """
+        Reads the full-locus haplotypes of the graph from the HPF file, the same way grim's graph generation does.
+
+        Parameters:
+        conf (dict): The configuration, with freq_file, pops_count_file, loci_map and freq_trim_threshold.
+
+        Returns:
+        tuple[List[str], numpy.ndarray]: The haplotypes, in the order of their node ids, and their frequencies, one
+        column per population.
+        """
+    from graph_generation.generate_neo4j_multi_hpf import loci_order, make_allele_list
+
+    pops = conf.get("populations")
+    freq_trim = conf.get("freq_trim_threshold")
+    trim = {pop: freq_trim for pop in pops}
+    pop_ratio_path = conf.get("pops_count_file", "")
+    if pop_ratio_path and os.path.isfile(pop_ratio_path):
+        with open(pop_ratio_path) as f_count:
+            for line in f_count:
+                pop, count_pop, _ = line.strip().split(",")
+                trim[pop] = freq_trim / float(count_pop)
+
+    full_loci, full_name_index_dict = loci_order(conf.get("loci_map"))
+    columns = {pop: i for i, pop in enumerate(pops)}
+    haplotypes = {}
+    with open(conf.get("freq_file")) as f:
+        for hap_line in f:
+            haplotype, pop, freq = hap_line.split(",")
+            if haplotype == "hap":
+                continue
+            freq = float(freq)
+            if freq == 0.0 or freq < trim[pop]:
+                continue
+            haplotype = "~".join(make_allele_list(haplotype, full_name_index_dict, len(full_loci)))
+            haplotypes.setdefault(haplotype, {})[pop] = freq
+
+    freqs = np.zeros((len(haplotypes), len(pops)), dtype=np.float64)
+    for row, pop_freqs in enumerate(haplotypes.values()):
+        for pop, freq in pop_freqs.items():
+            freqs[row, columns[pop]] = freq
+    return list(haplotypes), freqs
+
+
+def _patch_freqs(graph, haplotypes, freqs, columns):
+    """Returns the frequencies of the nodes of both graphs of the store, with the given columns recomputed."""
+    alleles = np.array([haplotype.split("~") for haplotype in haplotypes], dtype=object)
+    full_loci = graph.full_loci
+
+    patched = {}
+    for prefix, nodes in (("vertices", graph._vertices), ("whole_vertices", graph._whole)):
+        node_freqs = np.array(nodes.freqs)
+        for code, label in enumerate(graph.labels):
+            node_ids = np.flatnonzero(nodes.labels == code)
+            if not len(node_ids):
+                continue
+            if label == full_loci:
+                # the full-locus nodes are the haplotypes themselves
+                sub_names = haplotypes
+                inverse = np.arange(len(haplotypes))
+            else:
+                loci = [full_loci.index(locus) for locus in label]
+                joined = ["~".join(row) for row in alleles[:, loci].tolist()]
+                sub_names, inverse = np.unique(joined, return_inverse=True)
+                sub_names = sub_names.tolist()
+            # sum the haplotypes into their sub-haplotypes one by one, in the order of the haplotypes, like grim
+            sums = np.zeros((len(sub_names), len(columns)), dtype=np.float64)
+            np.add.at(sums, inverse.ravel(), freqs[:, columns])
+            rows = {name: row for row, name in enumerate(sub_names)}
+            for node_id, name in zip(node_ids, nodes.node_names(node_ids)):
+                node_freqs[node_id, columns] = sums[rows[name]] if name in rows else 0
+        patched[prefix] = node_freqs
+    return patched
+
+
+def update_graph(config_file, store_dir="data/graph_store", pickle_path="data/graph.pkl", freqs_dir="data/freqs_dicts",
+                 full=False):
+    """
+        Brings the graph up to date with the frequency files, patching it when possible (see the module docstring).
+
+        Parameters:
+        config_file (str): The configuration JSON file.
+        store_dir (str): The graph store directory.
+        pickle_path (str): The pickled graph file, patched too if it exists, or None.
+        freqs_dir (str): The frequency dictionaries directory, see build_freqs.build_frequencies.
+        full (bool): Build the graph from scratch.
+
+        Returns:
+        str: 'unchanged', 'patched' or 'rebuilt'.
+        """
+    from graph_store import load_graph
+
+    with open(config_file) as f:
+        conf = json.load(f)
+
+    changed = None if full else changed_populations(conf, store_dir)
+    if changed == []:
+        print("The frequency files did not change")
+        return "unchanged"
+
+    build_frequencies(config_file, freqs_dir=freqs_dir)
+    if changed is None:
+        print("Building the graph from scratch")
+        build_graph(config_file, store_dir, pickle_path)
+        return "rebuilt"
+
+    print(f"The frequency files of {changed} changed")
+    haplotypes, freqs = read_full_haplotypes(conf)
+    graph = load_graph(store_dir)
+    full_code = graph.labels.index(graph.full_loci)
+    full_ids = np.flatnonzero(graph._vertices.labels == full_code)
+    if graph._vertices.node_names(full_ids) != haplotypes:
+        print("The haplotypes of the graph changed, building the graph from scratch")
+        build_graph(config_file, store_dir, pickle_path)
+        return "rebuilt"
+
+    pops = conf.get("populations")
+    patched = _patch_freqs(graph, haplotypes, freqs, [pops.index(pop) for pop in changed])
+    del graph
+
+    # each file is replaced atomically, the workers that mapped the old ones keep reading them until they reload
+    for prefix in PREFIXES:
+        tmp_path = os.path.join(store_dir, f"{prefix}_freqs.tmp.npy")
+        np.save(tmp_path, patched[prefix])
+        os.replace(tmp_path, os.path.join(store_dir, f"{prefix}_freqs.npy"))
+
+    if pickle_path and os.path.isfile(pickle_path):
+        with open(pickle_path, "rb") as f:
+            pickled = pickle.load(f)
+        for prefix, attributes in (("vertices", pickled.Vertices_attributes),
+                                   ("whole_vertices", pickled.Whole_Vertices_attributes)):
+            for name, attribute in attributes.items():
+                if isinstance(attribute, tuple):
+                    label, _, node_id = attribute
+                    attributes[name] = (label, patched[prefix][node_id].tolist(), node_id)
+        tmp_path = pickle_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(pickled, f)
+        os.replace(tmp_path, pickle_path)
+
+    write_manifest(store_dir, build_manifest(conf))
+    print(f"Patched the frequencies of {changed} in {store_dir}")
+    return "patched"
+
+
+def _nodes_by_name(store_dir, prefix):
+    """Returns the node names of one of the graphs of a store, and their labels and frequencies in name order."""
+    with open(os.path.join(store_dir, "meta.json")) as f:
+        labels = np.array(json.load(f)["labels"] + [""], dtype=object)
+    nodes = _Nodes(store_dir, prefix)
+    order = np.asarray(nodes.sorted_to_id)
+    return nodes, {
+        "names": np.asarray(nodes.names),
+        "labels": labels[np.asarray(nodes.labels)[order]],
+        "freqs": np.asarray(nodes.freqs)[order],
+    }
+
+
+def _adjacency_by_name(nodes):
+    # the neighbors of each node as the graph store answers them, by name. grim numbers the nodes of the labels that
+    # are only in plan B in the order of a set, which may differ from build to build, so the ids are not compared
+    names = nodes.node_names(np.arange(len(nodes)))
+    starts = np.asarray(nodes.neighbors_start, dtype=np.int64)
+    edges = np.asarray(nodes.edges)
+    return {name: frozenset(nodes.node_names(edges[starts[node_id]:max(starts[node_id], starts[node_id + 1])]))
+            for node_id, name in enumerate(names)}
+
+
+def compare_stores(store_a, store_b):
+    """
+        Compares the nodes, their labels and frequencies by node name, and the edges, of two graph stores.
+
+        Parameters:
+        store_a (str): A graph store.
+        store_b (str): Another graph store.
+
+        Returns:
+        List[str]: What differs, e.g. 'vertices freqs', empty if the graphs are the same.
+        """
+    differences = []
+    for prefix in PREFIXES:
+        (nodes_a, by_name_a), (nodes_b, by_name_b) = _nodes_by_name(store_a, prefix), _nodes_by_name(store_b, prefix)
+        for name in ("names", "labels", "freqs"):
+            if not np.array_equal(by_name_a[name], by_name_b[name]):
+                differences.append(f"{prefix} {name}")
+                if name == "names":
+                    break
+        else:
+            if _adjacency_by_name(nodes_a) != _adjacency_by_name(nodes_b):
+                differences.append(f"{prefix} edges")
+    return differences
+
+
+def verify_graph(config_file, store_dir="data/graph_store"):
+    """
+        Builds the graph from scratch in a temporary directory and compares it with the graph store.
+
+        Parameters:
+        config_file (str): The configuration JSON file.
+        store_dir (str): The graph store directory.
+
+        Returns:
+        List[str]: What differs, empty if the graph store is the same as a full rebuild.
+        """
+    with open(config_file) as f:
+        conf = json.load(f)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # build from the same HPF file, to grim csv files and a store of the temporary directory
+        tmp_conf = dict(conf, graph_files_path=os.path.join(tmp_dir, "csv/"))
+        tmp_config_file = os.path.join(tmp_dir, "conf.json")
+        with open(tmp_config_file, "w") as f:
+            json.dump(tmp_conf, f)
+        build_graph(tmp_config_file, os.path.join(tmp_dir, "graph_store"), pickle_path=None)
+        return compare_stores(os.path.join(tmp_dir, "graph_store"), store_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the graph, or update it for the changed frequency files.")
+    parser.add_argument("-c", "--config", default="conf/conf.json", help="Configuration JSON file", type=str)
+    parser.add_argument("-s", "--store", default="data/graph_store", help="Graph store directory", type=str)
+    parser.add_argument("-p", "--pickle", default="data/graph.pkl", help="Pickled graph file", type=str)
+    parser.add_argument("--full", action="store_true", help="Build the graph from scratch")
+    parser.add_argument("--verify", action="store_true", help="Compare the graph with a full rebuild")
+    args = parser.parse_args()
+
+    print(update_graph(args.config, args.store, args.pickle, full=args.full))
+    if args.verify:
+        differences = verify_graph(args.config, args.store)
+        if differences:
+            sys.exit(f"The graph differs from a full rebuild in {differences}")
+        print("The graph is the same as a full rebuild")
@@ -0,0 +1,319 @@
+"""
+A memory-mappable on-disk format for the grim graph.
+
+The pickled grim graph keeps every haplotype as a python string and its frequencies as python lists, so each
+worker process that unpickles it holds its own private copy. The graph store saves the same graph as flat numpy
+arrays that are memory-mapped read-only: all the workers share one page-cache copy, and loading is immediate.
+
+A store is a directory with, for the plan A graph ("vertices") and the whole graph ("whole_vertices"):
+    <prefix>_names.npy            the node names, sorted, as fixed width bytes.
+    <prefix>_sorted_to_id.npy     the node id of each sorted name.
+    <prefix>_id_to_sorted.npy     the position of each node id in the sorted names.
+    <prefix>_labels.npy           the index of the node label in meta.json labels, -1 for connectors.
+    <prefix>_freqs.npy            the node frequencies, one column per population.
+    <prefix>_edges.npy            the adjacency, grouped by source node.
+    <prefix>_neighbors_start.npy  the first edge of each node.
+and a meta.json file with the labels, the full loci and the plan A/B node lists.
+"""
+import argparse
+import json
+import os
+import pickle
+from collections.abc import Mapping
+
+import numpy as np
+
+STORE_FORMAT_VERSION = 1
+PREFIXES = ("vertices", "whole_vertices")
+
+
+def _graph_arrays(names, attributes, labels_index, n_pops):
+    """
+        Converts the names and attributes of one of the grim graphs to flat arrays.
+
+        Parameters:
+        names (Iterable[str]): The node names by node id.
+        attributes (dict): The node attributes, (label, freqs, id) or the id of a connector.
+        labels_index (dict): Maps a label to its index, new labels are added to it.
+        n_pops (int): The number of populations.
+
+        Returns:
+        dict: The arrays, by their name in the store.
+        """
+    names = [str(name) for name in names]
+    labels = np.full(len(names), -1, dtype=np.int16)
+    freqs = np.zeros((len(names), n_pops), dtype=np.float64)
+    for node_id, name in enumerate(names):
+        attribute = attributes[name]
+        if isinstance(attribute, tuple):
+            label, freq, _ = attribute
+            if label not in labels_index:
+                labels_index[label] = len(labels_index)
+            labels[node_id] = labels_index[label]
+            freqs[node_id] = freq
+
+    encoded = np.array([name.encode("ascii") for name in names], dtype=bytes)
+    sorted_to_id = np.argsort(encoded, kind="stable").astype(np.uint32)
+    id_to_sorted = np.empty_like(sorted_to_id)
+    id_to_sorted[sorted_to_id] = np.arange(len(names), dtype=np.uint32)
+    return {
+        "names": encoded[sorted_to_id],
+        "sorted_to_id": sorted_to_id,
+        "id_to_sorted": id_to_sorted,
+        "labels": labels,
+        "freqs": freqs,
+    }
+
+
+def save_graph(graph, store_dir):
+    """
+        Saves a grim graph (as returned by grim.graph_instance, or unpickled from data/graph.pkl) as a graph store.
+
+        Parameters:
+        graph (Graph): The grim graph.
+        store_dir (str): The directory to write the store to.
+
+        Returns:
+        None
+        """
+    os.makedirs(store_dir, exist_ok=True)
+
+    first_node = next(iter(graph.Vertices_attributes.values()))
+    n_pops = len(first_node[1])
+    labels_index = {}
+    graphs = {
+        "vertices": (graph.Vertices, graph.Vertices_attributes, graph.Edges, graph.Neighbors_start),
+        "whole_vertices": (graph.Whole_Vertices, graph.Whole_Vertices_attributes, graph.Whole_Edges,
+                           graph.Whole_Neighbors_start),
+    }
+    for prefix, (names, attributes, edges, neighbors_start) in graphs.items():
+        arrays = _graph_arrays(names, attributes, labels_index, n_pops)
+        arrays["edges"] = np.asarray(edges, dtype=np.uint32)
+        arrays["neighbors_start"] = np.asarray(neighbors_start, dtype=np.uint32)
+        for name, array in arrays.items():
+            np.save(os.path.join(store_dir, f"{prefix}_{name}.npy"), array)
+
+    meta = {
+        "format_version": STORE_FORMAT_VERSION,
+        "full_loci": graph.full_loci,
+        "n_pops": n_pops,
+        "labels": sorted(labels_index, key=labels_index.get),
+        "nodes_plan_a": graph.nodes_plan_a,
+        "nodes_plan_b": graph.nodes_plan_b,
+    }
+    # meta.json is written last, a store without it is incomplete
+    with open(os.path.join(store_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def convert_pickle(pickle_path, store_dir):
+    """
+        Converts a pickled grim graph to a graph store.
+
+        Parameters:
+        pickle_path (str): The path to the pickled graph.
+        store_dir (str): The directory to write the store to.
+
+        Returns:
+        None
+        """
+    with open(pickle_path, "rb") as f:
+        graph = pickle.load(f)
+    save_graph(graph, store_dir)
+
+
+def store_exists(store_dir):
+    return os.path.isfile(os.path.join(store_dir, "meta.json"))
+
+
+class _Nodes:
+    """The memory-mapped arrays of one of the graphs, with lookups by node name."""
+
+    def __init__(self, store_dir, prefix):
+        for name in ("names", "sorted_to_id", "id_to_sorted", "labels", "freqs", "edges", "neighbors_start"):
+            setattr(self, name, np.load(os.path.join(store_dir, f"{prefix}_{name}.npy"), mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def find(self, name):
+        """Returns the id of the node with the given name, or None."""
+        key = name.encode("ascii", "replace")
+        pos = int(np.searchsorted(self.names, key))
+        if pos < len(self.names) and self.names[pos] == key:
+            return int(self.sorted_to_id[pos])
+        return None
+
+    def name(self, node_id):
+        return self.names[self.id_to_sorted[node_id]].decode("ascii")
+
+    def node_names(self, node_ids):
+        return [name.decode("ascii") for name in self.names[self.id_to_sorted[node_ids]]]
+
+    def neighbors(self, node_id):
+        return self.edges[self.neighbors_start[node_id]:self.neighbors_start[node_id + 1]]
+
+
+class _Attributes(Mapping):
+    """A read-only view with the same items as the Vertices_attributes dicts of the grim graph."""
+
+    def __init__(self, nodes, labels):
+        self._nodes = nodes
+        self._labels = labels
+
+    def _attribute(self, node_id):
+        label = int(self._nodes.labels[node_id])
+        if label < 0:
+            return node_id
+        return self._labels[label], self._nodes.freqs[node_id].tolist(), node_id
+
+    def __getitem__(self, name):
+        node_id = self._nodes.find(name)
+        if node_id is None:
+            raise KeyError(name)
+        return self._attribute(node_id)
+
+    def __contains__(self, name):
+        return self._nodes.find(name) is not None
+
+    def __iter__(self):
+        for node_id in range(len(self._nodes)):
+            yield self._nodes.name(node_id)
+
+    def __len__(self):
+        return len(self._nodes)
+
+
+class MappedGraph(object):
+    """
+        A grim graph backed by a memory-mapped graph store.
+
+        It answers the same queries as grim.imputation.networkx_graph.Graph, so it can be passed to
+        grim.impute_instance in place of the unpickled graph.
+        """
+
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["format_version"] != STORE_FORMAT_VERSION:
+            raise Exception(f"Unsupported graph store version {meta['format_version']} in {store_dir}")
+
+        self.store_dir = store_dir
+        self.full_loci = meta["full_loci"]
+        self.nodes_plan_a = meta["nodes_plan_a"]
+        self.nodes_plan_b = meta["nodes_plan_b"]
+        self.labels = meta["labels"]
+        self._label_codes = {label: code for code, label in enumerate(self.labels)}
+        self.labelDict = {}
+
+        self._vertices = _Nodes(store_dir, "vertices")
+        self._whole = _Nodes(store_dir, "whole_vertices")
+        self.Vertices_attributes = _Attributes(self._vertices, self.labels)
+        self.Whole_Vertices_attributes = _Attributes(self._whole, self.labels)
+
+    def _freqs_by_name(self, nodes, node_ids):
+        freqs = nodes.freqs[node_ids].tolist()
+        return dict(zip(nodes.node_names(node_ids), freqs))
+
+    def _haps_with_label(self, nodes, label):
+        code = self._label_codes.get(label)
+        if code is None:
+            return []
+        return nodes.node_names(np.flatnonzero(nodes.labels == code))
+
+    def haps_by_label(self, label):
+        """Find haplotypes by their labels. Returns a list of haplotypes."""
+        if label in self.labelDict:
+            return self.labelDict[label]
+        hapsList = []
+        if not self.nodes_plan_a or label in self.nodes_plan_a:
+            hapsList = self._haps_with_label(self._vertices, label)
+        elif label in self.nodes_plan_b:
+            hapsList = self._haps_with_label(self._whole, label)
+        self.labelDict[label] = hapsList
+        return hapsList
+
+    def haps_with_probs_by_label(self, label):
+        """Find the haplotypes of a label, returns a dictionary of haplotype to frequency."""
+        dictAlleles = {}
+        listLabel = self.haps_by_label(label)
+        if not self.nodes_plan_a or label in self.nodes_plan_a:
+            for allele in listLabel:
+                dictAlleles[allele] = self.Vertices_attributes[allele][1]
+        elif label in self.nodes_plan_b:
+            for allele in listLabel:
+                dictAlleles[allele] = self.Whole_Vertices_attributes[allele][1]
+        return dictAlleles
+
+    def adjs_query(self, alleleList):
+        """Returns a dictionary of the full haplotypes adjacent to the given haplotypes to their frequencies."""
+        adjDict = dict()
+        full_loci_code = self._label_codes.get(self.full_loci)
+        for allele in alleleList:
+            allele_id = self._vertices.find(allele)
+            if allele_id is None:
+                continue
+            if self._vertices.labels[allele_id] == full_loci_code:
+                adjDict[allele] = self._vertices.freqs[allele_id].tolist()
+            else:
+                adjDict.update(self._freqs_by_name(self._vertices, self._vertices.neighbors(allele_id)))
+        return adjDict
+
+    def adjs_query_by_color(self, alleleList, labelA, labelB):
+        """Returns a dictionary of the labelB haplotypes adjacent to the given labelA haplotypes to their frequencies."""
+        adjDict = dict()
+        if labelA == labelB:
+            return self.node_probs(alleleList, labelA)
+
+        for allele in alleleList:
+            if allele in self.Whole_Vertices_attributes:
+                connector_id = self._whole.find(labelB + allele)
+                if connector_id is not None:
+                    adjDict.update(self._freqs_by_name(self._whole, self._whole.neighbors(connector_id)))
+        return adjDict
+
+    def node_probs(self, nodes, label):
+        """Get a list of haplotypes and a label, return a dictionary of nodes and their proper frequency."""
+        nodesDict = {}
+        if not self.nodes_plan_b or label in self.nodes_plan_b:
+            for node in nodes:
+                node_id = self._whole.find(node)
+                if node_id is not None:
+                    nodesDict[node] = self._whole.freqs[node_id].tolist()
+        elif label in self.nodes_plan_a:
+            for node in nodes:
+                if node in self.Whole_Vertices_attributes:
+                    nodesDict[node] = self.Vertices_attributes[node][1]
+        return nodesDict
+
+
+def load_graph(store_dir):
+    """
+        Loads a graph store, memory-mapped read-only.
+
+        Parameters:
+        store_dir (str): The directory of the store.
+
+        Returns:
+        MappedGraph: The graph.
+        """
+    return MappedGraph(store_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a grim graph to a memory-mapped graph store.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-p", "--pickle", help="Pickled graph file, e.g. data/graph.pkl", type=str)
+    source.add_argument("-c", "--config", help="Configuration JSON file, to build the graph from its nodes/edges csv files",
+                        type=str)
+    parser.add_argument("-o", "--output", default="data/graph_store", help="Output store directory", type=str)
+    args = parser.parse_args()
+
+    if args.pickle:
+        convert_pickle(args.pickle, args.output)
+    else:
+        from generate_config_dict import generate_dict_config
+        from grim import grim
+
+        save_graph(grim.graph_instance(generate_dict_config(args.config)), args.output)
+    print(f"Produced graph store: {args.output}")
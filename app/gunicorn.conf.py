@@ -0,0 +1,51 @@
+"""
+Production pre-fork server configuration.
+
+Run from the app directory:
+    gunicorn -c gunicorn.conf.py app:app
+
+The app is imported once in the master (preload_app), which loads py-ard, the graph and the frequencies. The
+master then freezes its heap and forks the workers, so the workers share those pages instead of copying them.
+Workers are recycled after max_requests by forking again from the master, without reloading anything.
+"""
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get("GRIMMARD_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("GRIMMARD_WORKERS", multiprocessing.cpu_count()))
+preload_app = True
+# each request imputes in a workspace of its own (see imputation.request_workspace), so a worker can serve requests
+# in threads, more than 1 runs the gthread worker
+threads = int(os.environ.get("GRIMMARD_THREADS", 1))
+# the imputation_processes of 0 (the cores) are shared by the workers: each worker imputes the chunks of the files in
+# a pool of its share of them (see runfile.ImputationEngine.pool)
+os.environ.setdefault("GRIMMARD_PROCESSES", str(max(1, multiprocessing.cpu_count() // workers)))
+# the master loads everything before forking, the workers are ready when they start
+os.environ.setdefault("GRIMMARD_BACKGROUND_WARM_UP", "0")
+
+# recycle workers, forked again from the already loaded master
+max_requests = int(os.environ.get("GRIMMARD_MAX_REQUESTS", 1000))
+max_requests_jitter = max_requests // 10
+
+# imputation of large files can take a long time
+timeout = int(os.environ.get("GRIMMARD_TIMEOUT", 600))
+
+
+def when_ready(server):
+    # Move everything loaded so far to the permanent generation, so the garbage collector of the workers never
+    # touches (and copies) those pages.
+    gc.collect()
+    gc.freeze()
+    server.log.info("Artifacts loaded, heap frozen. Forking workers.")
+
+
+def post_fork(server, worker):
+    from imputation import get_engine, get_job_queue, reopen_ard_connection
+
+    reopen_ard_connection()
+    # the pool of the worker is started now, so its processes are ready for the first file, and reused by all its
+    # requests
+    get_engine().pool()
+    # each worker runs the queued imputation jobs in a background thread
+    get_job_queue().start()
@@ -0,0 +1,115 @@
+"""
+An index of the haplotype frequencies of the graph, by population.
+
+The index holds the full-locus haplotypes of the graph as a matrix of allele codes, one column per locus, and their
+frequencies as a matrix with one column per population. The frequency of a haplotype of any subset of the loci is
+its marginal frequency, the sum over the full-locus haplotypes that contain it, the same way the graph generation
+computes the frequencies of its sub-haplotype nodes. The marginals of each loci subset are computed once.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+# the number of loci subsets whose marginal frequencies are kept
+MARGINALS_CACHE_SIZE = 64
+
+
+class HaplotypeFrequencyIndex:
+    """
+        Looks up the frequencies of haplotypes of any loci, for all the populations at once.
+
+        Parameters:
+        haplotypes (dict): The full-locus haplotypes, in the format 'A*01:01~B*08:01~...', to their frequency in each
+        population.
+        populations (List[str]): The populations, in the order of the frequencies.
+        """
+
+    def __init__(self, haplotypes, populations):
+        self.populations = list(populations)
+        self.columns = {pop: i for i, pop in enumerate(self.populations)}
+
+        names = list(haplotypes)
+        self._freqs = np.array([haplotypes[name] for name in names], dtype=np.float64).reshape(
+            len(names), len(self.populations))
+
+        # the allele of each locus of each haplotype, as codes, and the locus and code of each allele
+        alleles = [name.split("~") for name in names]
+        n_loci = len(alleles[0]) if alleles else 0
+        self._codes = np.empty((len(names), n_loci), dtype=np.int32)
+        self._alleles = {}
+        for locus in range(n_loci):
+            values, codes = np.unique([hap[locus] for hap in alleles], return_inverse=True)
+            self._codes[:, locus] = codes.ravel()
+            for code, allele in enumerate(values.tolist()):
+                self._alleles[allele] = (locus, code)
+
+        self._marginals = OrderedDict()
+
+    @classmethod
+    def from_graph(cls, graph, populations):
+        """
+            Builds the index from the full-locus haplotypes of a grim graph (pickled or a graph store).
+
+            Parameters:
+            graph (Graph): The grim graph.
+            populations (List[str]): The populations of the graph.
+
+            Returns:
+            HaplotypeFrequencyIndex: The index.
+            """
+        return cls(graph.haps_with_probs_by_label(graph.full_loci), populations)
+
+    def alleles(self):
+        """Returns the alleles of the haplotypes."""
+        return self._alleles.keys()
+
+    def _marginal(self, loci):
+        # the distinct haplotypes of the given loci, and their summed frequencies
+        marginal = self._marginals.get(loci)
+        if marginal is None:
+            keys, inverse = np.unique(self._codes[:, list(loci)], axis=0, return_inverse=True)
+            freqs = np.zeros((len(keys), len(self.populations)), dtype=np.float64)
+            np.add.at(freqs, inverse.ravel(), self._freqs)
+            rows = {tuple(key): row for row, key in enumerate(keys.tolist())}
+            marginal = (rows, freqs)
+            self._marginals[loci] = marginal
+            if len(self._marginals) > MARGINALS_CACHE_SIZE:
+                self._marginals.popitem(last=False)
+        else:
+            self._marginals.move_to_end(loci)
+        return marginal
+
+    def frequencies(self, haplotypes):
+        """
+            Returns the frequencies of the given haplotypes in all the populations.
+
+            Parameters:
+            haplotypes (List[str]): Haplotypes of any loci, in the format 'A*01:01~B*08:01'.
+
+            Returns:
+            tuple[numpy.ndarray, numpy.ndarray]: The frequencies, one row per haplotype and one column per population
+            (see columns), and whether each haplotype was found.
+            """
+        freqs = np.zeros((len(haplotypes), len(self.populations)), dtype=np.float64)
+        found = np.zeros(len(haplotypes), dtype=bool)
+
+        # group the haplotypes by their loci, and look up each group in the marginals of its loci
+        by_loci = {}
+        for i, haplotype in enumerate(haplotypes):
+            alleles = haplotype.split("~")
+            if not all(allele in self._alleles for allele in alleles):
+                continue
+            coded = sorted(self._alleles[allele] for allele in alleles)
+            loci = tuple(locus for locus, _ in coded)
+            if len(set(loci)) != len(loci):
+                continue
+            by_loci.setdefault(loci, []).append((i, tuple(code for _, code in coded)))
+
+        for loci, group in by_loci.items():
+            rows, marginal_freqs = self._marginal(loci)
+            indices = [(i, rows[key]) for i, key in group if key in rows]
+            if indices:
+                positions, marginal_rows = zip(*indices)
+                freqs[list(positions)] = marginal_freqs[list(marginal_rows)]
+                found[list(positions)] = True
+        return freqs, found
@@ -1,12 +1,28 @@
+import contextlib
+import functools
+import glob
+import io
 import os
-import random
 import pickle
+import shutil
+import sqlite3
+import tempfile
+import threading
 import pyard
-import json
-from runfile import run_impute
-from reduce_loci import reduce_loci
-from grim.RunGrim import change_donor_file
-from grim.filter_by_rest import change_output_by_extra_gl
+import columnar
+import loci_graphs
+from runfile import ImputationEngine, side_outputs
+from artifacts import Artifacts, ArtifactManager
+from startup import WarmUp
+from jobs import JobQueue, INPUT_FILE
+from cache import ResultCache, artifacts_version
+from ard_table import ReductionTable
+from hap_index import HaplotypeFrequencyIndex
+from graph_store import load_graph, store_exists
+from reduce_loci import reduce_muug_rows, reduce_haps_rows, NUM_RES
+from grim.filter_top_3 import extract_locuses, split_gl
+from grim.filter_by_rest import filter_results
+from metrics import stage_timer, SUBJECTS, CANDIDATE_GENOTYPES, LOCI_GRAPHS
 
 # define the input and output directories as constants
 INPUT_DIR = "./input_dir"
@@ -18,36 +34,175 @@ PATH_TO_CONFIG = "./conf/conf.json"
 print(f"Using configuration file: {PATH_TO_CONFIG}")
 
 PATH_TO_GRIM_GRAPH = "./data/graph.pkl"
-print(f"Using graph file: {PATH_TO_GRIM_GRAPH}")
+# the memory-mapped graph store is used instead of the pickle when it exists (see graph_store.py)
+PATH_TO_GRIM_GRAPH_STORE = "./data/graph_store"
+print(f"Using graph file: {PATH_TO_GRIM_GRAPH_STORE if store_exists(PATH_TO_GRIM_GRAPH_STORE) else PATH_TO_GRIM_GRAPH}")
 
 # create the input and output directories if they don't already exist
 os.makedirs(INPUT_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# define lambdas to convert file numbers to their corresponding input/haplotype/genotype filenames
-TO_INPUT_FILE = lambda num: f"input{num}.csv"
-TO_HAPLOTYPE_FILE = lambda num: f"haplotype{num}.csv"
-TO_GENOTYPE_FILE = lambda num: f"genotype{num}.csv"
+# the names of the result files of an uploaded file or a job, inside its own workspace or job directory
+GENOTYPE_FILE = "genotype.csv"
+HAPLOTYPE_FILE = "haplotype.csv"
+ERRORS_FILE = "errors.csv"
 
-all_freqs = None
-def get_all_freqs():
-    global all_freqs
-    if all_freqs is None:
-        with open(f"./data/freqs_dicts/all_freqs.pickle", "rb") as f:
-            all_freqs = pickle.load(f)
-    return all_freqs
+# the number of distinct GL strings of an uploaded file that are remembered, so duplicates are reduced once
+ARD_DEDUP_SIZE = 100000
+
+# the files of a version of the artifacts, a change to any of them is a new version (the frequencies store of
+# data/freqs_dicts is an offline artifact, the app does not read it)
+ARTIFACT_PATHS = [PATH_TO_CONFIG, PATH_TO_GRIM_GRAPH_STORE, PATH_TO_GRIM_GRAPH, "./data/pop_ratio.txt"]
+
+def load_grim_graph():
+    if store_exists(PATH_TO_GRIM_GRAPH_STORE):
+        # memory-map the graph store, shared by all the worker processes
+        return load_graph(PATH_TO_GRIM_GRAPH_STORE)
+    # open the grim graph pickle file and load its contents
+    with open(PATH_TO_GRIM_GRAPH, "rb") as f:
+        return pickle.load(f)
+
+def load_artifacts(version):
+    """
+        Loads the configuration, the graph and everything built from them, and checks they fit together.
+
+        Parameters:
+        version (str): The version of the files, see cache.artifacts_version.
+
+        Raises:
+        ValueError: If the graph does not match the configuration.
+
+        Returns:
+        Artifacts: The loaded artifacts.
+        """
+    graph = load_grim_graph()
+    # the configuration is parsed once per version
+    engine = ImputationEngine(PATH_TO_CONFIG, graph)
+    if list(graph.full_loci) != list(engine.config["full_loci"]):
+        raise ValueError(f"The loci of the graph {graph.full_loci} are not the configured loci "
+                         f"{engine.config['full_loci']}")
+    try:
+        # the frequencies of the haplotypes of any loci by population, from the full-locus haplotypes of the graph
+        index = HaplotypeFrequencyIndex.from_graph(graph, engine.config["pops"])
+    except ValueError:
+        raise ValueError(f"The frequencies of the graph are not of the configured populations "
+                         f"{engine.config['pops']}")
+
+    json_conf = engine.json_conf
+    # the results depend on the configuration, the graph and the frequencies they were imputed with
+    cache = ResultCache(version, max_bytes=json_conf.get("result_cache_max_mb", 64) << 20,
+                        db_path=json_conf.get("result_cache_db") or None,
+                        max_disk_bytes=json_conf.get("result_cache_disk_max_mb", 1024) << 20)
+
+    # the lgx reductions of the alleles of the frequency graph, and a memo of any other allele
+    table = ReductionTable(get_ard(), 'lgx')
+    print(f"Reduced {table.build(index.alleles())} alleles of the frequency graph")
+
+    # the graphs of the configured loci subsets that were built, see loci_graphs.py
+    subset_graphs = loci_graphs.load_loci_graphs(json_conf)
+    print(f"Loaded the loci graphs {[loci_graph.name for loci_graph in subset_graphs]}")
+
+    return Artifacts(version, graph=graph, engine=engine, hap_index=index, result_cache=cache, ard_table=table,
+                     loci_graphs=subset_graphs)
+
+artifact_manager = ArtifactManager(load_artifacts,
+                                   lambda: artifacts_version(ARTIFACT_PATHS + loci_graphs.artifact_paths()),
+                                   poll_interval=lambda artifacts:
+                                   artifacts.engine.json_conf.get("artifacts_poll_seconds", 30))
+
+# the version of the artifacts a request started with, see pin_artifacts
+_pinned = threading.local()
+
+def get_artifacts():
+    """Returns the artifacts of the current request, or the active ones outside of a request."""
+    return getattr(_pinned, "artifacts", None) or artifact_manager.active
+
+def pin_artifacts():
+    """
+        Pins the active version of the artifacts to the current thread, until unpin_artifacts. A request (or a job)
+        uses the same version from start to end, even if a new version becomes active meanwhile.
+
+        Returns:
+        Artifacts: The pinned artifacts.
+        """
+    artifact_manager.check_for_update()
+    _pinned.artifacts = artifact_manager.active
+    return _pinned.artifacts
+
+def unpin_artifacts():
+    _pinned.artifacts = None
+
+def get_hap_index():
+    return get_artifacts().hap_index
 
-grim_graph = None
 def get_grim_graph():
-    global grim_graph
-    if grim_graph is None:
-        # open the grim graph pickle file and load its contents into the grim_graph variable
-        with open(PATH_TO_GRIM_GRAPH, "rb") as f:
-            grim_graph = pickle.load(f)
-    return grim_graph
+    return get_artifacts().graph
 
-# initialize the pyard object
-ard = pyard.init()
+def get_engine():
+    return get_artifacts().engine
+
+def get_result_cache():
+    return get_artifacts().result_cache
+
+def get_ard_table():
+    return get_artifacts().ard_table
+
+job_queue = None
+def get_job_queue():
+    global job_queue
+    if job_queue is None:
+        json_conf = get_engine().json_conf
+        job_queue = JobQueue(json_conf.get("jobs_dir", "jobs_dir"), impute_job,
+                             expire_seconds=json_conf.get("jobs_expire_hours", 24) * 3600)
+    return job_queue
+
+# the warm-up of this process, see warm_up
+startup = None
+
+def warm_up(setup=None, background=False):
+    """
+        Initializes py-ard and loads the graph, the imputation engine and the haplotype frequency index, so they are
+        ready before the first request. In the pre-fork server this runs once in the master, and the workers inherit
+        them.
+
+        Parameters:
+        setup (Callable[[], None]): Run first, e.g. to build the graph if it does not exist.
+        background (bool): True to warm up in a background thread and return at once.
+
+        Returns:
+        WarmUp: The warm-up, its ready event is set when it is done.
+        """
+    global startup
+
+    def load_artifacts_phase():
+        print(f"Using artifacts version {artifact_manager.active.version}")
+
+    phases = ([("setup", setup)] if setup else []) + [("pyard", get_ard), ("artifacts", load_artifacts_phase)]
+    startup = WarmUp(phases)
+    return startup.start(background)
+
+# the pyard object, initialized on first use (see get_ard)
+_ard = None
+_ard_lock = threading.Lock()
+
+def get_ard():
+    """Returns the py-ard object, initialized on the first call."""
+    global _ard
+    with _ard_lock:
+        if _ard is None:
+            _ard = pyard.init()
+    return _ard
+
+def reopen_ard_connection():
+    """
+        Reopens the py-ard read-only database connection.
+
+        An sqlite connection must not be used across a fork, so each forked worker opens its own connection to the
+        same database file.
+        """
+    ard = get_ard()
+    db_path = ard.db_connection.execute("PRAGMA database_list").fetchone()[2]
+    ard.db_connection = sqlite3.connect(f"file:{db_path}?mode=ro", check_same_thread=False, uri=True)
 
 # define a mapping from allele names to their corresponding serology types
 cast = {
@@ -78,33 +233,89 @@ cast = {
 }
 
 
-def apply_ard_on_file(path):
+def apply_ard_on_lines(lines, on_error):
     """
-    Apply py-ard on the genos in the given file and write the output to the input file.
+    Apply py-ard on the genos of the given input lines, one line at a time.
 
     Parameters:
-    path (str): The path to the input file
-
-    Raises:
-    Exception: If the input file format is wrong, the function will raise an exception with the error message.
+    lines (Iterable[str]): The lines of an input file, 'id,glstring,race1,race2'.
+    on_error (Callable[[int, str, str], None]): Called with the line number, the line and the reason of each
+    malformed line, which is skipped.
 
     Returns:
-    None
+    Iterator[str]: The reduced lines.
     """
-    new_lines = []
-    with open(path) as f:
-        lines = f.readlines()
+    reduce = functools.lru_cache(maxsize=ARD_DEDUP_SIZE)(get_ard_table().reduce)
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        fields = line.rstrip("\r\n").split(",")
+        if len(fields) != 4:
+            on_error(line_number, line, f"Expected 4 fields (id,glstring,race1,race2), found {len(fields)}")
+            continue
+        id, glstring, race1, race2 = fields
         try:
-            for line in lines:
-                id, glstring, race1, race2 = line.split(",")
-                ardstring = ard.redux(glstring, 'lgx')
-                new_lines.append(f"{id},{ardstring},{race1},{race2}")
+            ardstring = reduce(glstring)
         except Exception as e:
-            # raise Exception("Input file format wrong.", str(e))
-            raise Exception(str(e))
+            on_error(line_number, line, str(e) or type(e).__name__)
+            continue
+        yield f"{id},{ardstring},{race1},{race2}\n"
 
-    with open(path, "w") as f:
-        f.writelines(new_lines)
+
+def apply_ard_on_file(path, output_path=None, errors_path=None):
+    """
+    Apply py-ard on the genos in the given file, streaming it line by line.
+
+    Parameters:
+    path (str): The path to the input file
+    output_path (str): The path to write the reduced file to, the input file is replaced if not given.
+    errors_path (str): The path to write the malformed lines to, as 'line_number,reason' lines.
+
+    Returns:
+    int: The number of malformed lines.
+    """
+    reduced_path = output_path or path + ".ard"
+    with open(path) as f:
+        n_errors = write_ard_lines(f, reduced_path, errors_path)
+    if not output_path:
+        os.replace(reduced_path, path)
+    return n_errors
+
+
+def write_ard_lines(lines, output_path, errors_path=None):
+    """
+    Apply py-ard on the given input lines and write them to a file, without holding the file in memory.
+
+    Parameters:
+    lines (Iterable[str]): The lines of an input file, e.g. an open file or an upload stream.
+    output_path (str): The path to write the reduced lines to.
+    errors_path (str): The path to write the malformed lines to, as 'line_number,reason' lines. Created only if there
+    are malformed lines.
+
+    Returns:
+    int: The number of malformed lines.
+    """
+    n_errors = 0
+    f_errors = None
+
+    def on_error(line_number, line, reason):
+        nonlocal n_errors, f_errors
+        n_errors += 1
+        if errors_path:
+            if f_errors is None:
+                f_errors = open(errors_path, "w")
+            f_errors.write(f"{line_number},{reason}\n")
+
+    try:
+        with open(output_path, "w") as f_out:
+            f_out.writelines(apply_ard_on_lines(lines, on_error))
+    finally:
+        if f_errors:
+            f_errors.close()
+    # one line for the file, the malformed lines themselves are in the errors file
+    if n_errors:
+        print(f"Skipped {n_errors} malformed lines" + (f", see {errors_path}" if errors_path else ""))
+    return n_errors
 
 
 def get_allele_type(allele: str):
@@ -216,74 +427,358 @@ def apply_ard(alleles: dict, is_genetic: bool):
 
     glstring = build_glstring(my_all_alleles)
     #print(ard.redux(glstring, 'lgx'))
-    return glstring, ard.redux(glstring, 'lgx')
+    return glstring, get_ard_table().reduce(glstring)
 
 
-def get_random_number():
+@contextlib.contextmanager
+def request_workspace():
     """
-        Generates a random number.
+        A scratch directory of a single request, so concurrent requests never share a file. The directory and
+        everything written to it are removed when the request is done, or fails.
 
         Returns:
-        int: The random number.
+        str: The path to the directory.
         """
-    while True:
-        num = random.randint(0, 10000)
-        file_path = os.path.join(INPUT_DIR, TO_INPUT_FILE(num))
-        if not os.path.exists(file_path):
-            return num
+    workspace = tempfile.mkdtemp(prefix="request", dir=OUTPUT_DIR)
+    try:
+        yield workspace
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
 
 
-def string_to_file(ard_string, race1="UNK", race2="UNK"):
+def string_to_file(ard_string, race1="UNK", race2="UNK", directory=INPUT_DIR):
     """
-        Writes the given ARD string to a file with a random name and returns the name.
+        Writes the given ARD string to a new file with a unique name and returns its path.
 
         Parameters:
         ard_string (str): The ARD string.
         race1 (str): The race of the patient.
         race2 (str): The race of the donor.
+        directory (str): The directory to write the file to.
 
         Returns:
-        int: The random number that was used as part of the filename.
+        str: The path to the file.
         """
-    line = f"D1,{ard_string},{race1},{race2}"
-
-    while True:
-        num = random.randint(0, 10000)
-        file_path = os.path.join(INPUT_DIR, TO_INPUT_FILE(num))
-        if not os.path.exists(file_path):
-            with open(file_path, "w") as f:
-                f.write(line)
+    # the file is created exclusively, so two requests never get the same name
+    fd, file_path = tempfile.mkstemp(prefix="input", suffix=".csv", dir=directory)
+    with os.fdopen(fd, "w") as f:
+        f.write(f"D1,{ard_string},{race1},{race2}")
+    return file_path
 
-            return num
 
-
-def apply_grim_file(file):
+def apply_grim_file(file, workspace, output_format="csv", compression="none"):
     """
         Applies imputation to the given file using GRIM and returns the paths to the resulting genotype and haplotype files.
 
         Parameters:
         file (FileStorage): The file to apply imputation to.
+        workspace (str): The directory of the request to write the results to, see request_workspace.
+        output_format (str): The format of the genotype and haplotype files, 'csv' or the columnar 'npz' (see
+        columnar.py).
+        compression (str): 'zstd' to compress the result files, or 'none'.
 
         Returns:
-        tuple[str, str]: A tuple containing the paths to the genotype and haplotype files.
+        tuple[str, str, str]: A tuple containing the paths to the genotype and haplotype files, and to the file of
+        the malformed lines, or None if there are none.
         """
-    num = get_random_number()
-    input_path = os.path.join(INPUT_DIR, TO_INPUT_FILE(num))
-    file.save(input_path)
-    apply_ard_on_file(input_path)
+    columnar.check_format(output_format)
+    columnar.check_compression(compression)
+
+    # the workspace is the request's own, so the names are fixed
+    haplotype_path = os.path.join(workspace, HAPLOTYPE_FILE)
+    genotype_path = os.path.join(workspace, GENOTYPE_FILE)
+    errors_path = os.path.join(workspace, ERRORS_FILE)
+
+    # the upload is reduced as it is read, only the reduced input is written to disk
+    lines = io.TextIOWrapper(file.stream, encoding="utf-8", newline="")
+    impute_batch_lines(lines, genotype_path, haplotype_path, errors_path, endpoint="impute-file")
+
+    if output_format == "npz":
+        with stage_timer("columnar"):
+            genotype_path, haplotype_path = columnar.to_columnar(genotype_path, haplotype_path,
+                                                                 compressed=compression == "none")
+    errors_path = errors_path if os.path.exists(errors_path) else None
+    return tuple(columnar.compress(path, compression) if path else None
+                 for path in (genotype_path, haplotype_path, errors_path))
+
 
-    haplotype_path = os.path.join(OUTPUT_DIR, TO_HAPLOTYPE_FILE(num))
-    genotype_path = os.path.join(OUTPUT_DIR, TO_GENOTYPE_FILE(num))
+def impute_batch_lines(lines, genotype_path, haplotype_path, errors_path=None, progress=None, endpoint="jobs"):
+    """
+        Applies py-ard on the given input lines, and imputes them in parallel chunks.
+
+        The reduced input and the other outputs of grim (populations, missing and problem subjects) are written to
+        a workspace of their own, and removed when the imputation is done.
+
+        Parameters:
+        lines (Iterable[str]): The lines of the input file, e.g. an open file or an upload stream.
+        genotype_path (str): The path to the genotypes output file.
+        haplotype_path (str): The path to the haplotypes output file.
+        errors_path (str): The path to write the malformed lines to, see write_ard_lines.
+        progress (Callable[[int, int], None]): Called with the number of imputed subjects and the total number of
+        subjects after each chunk.
+        endpoint (str): The endpoint to count the subjects of, in the metrics.
+
+        Returns:
+        int: The number of malformed lines.
+        """
+    with request_workspace() as workspace:
+        input_path = os.path.join(workspace, "input.csv")
+        with stage_timer("ard_file"):
+            n_errors = write_ard_lines(lines, input_path, errors_path)
+        with open(input_path) as f:
+            SUBJECTS.inc(sum(1 for _ in f), endpoint=endpoint)
+        with stage_timer("impute_file"):
+            get_engine().impute_file_parallel(input_path, output_haplotype_path=haplotype_path,
+                                              output_genotype_path=genotype_path, progress=progress,
+                                              **side_outputs(input_path))
+    return n_errors
+
+
+def _read_results(path):
+    # the (result, probability) rows of an imputation output file, by subject id
+    rows = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                subject_id, result, prob, _ = line.rstrip("\n").split(",")
+                rows.setdefault(subject_id, []).append((result, float(prob)))
+    return rows
+
+
+def impute_stream(lines, chunk_size=None):
+    """
+        Applies py-ard on the given input lines and imputes them in chunks, and yields the results of each subject
+        as soon as its chunk is imputed, so neither the input nor the results are held in memory.
 
-    grim_graph = get_grim_graph()
-    run_impute(PATH_TO_CONFIG, grim_graph, input_path,
-               output_haplotype_path=haplotype_path, output_genotype_path=genotype_path)
-    os.remove(input_path)
+        Parameters:
+        lines (Iterable[str]): The lines of the input file, e.g. an upload stream.
+        chunk_size (int): The number of subjects in a chunk, defaults to the stream_chunk_size configuration.
 
-    return genotype_path, haplotype_path
+        Returns:
+        Iterator[dict]: For each subject in order, its id, its [genotype, probability] genotypes and
+        [haplotype 1, haplotype 2, probability] haplotype pairs. The malformed lines are yielded as their line
+        number and error, and the last item has the numbers of subjects and errors.
+        """
+    engine = get_engine()
+    chunk_size = chunk_size or engine.json_conf.get("stream_chunk_size", 100)
+    errors = []
+    counts = {"subjects": 0, "errors": 0}
+
+    with request_workspace() as chunks_dir:
+        def write_chunks():
+            f_out = None
+            for i, line in enumerate(apply_ard_on_lines(lines, lambda number, _, reason:
+                                                        errors.append({"line": number, "error": reason}))):
+                if i % chunk_size == 0:
+                    if f_out:
+                        f_out.close()
+                        yield f_out.name
+                    f_out = open(os.path.join(chunks_dir, f"chunk{i // chunk_size}.csv"), "w")
+                f_out.write(line)
+            if f_out:
+                f_out.close()
+                yield f_out.name
+
+        for config in engine.impute_chunks(write_chunks()):
+            chunk_path = config["imputation_input_file"]
+            while errors:
+                counts["errors"] += 1
+                yield errors.pop(0)
+
+            with open(chunk_path) as f:
+                subject_ids = [line.split(",", 1)[0] for line in f]
+            genotypes = _read_results(config["imputation_out_umug_freq_file"])
+            haplotypes = _read_results(config["imputation_out_hap_freq_file"])
+            SUBJECTS.inc(len(subject_ids), endpoint="impute-file")
+            for subject_id in subject_ids:
+                counts["subjects"] += 1
+                yield {"id": subject_id,
+                       "genotypes": [[genotype, prob] for genotype, prob in genotypes.get(subject_id, [])],
+                       "haplotype_pairs": [haps.split("+") + [prob] for haps, prob in haplotypes.get(subject_id, [])]}
+
+            # the chunk and its outputs are not needed anymore
+            for path in glob.glob(os.path.splitext(chunk_path)[0] + ".*"):
+                os.remove(path)
+
+        while errors:
+            counts["errors"] += 1
+            yield errors.pop(0)
+    yield dict(done=True, **counts)
+
+
+def impute_job(job_dir, progress):
+    """
+        Runs an asynchronous imputation job (see jobs.py).
 
+        Parameters:
+        job_dir (str): The directory of the job, with its uploaded input file.
+        progress (Callable[[int, int], None]): The progress callback of the job.
 
-def apply_grim(alleles: dict, race, loci, is_genetic=True):
+        Returns:
+        List[str]: The paths to the genotype and haplotype files, and to the file of the malformed lines if there
+        are any.
+        """
+    genotype_path = os.path.join(job_dir, GENOTYPE_FILE)
+    haplotype_path = os.path.join(job_dir, HAPLOTYPE_FILE)
+    errors_path = os.path.join(job_dir, ERRORS_FILE)
+    # the whole job is imputed with the version of the artifacts it started with
+    pin_artifacts()
+    try:
+        with open(os.path.join(job_dir, INPUT_FILE)) as f:
+            n_errors = impute_batch_lines(f, genotype_path, haplotype_path, errors_path, progress=progress)
+    finally:
+        unpin_artifacts()
+    return [genotype_path, haplotype_path] + ([errors_path] if n_errors else [])
+
+
+def best_hap_race_pairs(res_haps, number_of_results):
+    """
+        Returns the most probable haplotype pairs of a subject, with their populations.
+
+        Parameters:
+        res_haps (dict): The haplotypes result of grim, with 'Haps', 'Pops' and 'Probs' lists.
+        number_of_results (int): The maximum number of pairs to return.
+
+        Returns:
+        List[Tuple[str, str, str, str, float]]: (haplotype 1, population 1, haplotype 2, population 2, probability) tuples,
+        sorted by probability.
+        """
+    haps, pops, probs = res_haps["Haps"], res_haps["Pops"], res_haps["Probs"]
+    all_res = [(probs[i], i) for i in range(len(probs))]
+    all_res.sort(key=lambda x: x[0], reverse=True)
+    return [(haps[i][0], pops[i][0], haps[i][1], pops[i][1], prob) for prob, i in all_res[:number_of_results]]
+
+
+def best_genotypes(res_haps, number_of_results):
+    """
+        Sums the haplotype pairs of a subject into unphased genotypes and returns the most probable ones.
+
+        Parameters:
+        res_haps (dict): The haplotypes result of grim, with 'Haps' and 'Probs' lists.
+        number_of_results (int): The maximum number of genotypes to return.
+
+        Returns:
+        List[Tuple[str, float]]: (genotype, probability) tuples, sorted by probability.
+        """
+    res_muugs = {}
+    for (hap1, hap2), prob in zip(res_haps["Haps"], res_haps["Probs"]):
+        muug = "^".join("+".join(sorted([allele1, allele2]))
+                        for allele1, allele2 in zip(hap1.split("~"), hap2.split("~")))
+        if muug in res_muugs:
+            res_muugs[muug] += prob
+        else:
+            res_muugs[muug] = prob
+    pairs = sorted(res_muugs.items(), key=lambda x: x[1], reverse=True)
+    return pairs[:number_of_results]
+
+
+def get_num_res(num_res=None):
+    """Returns the requested number of reduced results, or the configured one."""
+    if num_res:
+        return int(num_res)
+    return get_engine().json_conf.get("reduce_number_of_results", NUM_RES)
+
+
+def impute_ard_rows(ard_string, race, loci, subject_id="D1", num_res=None):
+    """
+        Imputes a single ARD reduced GL string in memory and returns the reduced genotype and haplotype pair rows.
+
+        If the subject is typed at, and asks for, only the loci of a loci graph (see loci_graphs.py), its whole GL
+        string is imputed on the smallest such graph. Otherwise, or if that imputation has no results, only the 3
+        dominant loci are imputed on the full graph, and the results are filtered by the rest of the GL string. Either way, the results are then reduced to
+        the requested loci.
+
+        Parameters:
+        ard_string (str): The ARD reduced GL string.
+        race (str): The race(s) of the subject, separated by ';'.
+        loci (List[str]): The loci to reduce the results to.
+        subject_id (str): The id of the subject.
+        num_res (int): The number of reduced results, defaults to the reduce_number_of_results configuration.
+
+        Returns:
+        tuple[List, List]: The (id, genotype, probability, rank) and (id, 'hap1+hap2', probability, rank) rows, see
+        reduce_muug_rows and reduce_haps_rows.
+        """
+    artifacts = get_artifacts()
+    # a subject typed at, and asking for, only the loci of a loci graph is imputed on the smallest such graph
+    loci_graph = loci_graphs.route(artifacts.loci_graphs, set(loci) | set(extract_locuses(ard_string)))
+    genotypes, haplotypes_pairs = [], []
+
+    if loci_graph:
+        # the whole GL string is imputed, and all the candidates are summed to the loci, so the results are exact
+        with stage_timer("impute"):
+            res_muugs, res_haps = loci_graph.engine.impute_one(subject_id, ard_string, race, race)
+        if res_muugs is not None and isinstance(res_haps["Haps"], list):
+            CANDIDATE_GENOTYPES.observe(len(res_muugs["Haps"]))
+            genotypes = best_genotypes(res_haps, len(res_haps["Probs"]))
+            haplotypes_pairs = best_hap_race_pairs(res_haps, len(res_haps["Probs"]))
+        else:
+            print(f"Subject: {subject_id} - no results on the {loci_graph.name} graph, imputing on the full graph")
+            loci_graph = None
+
+    LOCI_GRAPHS.inc(graph=loci_graph.name if loci_graph else "full")
+    if not loci_graph:
+        imputation_engine = artifacts.engine
+        number_of_results = imputation_engine.config["number_of_results"]
+
+        # impute the 3 most important loci, and keep the rest to filter the results by
+        short_gl, extra_gl = split_gl(ard_string)
+        extra_gl = extra_gl.replace("g", "").replace("L", "")
+        with stage_timer("impute"):
+            res_muugs, res_haps = imputation_engine.impute_one(subject_id, short_gl, race, race)
+
+        if res_muugs is not None and isinstance(res_haps["Haps"], list):
+            CANDIDATE_GENOTYPES.observe(len(res_muugs["Haps"]))
+            pairs = best_hap_race_pairs(res_haps, number_of_results)
+            res_haps = {"Haps": [[hap1, hap2] for hap1, _, hap2, _, _ in pairs],
+                        "Pops": [[pop1, pop2] for _, pop1, _, pop2, _ in pairs],
+                        "Probs": [prob for *_, prob in pairs]}
+            if extra_gl:
+                with stage_timer("filter_extra_gl"):
+                    res_haps = filter_results(res_haps, extra_gl)
+            genotypes = best_genotypes(res_haps, number_of_results)
+            haplotypes_pairs = best_hap_race_pairs(res_haps, number_of_results)
+
+    num_res = get_num_res(num_res)
+    with stage_timer("reduce_loci"):
+        reduced_genos = list(reduce_muug_rows(((subject_id, gl, prob) for gl, prob in genotypes), loci, num_res))
+        reduced_haps = list(reduce_haps_rows(
+            ((subject_id, hap1, hap2, prob) for hap1, _, hap2, _, prob in haplotypes_pairs), loci, num_res))
+    return reduced_genos, reduced_haps
+
+
+def impute_ard_string(ard_string, race, loci, subject_id="D1", genotype_path=None, haplotype_path=None,
+                      num_res=None):
+    """
+        Imputes a single ARD reduced GL string in memory and returns the structured results, see impute_ard_rows.
+
+        Parameters:
+        ard_string (str): The ARD reduced GL string.
+        race (str): The race(s) of the subject, separated by ';'.
+        loci (List[str]): The loci to reduce the results to.
+        subject_id (str): The id of the subject.
+        genotype_path (str): Optional path to write the reduced genotypes to.
+        haplotype_path (str): Optional path to write the reduced haplotype pairs to.
+        num_res (int): The number of reduced results, defaults to the reduce_number_of_results configuration.
+
+        Returns:
+        tuple[List, dict, List]: The genotypes, the haplotypes frequencies by race and the haplotype pairs,
+        as returned by format_genos and format_haps.
+        """
+    reduced_genos, reduced_haps = impute_ard_rows(ard_string, race, loci, subject_id, num_res)
+
+    # optional file sink
+    for path, rows in ((genotype_path, reduced_genos), (haplotype_path, reduced_haps)):
+        if path:
+            with open(path, "w") as f:
+                for row in rows:
+                    f.write(",".join(map(str, row)) + "\n")
+
+    haplotypes, haplotypes_pairs = format_haps([row[1:] for row in reduced_haps], race)
+    return format_genos([row[1:] for row in reduced_genos]), haplotypes, haplotypes_pairs
+
+
+def apply_grim(alleles: dict, race, loci, is_genetic=True, num_res=None):
     """
         Applies py-ard and imputation to the given alleles and returns the resulting genotypes, haplotypes, GL string, and ARD string.
 
@@ -291,57 +786,58 @@ def apply_grim(alleles: dict, race, loci, is_genetic=True):
         alleles (dict): A dictionary of alleles and their values.
         race (str): The race of the patient.
         is_genetic (bool): True if the values represent genetic alleles, False if they represent serological alleles.
+        num_res (int): The number of results, defaults to the reduce_number_of_results configuration.
 
         Returns:
         tuple[List[Tuple[str, str]], List[str], List[Tuple[str, str]], str, str]: A tuple containing the genotypes, haplotypes, GL string, and ARD string.
         """
-    hap_pop_pair, dominant3 = True, True
-    with open(PATH_TO_CONFIG, 'r') as f:
-        config = json.load(f)
-    glstring, ard_string = apply_ard(alleles, is_genetic)
-    num = string_to_file(ard_string, race1=race, race2=race)
-
-    input_path = os.path.join(INPUT_DIR, TO_INPUT_FILE(num))
-    haplotype_path = os.path.join(OUTPUT_DIR, TO_HAPLOTYPE_FILE(num))
-    genotype_path = os.path.join(OUTPUT_DIR, TO_GENOTYPE_FILE(num))
-
-    gls, lines = change_donor_file(input_path)
-    grim_graph = get_grim_graph()
-    # Apply grim here
-    run_impute(PATH_TO_CONFIG, grim_graph, input_path,
-               output_haplotype_path=haplotype_path, output_genotype_path=genotype_path, hap_pop_pair=hap_pop_pair)
-
-
-    path_pmug = haplotype_path
-    path_umug = genotype_path
-    path_umug_pops = os.path.join(
-        config["imputation_out_path"], config["imputation_out_umug_pops_filename"]
-    )
-    path_pmug_pops = os.path.join(
-        config["imputation_out_path"], config["imputation_out_hap_pops_filename"]
-    )
-    path_miss = os.path.join(
-        config["imputation_out_path"], config["imputation_out_miss_filename"]
-    )
-
-    change_output_by_extra_gl(
-        config, gls, path_pmug, path_umug, path_umug_pops, path_pmug_pops, path_miss
-    )  # filter reasults in our origianl file, add miss to existing miss
-
-    # changing to original donor file
-    with open(input_path, "w") as file:
-        for line in lines:
-            file.write(line)
-    file.close()
-
-    os.remove(input_path) #?#
-
-    output_file_hap, output_file_muug = reduce_loci(loci, genotype_path, haplotype_path)
-    genotypes = read_genos(output_file_muug)
-    haplotypes, haplotypes_pairs = read_haps(output_file_hap, race)
+    with stage_timer("ard"):
+        glstring, ard_string = apply_ard(alleles, is_genetic)
+    SUBJECTS.inc(endpoint="impute-form")
+
+    # repeated queries are answered from the result cache
+    num_res = get_num_res(num_res)
+    cache = get_result_cache()
+    key = cache.key(ard_string, race, loci, num_res)
+    result = cache.get(key)
+    if result is None:
+        result = impute_ard_string(ard_string, race, loci, num_res=num_res)
+        cache.put(key, result)
+    genotypes, haplotypes, haplotypes_pairs = result
     return genotypes, haplotypes, haplotypes_pairs, glstring, ard_string
 
 
+def apply_grim_json(alleles: dict, race, loci, is_genetic=True, num_res=None):
+    """
+        Applies py-ard and imputation to the given alleles and returns the results of the JSON API.
+
+        Parameters:
+        alleles (dict): A dictionary of alleles and their values, or a glstring, as in apply_ard.
+        race (str): The race(s) of the subject, separated by ';'.
+        loci (List[str]): The loci to reduce the results to.
+        is_genetic (bool): True if the values represent genetic alleles, False if they represent serological alleles.
+        num_res (int): The number of results, defaults to the reduce_number_of_results configuration.
+
+        Returns:
+        dict: The GL string, the ARD string, the [genotype, probability] genotypes and the
+        [haplotype 1, haplotype 2, probability] haplotype pairs, the most probable first.
+        """
+    with stage_timer("ard"):
+        glstring, ard_string = apply_ard(alleles, is_genetic)
+    SUBJECTS.inc(endpoint="api")
+
+    num_res = get_num_res(num_res)
+    cache = get_result_cache()
+    key = cache.key(ard_string, race, loci, num_res, kind="json")
+    result = cache.get(key)
+    if result is None:
+        reduced_genos, reduced_haps = impute_ard_rows(ard_string, race, loci, num_res=num_res)
+        result = {"genotypes": [[genotype, float(prob)] for _, genotype, prob, _ in reduced_genos],
+                  "haplotype_pairs": [haps.split("+") + [float(prob)] for _, haps, prob, _ in reduced_haps]}
+        cache.put(key, result)
+    return dict(glstring=glstring, ard_string=ard_string, **result)
+
+
 def read_genos(path):
     """
         Reads in HLA genotypes and probabilities from a file and returns them as a list of tuples.
@@ -350,25 +846,36 @@ def read_genos(path):
         path (str): Path to the input file.
 
         Returns:
-        list: A list of tuples where each tuple contains the following four values:
-              1. Index (str): The index of the HLA genotype.
-              2. HLA genotype (str): The HLA genotype in the format 'A*01:01+B*08:01'.
-              3. Probability (str): The probability of the HLA genotype in scientific notation with 2 decimal places.
-              4. Index (str): The index of the HLA genotype (same as the first value).
+        list: See format_genos.
 
         Example:
            >> read_genos('genos.txt')
         [('1', 'A*01:01+B*08:01', '1.23e-02', '1'), ('2', 'A*02:01+B*07:02', '2.34e-03', '2')]
         """
+    with open(path) as f:
+        rows = [line.split(",")[1:] for line in f]
+    return format_genos(rows)
+
+
+def format_genos(rows):
+    """
+        Formats HLA genotypes and probabilities for display.
+
+        Parameters:
+        rows (Iterable[Tuple[str, str, int]]): (genotype, probability, index) rows.
+
+        Returns:
+        list: A list of tuples where each tuple contains the following four values:
+              1. Index (str): The index of the HLA genotype.
+              2. HLA genotype (str): The HLA genotype in the format 'A*01:01+B*08:01'.
+              3. Probability (str): The probability of the HLA genotype in scientific notation with 2 decimal places.
+              4. Normalized (str): The probability of the HLA genotype normalized by the sum of all probabilities.
+        """
     hlas_and_probs = []
 
-    # Of course use num here to get the results of this patient
-    with open(path) as f:
-        lines = f.readlines()
-        for line in lines:
-            _, hla, prob, index = line.split(",")
-            hlas_and_probs.append([index, hla, f"{float(prob):0.2e}"])
-            # hlas_and_probs[hla] = f"{float(prob):0.2e}"
+    for hla, prob, index in rows:
+        hlas_and_probs.append([str(index), hla, f"{float(prob):0.2e}"])
+        # hlas_and_probs[hla] = f"{float(prob):0.2e}"
 
     probs = [float(prob[2]) for prob in hlas_and_probs]
     #min_prob = min(probs)
@@ -380,7 +887,6 @@ def read_genos(path):
         #normalized = (prob - min_prob) / (max_prob - min_prob)
         hlas_and_probs[i].append(f"{normalized:.3f}")
 
-    # os.remove(path)
     return hlas_and_probs
 
 
@@ -392,32 +898,45 @@ def read_haps(path, race_str):
         path (str): Path to the input file.
 
         Returns:
-        tuple: A tuple of two lists where the first list contains dictionaries for each HLA haplotype and their probabilities for each race,
-               and the second list contains tuples with the following four values:
-                1. Index (str): The index of the HLA haplotype.
-                2. First HLA allele (str): The first HLA allele in the haplotype, in the format 'A*01:01'.
-                3. Second HLA allele (str): The second HLA allele in the haplotype, in the format 'B*08:01'.
-                4. Probability (str): The probability of the HLA haplotype in scientific notation with 2 decimal places.
+        tuple: See format_haps.
 
         Example:
             >> read_haps('haps.txt')
            ({'A*01:01': {'Asian': '1.23e-02', 'African': '3.45e-03'}, 'B*08:01': {'Asian': '5.67e-04', 'African': '7.89e-05'}},
             [('1', 'A*01:01', 'B*08:01', '1.23e-02'), ('2', 'A*01:01', 'B*08:02', '2.34e-03')])
         """
+    with open(path) as f:
+        rows = [line.split(",")[1:] for line in f]
+    return format_haps(rows, race_str)
+
+
+def format_haps(rows, race_str):
+    """
+        Formats HLA haplotype pairs and probabilities for display, with the frequency of each haplotype by race.
+
+        Parameters:
+        rows (Iterable[Tuple[str, str, int]]): (haplotype pair, probability, index) rows, the pair in the format 'hap1+hap2'.
+        race_str (str): The races of the subject, separated by ';'.
+
+        Returns:
+        tuple: A tuple of two lists where the first list contains dictionaries for each HLA haplotype and their probabilities for each race,
+               and the second list contains tuples with the following five values:
+                1. Index (str): The index of the HLA haplotype.
+                2. First HLA allele (str): The first HLA allele in the haplotype, in the format 'A*01:01'.
+                3. Second HLA allele (str): The second HLA allele in the haplotype, in the format 'B*08:01'.
+                4. Probability (str): The probability of the HLA haplotype in scientific notation with 2 decimal places.
+                5. Normalized (str): The probability normalized by the sum of all probabilities.
+        """
     hlas = set()
     hla_and_probs = {}
     hla_pairs = []
     race_list = race_str.split(";")
 
-    # Of course use num here to get the results of this patient
-    with open(path) as f:
-        lines = f.readlines()
-        for line in lines:
-            _, hla, prob, index = line.split(",")
-            hla1, hla2 = hla.split("+")
-            hlas.add(hla1)
-            hlas.add(hla2)
-            hla_pairs.append([index, hla1, hla2, f"{float(prob):0.2e}"])
+    for hla, prob, index in rows:
+        hla1, hla2 = hla.split("+")
+        hlas.add(hla1)
+        hlas.add(hla2)
+        hla_pairs.append([str(index), hla1, hla2, f"{float(prob):0.2e}"])
 
     haplos = [float(hap[3]) for hap in hla_pairs]
     sum_haplos = sum(haplos)
@@ -426,38 +945,13 @@ def read_haps(path, race_str):
         normalized = prob / sum_haplos
         hla_pairs[i].append(f"{normalized:.3f}")
 
-    conf = dict()
-    with open(PATH_TO_CONFIG, "r") as f:
-        conf = json.load(f)
-
-    populations = conf["populations"]
-
-    """for hla in hlas:
-        hla_and_probs[hla] = {}
-        for race, dict_ in all_freqs.items():
-            if hla in dict_:
-                hla_and_probs[hla][race] = f"{dict_[hla]:0.2e}"
-            else:
-                freq = grim_graph.whole_graph.nodes[hla]["freq"][populations.index(race)]
-                hla_and_probs[hla][race] = f"{freq:0.3e}" """
-    all_freqs = get_all_freqs()
-    grim_graph = get_grim_graph()
-    for hla in hlas:
-        hla_and_probs[hla] = {}
-        for race, _ in all_freqs.items():
-            if race in populations and hla in grim_graph.Vertices_attributes:
-                freq = grim_graph.Vertices_attributes[hla][1][populations.index(race)]
-                #freq = [str(round(f, 3)) for f in freq]
-                hla_and_probs[hla][race] = f"{freq:0.8e}"
-            elif race in populations and hla in grim_graph.Whole_Vertices_attributes:
-                freq = grim_graph.Whole_Vertices_attributes[hla][1][populations.index(race)]
-                hla_and_probs[hla][race] = f"{freq:0.8e}"
-                #freq = [str(round(f,3)) for f in freq]
-                #hla_and_probs[hla][race] = f"{freq:0.8e}"
-                #hla_and_probs[hla][race] = populations.index(race)
-            else:
-                hla_and_probs[hla][race] = 0
-
-                # os.remove(path)
+    # look up the frequencies of all the haplotypes in all the populations at once
+    index = get_hap_index()
+    hlas = list(hlas)
+    freqs, found = index.frequencies(hlas)
+    for hla, hla_freqs, hla_found in zip(hlas, freqs.tolist(), found.tolist()):
+        hla_and_probs[hla] = {race: f"{hla_freqs[column]:0.8e}" if hla_found else 0
+                              for race, column in index.columns.items()}
+
     return hla_and_probs, hla_pairs
 
@@ -0,0 +1,255 @@
+"""
+Asynchronous batch imputation jobs.
+
+A job is a directory in the jobs directory, with the uploaded input file, a status.json file and, once it is done,
+the results zip. The jobs directory is the queue: a runner thread in each server process claims the queued jobs,
+one at a time, and runs them. Since the state of a job is on disk, any worker can submit a job, report its
+status or send its results. Finished jobs are removed after they expire.
+"""
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import traceback
+import uuid
+from zipfile import ZipFile
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+STATUS_FILE = "status.json"
+INPUT_FILE = "input.csv"
+RESULT_FILE = "grimmard_results.zip"
+# created exclusively by the process that runs the job, holds its pid
+CLAIM_FILE = "claim"
+
+JOB_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+# seconds between looking for expired jobs
+CLEANUP_INTERVAL = 60
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue:
+    """
+        An on-disk queue of imputation jobs.
+
+        Parameters:
+        jobs_dir (str): The directory of the jobs.
+        run_job (Callable[[str, Callable[[int, int], None]], List[str]]): Runs a job. Called with the job directory
+        and a progress callback, returns the paths of the result files to zip.
+        expire_seconds (float): The time a finished job is kept.
+        poll_interval (float): The seconds between looking for queued jobs.
+        """
+
+    def __init__(self, jobs_dir, run_job, expire_seconds=24 * 3600, poll_interval=1.0):
+        self.jobs_dir = jobs_dir
+        self.run_job = run_job
+        self.expire_seconds = expire_seconds
+        self.poll_interval = poll_interval
+        self._runner_pid = None
+        self._lock = threading.Lock()
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def _job_dir(self, job_id):
+        if not JOB_ID_PATTERN.fullmatch(job_id):
+            raise KeyError(job_id)
+        return os.path.join(self.jobs_dir, job_id)
+
+    @staticmethod
+    def _write_status(job_dir, status):
+        # replace the status file atomically, so it is never read half written
+        tmp_path = os.path.join(job_dir, STATUS_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(status, f)
+        os.replace(tmp_path, os.path.join(job_dir, STATUS_FILE))
+
+    def submit(self, file):
+        """
+            Queues the imputation of an uploaded file.
+
+            Parameters:
+            file (FileStorage): The uploaded imputation input file.
+
+            Returns:
+            dict: The status of the new job.
+            """
+        job_id = uuid.uuid4().hex
+        # the job is prepared in a hidden directory, and appears in the queue complete
+        tmp_dir = os.path.join(self.jobs_dir, f".{job_id}")
+        os.makedirs(tmp_dir)
+        input_path = os.path.join(tmp_dir, INPUT_FILE)
+        file.save(input_path)
+        with open(input_path) as f:
+            total = sum(1 for _ in f)
+
+        status = {
+            "job_id": job_id,
+            "state": QUEUED,
+            "total": total,
+            "done": 0,
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "error": None,
+        }
+        self._write_status(tmp_dir, status)
+        os.rename(tmp_dir, self._job_dir(job_id))
+
+        self.start()
+        return status
+
+    def status(self, job_id):
+        """
+            Returns the status of a job.
+
+            Parameters:
+            job_id (str): The id of the job.
+
+            Raises:
+            KeyError: If there is no such job.
+
+            Returns:
+            dict: The status of the job.
+            """
+        try:
+            with open(os.path.join(self._job_dir(job_id), STATUS_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise KeyError(job_id)
+
+    def result_path(self, job_id):
+        """
+            Returns the path of the results zip of a job, or None if the job is not done.
+
+            Raises:
+            KeyError: If there is no such job.
+            """
+        if self.status(job_id)["state"] != DONE:
+            return None
+        return os.path.join(self._job_dir(job_id), RESULT_FILE)
+
+    def start(self):
+        """Starts the runner thread of this process, if it is not running yet. Safe to call after a fork."""
+        with self._lock:
+            if self._runner_pid == os.getpid():
+                return
+            self._runner_pid = os.getpid()
+            threading.Thread(target=self._run, name="grimmard-jobs", daemon=True).start()
+
+    def _run(self):
+        last_cleanup = 0
+        while True:
+            try:
+                job_id = self._claim_next()
+                if job_id:
+                    self._execute(job_id)
+                    continue
+                if time.time() - last_cleanup > CLEANUP_INTERVAL:
+                    self.remove_expired()
+                    last_cleanup = time.time()
+            except Exception:
+                traceback.print_exc()
+            time.sleep(self.poll_interval)
+
+    def _claim(self, job_dir):
+        try:
+            fd = os.open(os.path.join(job_dir, CLAIM_FILE), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(str(os.getpid()))
+        return True
+
+    def _reclaim_interrupted(self, job_dir):
+        # a job whose process died (e.g. a recycled worker) is claimed again and run from the start
+        claim_path = os.path.join(job_dir, CLAIM_FILE)
+        try:
+            with open(claim_path) as f:
+                pid = int(f.read())
+        except (FileNotFoundError, ValueError):
+            # no claim, or a claim that is just being written
+            return False
+        if _pid_alive(pid):
+            return False
+        try:
+            # only one of the processes that found the job interrupted succeeds in renaming the claim
+            os.rename(claim_path, f"{claim_path}.{os.getpid()}")
+        except FileNotFoundError:
+            return False
+        os.remove(f"{claim_path}.{os.getpid()}")
+        return self._claim(job_dir)
+
+    def _claim_next(self):
+        """Claims the oldest queued (or interrupted) job, and returns its id, or None."""
+        jobs = []
+        for job_id in os.listdir(self.jobs_dir):
+            if not JOB_ID_PATTERN.fullmatch(job_id):
+                continue
+            try:
+                status = self.status(job_id)
+            except (KeyError, ValueError):
+                continue
+            if status["state"] in (QUEUED, RUNNING):
+                jobs.append((status["created"], job_id))
+
+        for _, job_id in sorted(jobs):
+            job_dir = self._job_dir(job_id)
+            if self._claim(job_dir) or self._reclaim_interrupted(job_dir):
+                return job_id
+        return None
+
+    def _execute(self, job_id):
+        job_dir = self._job_dir(job_id)
+        status = self.status(job_id)
+        status.update(state=RUNNING, started=time.time(), done=0)
+        self._write_status(job_dir, status)
+
+        def progress(done, total):
+            status.update(done=done, total=total)
+            self._write_status(job_dir, status)
+
+        try:
+            result_paths = self.run_job(job_dir, progress)
+            tmp_path = os.path.join(job_dir, RESULT_FILE + ".tmp")
+            with ZipFile(tmp_path, "w") as zf:
+                for path in result_paths:
+                    zf.write(path, os.path.basename(path))
+            os.replace(tmp_path, os.path.join(job_dir, RESULT_FILE))
+            for path in result_paths:
+                os.remove(path)
+            status.update(state=DONE, done=status["total"])
+        except Exception as e:
+            traceback.print_exc()
+            status.update(state=FAILED, error=str(e))
+        status["finished"] = time.time()
+        self._write_status(job_dir, status)
+
+    def remove_expired(self):
+        """Removes the jobs that finished more than expire_seconds ago, and abandoned submissions."""
+        now = time.time()
+        for name in os.listdir(self.jobs_dir):
+            job_dir = os.path.join(self.jobs_dir, name)
+            if name.startswith("."):
+                expired = now - os.path.getmtime(job_dir) > self.expire_seconds
+            else:
+                try:
+                    status = self.status(name)
+                except (KeyError, ValueError):
+                    continue
+                expired = status["finished"] is not None and now - status["finished"] > self.expire_seconds
+            if expired:
+                shutil.rmtree(job_dir, ignore_errors=True)
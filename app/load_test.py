@@ -0,0 +1,171 @@
+"""
+Replays synthetic donors against a running application, at a given concurrency, and reports the throughput and the
+latency percentiles of each endpoint.
+
+The donors are generated by synthetic_donors.py. /impute-form gets one donor per request, half of them as a GL string
+and half as the fields of the form, and /impute-file gets files of --file-donors donors. Start the application
+(python3 app.py, or gunicorn for production numbers), then from the app directory:
+    python3 load_test.py --url http://127.0.0.1:5000 --requests 500 --concurrency 8 [--endpoints impute-form]
+"""
+import argparse
+import itertools
+import json
+import math
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from synthetic_donors import FREQ_DATA_DIR, generate_donors, load_haplotypes, to_csv_line, to_form
+
+ENDPOINTS = ["impute-form", "impute-file"]
+# the error page is rendered with a 200 status
+ERROR_MARKER = b"The following error has occurred"
+
+
+def form_request(donor, glstring=True):
+    return "impute-form", urllib.parse.urlencode(to_form(donor, glstring)).encode(), \
+        "application/x-www-form-urlencoded"
+
+
+def file_request(donors):
+    boundary = uuid.uuid4().hex
+    content = "".join(to_csv_line(donor) + "\n" for donor in donors)
+    body = (f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="genofile"; filename="donors.csv"\r\n'
+            f"Content-Type: text/csv\r\n\r\n{content}\r\n--{boundary}--\r\n").encode()
+    return "impute-file", body, f"multipart/form-data; boundary={boundary}"
+
+
+def build_requests(donors, endpoints=ENDPOINTS, file_donors=50):
+    """
+        Builds the requests of the load test from the donors.
+
+        Parameters:
+        donors (List[dict]): The donors, see synthetic_donors.generate_donors.
+        endpoints (List[str]): The endpoints to send requests to, see ENDPOINTS.
+        file_donors (int): The number of donors in each /impute-file file.
+
+        Returns:
+        List[tuple[str, bytes, str]]: The endpoint, body and content type of each request, the endpoints interleaved.
+        """
+    requests = {endpoint: [] for endpoint in endpoints}
+    if "impute-form" in requests:
+        requests["impute-form"] = [form_request(donor, glstring=i % 2 == 0) for i, donor in enumerate(donors)]
+    if "impute-file" in requests:
+        requests["impute-file"] = [file_request(donors[start:start + file_donors])
+                                   for start in range(0, len(donors), file_donors)]
+    return [request for group in itertools.zip_longest(*requests.values()) for request in group if request]
+
+
+def send(url, request, timeout):
+    """Sends a request, and returns its endpoint, its latency in seconds and whether it succeeded."""
+    endpoint, body, content_type = request
+    http_request = urllib.request.Request(f"{url}/{endpoint}", data=body, headers={"Content-Type": content_type})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(http_request, timeout=timeout) as response:
+            ok = response.status == 200 and ERROR_MARKER not in response.read()
+    except (urllib.error.URLError, OSError):
+        ok = False
+    return endpoint, time.perf_counter() - start, ok
+
+
+def percentile(sorted_values, q):
+    """Returns the q-th percentile (nearest rank) of sorted values."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(q / 100 * len(sorted_values)) - 1, 0)]
+
+
+def run_load(url, requests, n_requests, concurrency, duration=None, timeout=300):
+    """
+        Replays the requests, in a loop, from concurrent clients.
+
+        Parameters:
+        url (str): The url of the application.
+        requests (List[tuple[str, bytes, str]]): The requests, see build_requests.
+        n_requests (int): The number of requests to send.
+        concurrency (int): The number of concurrent clients.
+        duration (float): Stop sending requests after this many seconds, if given.
+        timeout (float): The timeout of a request, in seconds.
+
+        Returns:
+        dict: The number of requests, errors, throughput (requests per second) and p50/p95/p99 latencies (ms) of
+        each endpoint.
+        """
+    pending = iter(itertools.islice(itertools.cycle(requests), n_requests))
+    lock = threading.Lock()
+    results = []
+    start = time.perf_counter()
+
+    def client():
+        while duration is None or time.perf_counter() - start < duration:
+            with lock:
+                request = next(pending, None)
+            if request is None:
+                return
+            result = send(url, request, timeout)
+            with lock:
+                results.append(result)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(client) for _ in range(concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    report = {}
+    for endpoint in sorted({endpoint for endpoint, _, _ in results}):
+        latencies = sorted(latency for name, latency, _ in results if name == endpoint)
+        report[endpoint] = {
+            "requests": len(latencies),
+            "errors": sum(1 for name, _, ok in results if name == endpoint and not ok),
+            "throughput": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+        }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test a running application with synthetic donors.")
+    parser.add_argument("-u", "--url", default="http://127.0.0.1:5000", help="Application url", type=str)
+    parser.add_argument("-n", "--requests", default=200, help="Number of requests", type=int)
+    parser.add_argument("-c", "--concurrency", default=4, help="Number of concurrent clients", type=int)
+    parser.add_argument("-t", "--duration", default=None, help="Stop after this many seconds", type=float)
+    parser.add_argument("-e", "--endpoints", default=",".join(ENDPOINTS), help="Comma separated endpoints", type=str)
+    parser.add_argument("--donors", default=1000, help="Number of distinct donors", type=int)
+    parser.add_argument("--file-donors", default=50, help="Donors in each /impute-file file", type=int)
+    parser.add_argument("-p", "--populations", default="AFA,CAU", help="Comma separated populations", type=str)
+    parser.add_argument("-d", "--freq-data-dir", default=FREQ_DATA_DIR, help="Frequency files directory", type=str)
+    parser.add_argument("-s", "--seed", default=1, help="Random seed", type=int)
+    parser.add_argument("--multi-race", default=0.1, help="Fraction of multi-race donors", type=float)
+    parser.add_argument("--low-resolution", default=0.1, help="Fraction of alleles typed as :XX", type=float)
+    parser.add_argument("--missing-locus", default=0.2, help="Probability of a locus not being typed", type=float)
+    parser.add_argument("-o", "--output", default=None, help="Save the report as JSON", type=str)
+    args = parser.parse_args()
+
+    endpoints = [endpoint for endpoint in args.endpoints.split(",") if endpoint]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"Unknown endpoints {sorted(unknown)}, the endpoints are {ENDPOINTS}")
+
+    haplotypes = load_haplotypes(args.populations.split(","), args.freq_data_dir)
+    donors = list(generate_donors(args.donors, haplotypes, args.seed, args.multi_race, args.low_resolution,
+                                  args.missing_locus))
+    print(f"Sending {args.requests} requests to {args.url} from {args.concurrency} clients")
+    load_report = run_load(args.url, build_requests(donors, endpoints, args.file_donors), args.requests,
+                           args.concurrency, args.duration)
+
+    print(f"{'endpoint':14s} {'requests':>9s} {'errors':>7s} {'req/s':>8s} {'p50 ms':>9s} {'p95 ms':>9s} "
+          f"{'p99 ms':>9s}")
+    for name, stats in load_report.items():
+        print(f"{name:14s} {stats['requests']:9d} {stats['errors']:7d} {stats['throughput']:8.2f} "
+              f"{stats['p50_ms']:9.1f} {stats['p95_ms']:9.1f} {stats['p99_ms']:9.1f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"url": args.url, "concurrency": args.concurrency, "endpoints": load_report}, f, indent=2)
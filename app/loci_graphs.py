@@ -0,0 +1,272 @@
+"""
+Graphs of subsets of the loci, so the queries of a few loci are not imputed on the graph of all of them.
+
+The frequency of a haplotype of some of the loci is the sum (the marginal) of the frequencies of the full-locus
+haplotypes that carry it. For each loci subset of the loci_graphs configuration, the build sums the frequency files of
+the populations to the subset, and builds a graph of it with its own configuration, under <dir>/<loci>:
+    conf.json               the configuration of the subset: its loci_map, and the Plan A/B matrices projected on
+                            it, the rest as in the full configuration.
+    freqs/<pop>.freqs.gz    the frequencies of the haplotypes of the subset.
+    hpf.csv, pop_ratio.txt, csv/
+                            the HPF file, the population ratios and grim's nodes/edges files.
+    graph_store/            the graph store (see graph_store.py), with its build manifest.
+
+A graph of fewer loci has far fewer candidate haplotypes per query, and its results are the exact marginals of the
+full-locus haplotypes, rather than sums of the most probable full-locus results. A subject is routed to the smallest
+graph of the loci it is typed at and the loci it asks for (see route), or to the full graph if none covers them.
+
+Run from the app directory, after the full graph is built (produce_example_graph_file.py runs it too):
+    python3 loci_graphs.py --config conf/conf.json [--dir data/loci_graphs]
+"""
+import argparse
+import collections
+import gzip
+import json
+import os
+
+from build_freqs import build_frequencies, read_freq_file
+from graph_build import build_graph, changed_populations
+from graph_store import load_graph, store_exists
+from runfile import ImputationEngine
+
+LOCI_GRAPHS_DIR = "data/loci_graphs"
+FREQ_HEADER = "Haplo,Count,Freq\n"
+
+# a loaded graph of a loci subset: its name, the names of its loci, and its imputation engine
+LociGraph = collections.namedtuple("LociGraph", ["name", "loci", "engine"])
+
+
+def subset_loci_map(loci_map, loci):
+    """
+        Returns the loci map of a subset of the loci, numbered from 1 in the order of the full loci map.
+
+        The loci of the same position (DRB3, DRB4, DRB5 and DRBX) are all in the subset if any of them is.
+
+        Parameters:
+        loci_map (dict): The loci map of the full configuration, of each locus name to its position.
+        loci (List[str]): The names of the loci of the subset.
+
+        Raises:
+        ValueError: If a locus is not in the loci map.
+
+        Returns:
+        dict: The loci map of the subset.
+        """
+    unknown = [locus for locus in loci if locus not in loci_map]
+    if unknown:
+        raise ValueError(f"The loci {unknown} of a loci graph are not in the loci_map")
+    positions = sorted({loci_map[locus] for locus in loci})
+    renumber = {position: i + 1 for i, position in enumerate(positions)}
+    return {name: renumber[position] for name, position in loci_map.items() if position in renumber}
+
+
+def graph_name(loci_map):
+    # the loci of the subset in their order, one name per position
+    names = {}
+    for name, position in loci_map.items():
+        names.setdefault(position, name)
+    return "-".join(names[position] for position in sorted(names))
+
+
+def project_plan_a(plan_a, renumber):
+    # the Plan A nodes of the loci of the subset, renumbered, the full haplotype first
+    nodes = [list(range(1, len(renumber) + 1))]
+    for node in plan_a:
+        if all(position in renumber for position in node):
+            node = sorted(renumber[position] for position in node)
+            if node not in nodes:
+                nodes.append(node)
+    return nodes
+
+
+def project_plan_b(plan_b, renumber):
+    # each Plan B partition of the full loci, restricted to the loci of the subset, renumbered
+    partitions = []
+    for partition in plan_b:
+        blocks = [sorted(renumber[position] for position in block if position in renumber) for block in partition]
+        blocks = [block for block in blocks if block]
+        if blocks and blocks not in partitions:
+            partitions.append(blocks)
+    return partitions
+
+
+def subset_conf(conf, loci, graph_dir):
+    """
+        Returns the configuration of the graph of a loci subset.
+
+        Parameters:
+        conf (dict): The full configuration.
+        loci (List[str]): The names of the loci of the subset.
+        graph_dir (str): The directory of the graph of the subset.
+
+        Returns:
+        dict: The configuration of the subset.
+        """
+    loci_map = subset_loci_map(conf["loci_map"], loci)
+    renumber = {conf["loci_map"][name]: position for name, position in loci_map.items()}
+    sub_conf = {key: val for key, val in conf.items() if key != "loci_graphs"}
+    sub_conf.update({
+        "loci_map": loci_map,
+        "FULL_LOCI": conf.get("FULL_LOCI", "ABCDEFGHI")[:len(renumber)],
+        "Plan_A_Matrix": project_plan_a(conf.get("Plan_A_Matrix", []), renumber),
+        "Plan_B_Matrix": project_plan_b(conf.get("Plan_B_Matrix", []), renumber),
+        "freq_data_dir": os.path.join(graph_dir, "freqs"),
+        "freq_file": os.path.join(graph_dir, "hpf.csv"),
+        "pops_count_file": os.path.join(graph_dir, "pop_ratio.txt"),
+        "graph_files_path": os.path.join(graph_dir, "csv") + "/",
+    })
+    return sub_conf
+
+
+def marginalize_freqs(freq_path, output_path, loci):
+    """
+        Sums the haplotypes of a frequency file to a loci subset, and writes them as a frequency file.
+
+        Parameters:
+        freq_path (str): The gzipped frequency file, with 'Haplo,Count,Freq' rows.
+        output_path (str): The gzipped frequency file of the subset.
+        loci (Iterable[str]): The names of the loci of the subset.
+
+        Returns:
+        int: The number of haplotypes of the subset.
+        """
+    loci = set(loci)
+    haplotypes = {}
+    for haplotype, count, freq in read_freq_file(freq_path):
+        haplotype = "~".join(allele for allele in haplotype.split("~") if allele.split("*")[0] in loci)
+        counts = haplotypes.setdefault(haplotype, [0.0, 0.0])
+        counts[0] += count
+        counts[1] += freq
+
+    # without a modification time, the same frequencies are the same file, and the graph is not built again
+    with gzip.GzipFile(output_path, "wb", mtime=0) as f:
+        f.write(FREQ_HEADER.encode())
+        for haplotype, (count, freq) in haplotypes.items():
+            f.write(f"{haplotype},{count},{freq}\n".encode())
+    return len(haplotypes)
+
+
+def build_loci_graph(conf_file, loci, graphs_dir=LOCI_GRAPHS_DIR, force=False):
+    """
+        Builds the graph of a loci subset: its configuration, frequencies and graph store.
+
+        Parameters:
+        conf_file (str): The full configuration JSON file.
+        loci (List[str]): The names of the loci of the subset.
+        graphs_dir (str): The directory of the loci graphs.
+        force (bool): True to build the graph even if its frequencies and configuration did not change.
+
+        Returns:
+        str: The directory of the graph.
+        """
+    with open(conf_file) as f:
+        conf = json.load(f)
+    graph_dir = os.path.join(graphs_dir, graph_name(subset_loci_map(conf["loci_map"], loci)))
+    sub_conf = subset_conf(conf, loci, graph_dir)
+    os.makedirs(sub_conf["freq_data_dir"], exist_ok=True)
+    os.makedirs(sub_conf["graph_files_path"], exist_ok=True)
+
+    for pop in conf["populations"]:
+        n_haplotypes = marginalize_freqs(os.path.join(conf["freq_data_dir"], f"{pop}.freqs.gz"),
+                                         os.path.join(sub_conf["freq_data_dir"], f"{pop}.freqs.gz"),
+                                         sub_conf["loci_map"])
+        print(f"{graph_dir}: {n_haplotypes} {pop} haplotypes")
+
+    sub_conf_file = os.path.join(graph_dir, "conf.json")
+    with open(sub_conf_file, "w") as f:
+        json.dump(sub_conf, f, indent=2)
+
+    store_dir = os.path.join(graph_dir, "graph_store")
+    if not force and changed_populations(sub_conf, store_dir) == []:
+        print(f"{graph_dir}: the graph is up to date")
+        return graph_dir
+    build_frequencies(sub_conf_file, freqs_dir=None)
+    build_graph(sub_conf_file, store_dir=store_dir, pickle_path=None)
+    print(f"{graph_dir}: built the graph of {'+'.join(loci)}")
+    return graph_dir
+
+
+def build_loci_graphs(conf_file, graphs_dir=LOCI_GRAPHS_DIR, force=False):
+    """
+        Builds the graphs of the loci subsets of the loci_graphs configuration.
+
+        Parameters:
+        conf_file (str): The full configuration JSON file.
+        graphs_dir (str): The directory of the loci graphs.
+        force (bool): True to build the graphs even if they did not change.
+
+        Returns:
+        List[str]: The directories of the graphs.
+        """
+    with open(conf_file) as f:
+        conf = json.load(f)
+    return [build_loci_graph(conf_file, loci, graphs_dir, force) for loci in conf.get("loci_graphs", [])]
+
+
+def artifact_paths(graphs_dir=LOCI_GRAPHS_DIR):
+    """Returns the files and directories of the loci graphs whose change is a new version of the artifacts."""
+    if not os.path.isdir(graphs_dir):
+        return []
+    names = sorted(os.listdir(graphs_dir))
+    return [os.path.join(graphs_dir, name, path) for name in names for path in ("conf.json", "graph_store")]
+
+
+def load_loci_graphs(conf, graphs_dir=LOCI_GRAPHS_DIR):
+    """
+        Loads the graphs of the configured loci subsets that were built, and their imputation engines.
+
+        Parameters:
+        conf (dict): The full configuration, with loci_map and loci_graphs.
+        graphs_dir (str): The directory of the loci graphs.
+
+        Raises:
+        ValueError: If a graph does not match its configuration.
+
+        Returns:
+        List[LociGraph]: The loci graphs, the smallest first.
+        """
+    loci_graphs = []
+    for loci in conf.get("loci_graphs", []):
+        loci_map = subset_loci_map(conf["loci_map"], loci)
+        name = graph_name(loci_map)
+        graph_dir = os.path.join(graphs_dir, name)
+        store_dir = os.path.join(graph_dir, "graph_store")
+        if not store_exists(store_dir):
+            print(f"The graph of {name} is not built, its queries use the full graph (see loci_graphs.py)")
+            continue
+        graph = load_graph(store_dir)
+        engine = ImputationEngine(os.path.join(graph_dir, "conf.json"), graph)
+        # (grim keeps the loci map of the engine with its positions as strings)
+        if set(engine.json_conf["loci_map"]) != set(loci_map) or \
+                list(graph.full_loci) != list(engine.config["full_loci"]):
+            raise ValueError(f"The graph of {name} does not match the loci_map, build it again")
+        loci_graphs.append(LociGraph(name, frozenset(loci_map), engine))
+    return sorted(loci_graphs, key=lambda loci_graph: len(loci_graph.engine.config["full_loci"]))
+
+
+def route(loci_graphs, loci):
+    """
+        Returns the smallest loci graph of the given loci.
+
+        Parameters:
+        loci_graphs (List[LociGraph]): The loci graphs, the smallest first, see load_loci_graphs.
+        loci (Iterable[str]): The names of the loci the subject is typed at, and of those it asks for.
+
+        Returns:
+        LociGraph: The loci graph, or None if none covers the loci.
+        """
+    loci = set(loci)
+    for loci_graph in loci_graphs:
+        if loci <= loci_graph.loci:
+            return loci_graph
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the graphs of the configured loci subsets.")
+    parser.add_argument("-c", "--config", default="conf/conf.json", help="Configuration JSON file", type=str)
+    parser.add_argument("-d", "--dir", default=LOCI_GRAPHS_DIR, help="Loci graphs directory", type=str)
+    parser.add_argument("--force", action="store_true", help="Build the graphs even if they did not change")
+    args = parser.parse_args()
+
+    build_loci_graphs(args.config, args.dir, args.force)
@@ -0,0 +1,166 @@
+"""
+Counters and latency histograms of the request path, exposed in the Prometheus text format at /metrics.
+
+The metrics are kept in memory by each worker process, so each scrape answers for the worker that serves it (as do
+/cache-stats and /version). Recording a value takes a lock and a bisect of the buckets, cheap enough to leave on.
+
+Time a stage of the request path with:
+    with stage_timer("impute"):
+        ...
+"""
+import bisect
+import contextlib
+import threading
+import time
+
+# the latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                   300.0)
+# the buckets of the number of candidate genotypes of a subject
+AMBIGUITY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000)
+
+
+def _format_labels(labelnames, labels, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+        A counter of events, by labels.
+
+        Parameters:
+        name (str): The name of the metric.
+        documentation (str): The help text of the metric.
+        labelnames (tuple[str]): The names of the labels.
+        """
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    """A value that is set, by labels."""
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    """
+        A histogram of observed values, by labels.
+
+        Parameters:
+        name (str): The name of the metric.
+        documentation (str): The help text of the metric.
+        labelnames (tuple[str]): The names of the labels.
+        buckets (tuple[float]): The upper bounds of the buckets, increasing.
+        """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # the counts of each bucket (not cumulative, the last one is +Inf), the sum of the values, by labels
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts_sum = self._values.get(key)
+            if counts_sum is None:
+                counts_sum = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts_sum[0][index] += 1
+            counts_sum[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(float(bound))}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}"
+
+
+REQUEST_SECONDS = Histogram("grimmard_request_seconds", "Latency of the requests, by endpoint.",
+                            ("endpoint", "status"))
+STAGE_SECONDS = Histogram("grimmard_stage_seconds", "Latency of the stages of the imputation request path.",
+                          ("stage",))
+SUBJECTS = Counter("grimmard_subjects_total", "Subjects requested, by endpoint.", ("endpoint",))
+CANDIDATE_GENOTYPES = Histogram("grimmard_candidate_genotypes", "Candidate genotypes of a subject imputed alone.",
+                                buckets=AMBIGUITY_BUCKETS)
+IMPUTATION_PLANS = Counter("grimmard_imputation_plan_total",
+                           "Subjects imputed, by the plan of grim that imputed them (a, or the b/c fallbacks).",
+                           ("plan",))
+LOCI_GRAPHS = Counter("grimmard_loci_graph_total",
+                      "Subjects imputed alone, by the loci graph they were imputed on (full for the full graph).",
+                      ("graph",))
+ARTIFACTS_INFO = Gauge("grimmard_artifacts_info", "The active version of the configuration, graph and frequencies.",
+                       ("version",))
+
+REGISTRY = [REQUEST_SECONDS, STAGE_SECONDS, SUBJECTS, CANDIDATE_GENOTYPES, IMPUTATION_PLANS, LOCI_GRAPHS,
+            ARTIFACTS_INFO]
+
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    """Records the time of the enclosed block as a stage of the request path."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def render():
+    """
+        Returns the metrics in the Prometheus text format.
+
+        Returns:
+        str: The metrics.
+        """
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
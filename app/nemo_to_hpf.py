@@ -1,9 +1,9 @@
-import csv
-import gzip
 import json
 import pathlib
 import argparse
 
+from build_freqs import build_frequencies
+
 project_dir = "./"
 output_dir = "output/"
 
@@ -48,47 +48,5 @@ print(
     "****************************************************************************************************"
 )
 
-haplist_overall = {}  # list of haplotypes across all populations
-pop_hap_combos = {}
-
-list_pop_count = []
-#### Load initial frequency files
-for pop in pops:
-    freq_file = freq_data_dir + pop + ".freqs.gz"
-    print("Reading Frequency File:\t {}".format(freq_file))
-    with gzip.open(freq_file, "rb") as zf:
-        count_pop = 0
-        lines = [x.decode("utf8").strip() for x in zf.readlines()]
-        for hap_line in lines:
-            haplotype, count, freq = hap_line.split(",")
-            if haplotype == "Haplo":
-                continue
-            freq = float(freq)
-            # Ignore lines with 0 freq
-            if freq == 0.0:
-                continue
-
-            pop_haplotype = pop + "-" + haplotype
-            haplist_overall[haplotype] = 1
-            pop_hap_combos[pop_haplotype] = freq
-
-            count_pop += float(count)
-        list_pop_count.append(count_pop)
-
-sum_pops = sum(list_pop_count)
-pop_ratio_file = open(pop_ratio_dir, "w")
-for pop, ratio in zip(pops, list_pop_count):
-    pop_ratio_file.write("{},{},{}\n".format(pop, ratio, (ratio / sum_pops)))
-
-
-header = ["hap", "pop", "freq"]
-
-
-print("Writing hpf File:\t {}".format(hpf_file))
-with open(hpf_file, mode="w", newline='') as csv_file:
-    csv_writer = csv.writer(csv_file, delimiter=",", quoting=csv.QUOTE_NONE)
-    csv_writer.writerow(header)
-    for pop_haplotype in pop_hap_combos:
-        (pop, haplotype) = pop_haplotype.split("-")
-        freq = pop_hap_combos[pop_haplotype]
-        csv_writer.writerow([haplotype, pop, freq])
+# the populations are read in parallel, see build_freqs.py
+build_frequencies(configuration_file, freqs_dir=None, hpf_path=hpf_file, pop_ratio_path=pop_ratio_dir)
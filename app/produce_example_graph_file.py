@@ -1,53 +1,20 @@
-import os
-import pickle
-import shutil
-import gzip
-from graph_generation.generate_hpf import produce_hpf
-from generate_config_dict import generate_dict_config
-from grim import grim
+from build_freqs import build_frequencies
+from graph_build import build_graph
+from loci_graphs import build_loci_graphs
 
-# Step 1: Create HPF File
+# Step 1: Create the HPF File, the population ratios and the frequency dictionaries
 config_file = 'conf/conf.json'
-produce_hpf(conf_file=config_file)
-print("1. Produced: output_new/hpf.csv")
+build_frequencies(config_file, freqs_dir="data/freqs_dicts")
+print("1. Produced: output_new/hpf.csv, data/pop_ratio.txt and data/freqs_dicts")
 
-# Step 2: Create nodes/edges
-grim.graph_freqs(config_file)
+# Step 2 and 3: Create nodes/edges, the networkx Graph, its pickle and the memory-mapped graph store shared by the
+# app workers, with the build manifest of incremental updates (see graph_build.py)
+build_graph(config_file, store_dir="data/graph_store", pickle_path="data/graph.pkl")
 print("2. Produced nodes and edges: output_new/csv")
-
-# Step 3: Create networkx Graph
-dict_config = generate_dict_config(config_file)
-# Create a graph instance based on your configuration
-graph = grim.graph_instance(dict_config)
-
-# Pickle it out
-# Assuming 'graph' is your graph instance, save it as a pickle
-os.makedirs("data", exist_ok=True)
-with open('data/graph.pkl', 'wb') as pickle_file:
-    pickle.dump(graph, pickle_file)
 print("3. Produced Whole Graph: data/graph.pkl")
+print("3. Produced Graph Store: data/graph_store")
 
-# Generate the freq dictionary file
-os.makedirs("data/freqs_dicts", exist_ok=True)
-
-freqs_files = os.listdir("data/freq_9loci/")
-all_freqs = {}
-
-for file in freqs_files:
-    print(f"Reading file: {file}")
-    freqs = {}
-    with gzip.open(f"data/freq_9loci/{file}", 'rt') as f:
-        for i, line in enumerate(f):
-            if i == 0:
-              continue
-            hap, _, prob = line.split(",")
-            hap = "~".join(sorted(hap.split("~")))
-            prob == 'Freq\n'
-            freqs[hap] = float(prob)
-
-    pop = file.split('.')[0]
-    all_freqs[pop] = freqs
-
-with open(f"data/freqs_dicts/all_freqs.pickle", "wb") as f:
-    pickle.dump(all_freqs, f)
-print("4. Produced Pickled Freqs: data/freqs_dicts/all_freqs.pickle")
+# Step 4: Create the graphs of the configured loci subsets, from the frequencies summed to their loci (see
+# loci_graphs.py)
+build_loci_graphs(config_file, graphs_dir="data/loci_graphs")
+print("4. Produced Loci Graphs: data/loci_graphs")
@@ -0,0 +1,136 @@
+"""
+Profiles single imputation requests, on demand or one in every N requests, and saves their profiles.
+
+A request is profiled when it has the configured profiling_token in its X-Grimmard-Profile header or profile query
+parameter, or when it is one in every profiling_sample_every requests of the worker. Each profile is saved in
+profiling_dir as:
+    <name>.prof     the cProfile statistics, for pstats or snakeviz.
+    <name>.folded   the sampled stacks of the request, one 'frame;frame;frame count' line per stack, for
+                    flamegraph.pl or speedscope.
+    <name>.json     the endpoint, the ARD string (or uploaded file name), the time and why it was profiled.
+"""
+import cProfile
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILE_HEADER = "X-Grimmard-Profile"
+PROFILE_PARAM = "profile"
+
+_request_counter = itertools.count(1)
+
+
+def profile_reason(json_conf, token):
+    """
+        Returns why a request is profiled, or None if it is not.
+
+        Parameters:
+        json_conf (dict): The configuration, with profiling_token and profiling_sample_every.
+        token (str): The token of the request, from its header or query parameter, or None.
+
+        Returns:
+        str: 'requested', 'sampled' or None.
+        """
+    # compared in constant time, not to leak the token by the time of the comparison
+    expected = json_conf.get("profiling_token")
+    if token and expected and hmac.compare_digest(token.encode(), expected.encode()):
+        return "requested"
+    sample_every = json_conf.get("profiling_sample_every", 0)
+    if sample_every and next(_request_counter) % sample_every == 0:
+        return "sampled"
+    return None
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class RequestProfiler:
+    """
+        Profiles the thread that starts it, with cProfile and with a stack sampler for the flame graph.
+
+        Parameters:
+        interval (float): The seconds between samples of the stack.
+        """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.profile = cProfile.Profile()
+        self._thread_id = None
+        self._stopped = threading.Event()
+        self._sampler = None
+        self._profiling = False
+        self.start_time = self.elapsed = None
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self.start_time = time.time()
+        self._started = time.perf_counter()
+        try:
+            self.profile.enable()
+            self._profiling = True
+        except ValueError:
+            # another request of this process is being profiled, only the stacks are sampled
+            self._profiling = False
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        return self
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        """Stops profiling, returns the seconds since start."""
+        if self.elapsed is None:
+            if self._profiling:
+                self.profile.disable()
+            self._stopped.set()
+            self._sampler.join()
+            self.elapsed = time.perf_counter() - self._started
+        return self.elapsed
+
+    def save(self, profiles_dir, endpoint, tag, reason):
+        """
+            Saves the profile.
+
+            Parameters:
+            profiles_dir (str): The directory of the profiles.
+            endpoint (str): The endpoint of the request.
+            tag (str): The ARD string, or the uploaded file name, of the request.
+            reason (str): Why the request was profiled, see profile_reason.
+
+            Returns:
+            str: The path of the profile, without its extension.
+            """
+        self.stop()
+        os.makedirs(profiles_dir, exist_ok=True)
+        digest = hashlib.sha1((tag or "").encode()).hexdigest()[:8]
+        name = (f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.start_time))}_{endpoint.strip('/')}_"
+                f"{self.elapsed * 1000:.0f}ms_{digest}_{os.getpid()}")
+        path = os.path.join(profiles_dir, name)
+
+        if self._profiling:
+            self.profile.dump_stats(path + ".prof")
+        with open(path + ".folded", "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(path + ".json", "w") as f:
+            json.dump({"endpoint": endpoint, "tag": tag, "reason": reason, "start_time": self.start_time,
+                       "elapsed_seconds": self.elapsed, "samples": sum(self.stacks.values()),
+                       "cprofile": self._profiling}, f, indent=2)
+        return path
@@ -1,71 +1,117 @@
 import argparse
+import heapq
+import itertools
 import json
+from operator import itemgetter
 
+# the default number of results for each id
+NUM_RES = 20
 
-def write_best_prob_genotype(name_gl, res, fout, numOfResult=10):
-    sorted_by_value = sorted(res.items(), key=lambda kv: kv[1], reverse=True)
 
+def best_prob_genotypes(res, numOfResult=10):
+    # heapq.nlargest keeps the order of sorted(reverse=True) for equal probabilities, without sorting everything
+    best = heapq.nlargest(numOfResult, res.items(), key=itemgetter(1))
+    return [(key, prob, k) for k, (key, prob) in enumerate(best)]
+
+
+def write_best_prob_genotype(name_gl, res, fout, numOfResult=10):
     # write the output to file
-    minBestResult = min(numOfResult, len(sorted_by_value))
-    for k in range(minBestResult):
-        fout.write(name_gl + ',' + str(sorted_by_value[k][0]) + ',' +
-                   str(sorted_by_value[k][1]) + ',' + str(k) + '\n')
+    for gl, prob, k in best_prob_genotypes(res, numOfResult):
+        fout.write(name_gl + ',' + str(gl) + ',' +
+                   str(prob) + ',' + str(k) + '\n')
+
+
+def reduce_genotype(gl, loci):
+    full_gl = gl.split('^')
+    gl = []
+    for locus in full_gl:
+        if locus.split('*')[0] in loci:
+            gl.append(locus)
+    return '^'.join(sorted(gl))
+
+
+def reduce_haplotypes(hap1, hap2, loci):
+    haps = []
+    for hap in [hap1, hap2]:
+        hap = hap.split(';')[0]
+        hap = hap.split("~")
+        hap_tmp =[]
+        for locus in hap:
+            if locus.split('*')[0] in loci:
+                hap_tmp.append(locus)
+        haps.append(('~').join(sorted(hap_tmp)))
+
+    return ('+').join(sorted(haps))
+
+
+def group_by_id(rows):
+    """
+        Sums the probabilities of each key of a subject, one subject at a time.
+
+        The rows of a subject must be consecutive, as in the imputation output.
+
+        Parameters:
+        rows (Iterable[Tuple[str, str, float]]): (id, key, probability) rows, grouped by id.
+
+        Returns:
+        Iterator[Tuple[str, dict]]: The id and the summed probability of each key, for each subject.
+        """
+    for id, id_rows in itertools.groupby(rows, key=itemgetter(0)):
+        res = {}
+        for _, key, prob in id_rows:
+            res[key] = res.get(key, 0) + float(prob)
+        yield id, res
+
+
+def reduce_muug_rows(rows, loci, num_res):
+    """
+        Reduces imputed genotypes to the given loci, one subject at a time.
+
+        Parameters:
+        rows (Iterable[Tuple[str, str, float]]): (id, genotype, probability) rows, grouped by id.
+        loci (List[str]): The loci to keep.
+        num_res (int): The maximum number of results for each id.
+
+        Returns:
+        Iterator[Tuple[str, str, float, int]]: (id, reduced genotype, probability, rank) rows.
+        """
+    for id, res in group_by_id((id, reduce_genotype(gl, loci), prob) for id, gl, prob in rows):
+        for gl, prob, k in best_prob_genotypes(res, num_res):
+            yield id, gl, prob, k
+
+
+def reduce_haps_rows(rows, loci, num_res):
+    """
+        Reduces imputed haplotype pairs to the given loci, one subject at a time.
+
+        Parameters:
+        rows (Iterable[Tuple[str, str, str, float]]): (id, haplotype 1, haplotype 2, probability) rows, grouped by id.
+        loci (List[str]): The loci to keep.
+        num_res (int): The maximum number of results for each id.
+
+        Returns:
+        Iterator[Tuple[str, str, float, int]]: (id, reduced haplotype pair, probability, rank) rows.
+        """
+    for id, res in group_by_id((id, reduce_haplotypes(hap1, hap2, loci), prob) for id, hap1, hap2, prob in rows):
+        for haps, prob, k in best_prob_genotypes(res, num_res):
+            yield id, haps, prob, k
+
+
+def write_rows(rows, file_out):
+    with open(file_out, 'w') as f_out:
+        for id, key, prob, k in rows:
+            f_out.write(id + ',' + str(key) + ',' + str(prob) + ',' + str(k) + '\n')
+
 
 def reduce_muug_loci(file_in, file_out, loci, num_res):
-    dict_res = {}
     with open(file_in) as six_file:
-        for line in six_file:
-            id, gl, prob, rank = line.strip().split(',')
-            full_gl = gl.split('^')
-            gl = []
-            for locus in full_gl:
-                if locus.split('*')[0] in loci:
-                    gl.append(locus)
-            gl = '^'.join(sorted(gl))
-            if not id in dict_res:
-                dict_res[id] = {}
-            if gl in dict_res[id]:
-                dict_res[id][gl]+= float(prob)
-            else:
-                dict_res[id][gl] = float(prob)
-
-    six_file.close()
-
-    f_out = open(file_out, 'w')
-    for id in dict_res:
-        write_best_prob_genotype(id, dict_res[id], f_out, num_res)
-    f_out.close()
+        rows = (line.strip().split(',')[:3] for line in six_file)
+        write_rows(reduce_muug_rows(rows, loci, num_res), file_out)
 
 def reduce_haps_loci(file_in, file_out, loci, num_res):
-    dict_res = {}
     with open(file_in) as six_file:
-        for line in six_file:
-            id, hap1, hap2, prob, rank = line.strip().split(',')
-            haps = []
-            for hap in [hap1, hap2]:
-                hap = hap.split(';')[0]
-                hap = hap.split("~")
-                hap_tmp =[]
-                for locus in hap:
-                    if locus.split('*')[0] in loci:
-                        hap_tmp.append(locus)
-                haps.append(('~').join(sorted(hap_tmp)))
-
-
-            haps = ('+').join(sorted(haps))
-            if not id in dict_res:
-                dict_res[id] = {}
-            if haps in dict_res[id]:
-                dict_res[id][haps]+= float(prob)
-            else:
-                dict_res[id][haps] = float(prob)
-
-    six_file.close()
-
-    f_out = open(file_out, 'w')
-    for id in dict_res:
-        write_best_prob_genotype(id, dict_res[id], f_out, num_res)
-    f_out.close()
+        rows = (line.strip().split(',')[:4] for line in six_file)
+        write_rows(reduce_haps_rows(rows, loci, num_res), file_out)
 
 
 # parser = argparse.ArgumentParser()
@@ -75,9 +121,7 @@ def reduce_haps_loci(file_in, file_out, loci, num_res):
 #                     help="Configuration JSON file",
 #                     type=str)
 
-def reduce_loci(loci,  imputation_out_muug_freqs, imputation_out_hap_freqs):
-    num_res = 20
-
+def reduce_loci(loci,  imputation_out_muug_freqs, imputation_out_hap_freqs, num_res=NUM_RES):
     reduce_muug_loci(imputation_out_muug_freqs, (".").join(imputation_out_muug_freqs.split('.')[:-1]) + "_reduced.txt", loci, num_res)
     path_mug = (".").join(imputation_out_muug_freqs.split('.')[:-1]) + "_reduced.txt"
     output_file =(".").join(imputation_out_hap_freqs.split('.')[:-1])+ "_reduced.txt"
@@ -1,30 +1,46 @@
+import collections
 import json
+import multiprocessing
 import pathlib
+import shutil
 import sys
 import os
 import pickle
+import tempfile
+import threading
+import weakref
 
 sys.path.insert(0, os.path.join(".."))
 
+# grim puts its own directory first on sys.path as grim.grim is first imported, where its imputation package would
+# shadow imputation.py, here and in the processes of the pools (which start with the sys.path of this process), so it
+# is taken out again
+_sys_path = list(sys.path)
 from grim import grim
+from grim.imputation.impute import Imputation
+sys.path[:] = _sys_path
+
+from graph_store import load_graph
+from metrics import IMPUTATION_PLANS
+from columnar import check_format, to_columnar
 # grim.graph_freqs(configuration_file)
 
-def run_impute(
-        conf_file,
-        graph,
-        input_path,
-        output_haplotype_path,
-        output_genotype_path,
-        project_dir_graph="",
-        project_dir_in_file="",
-        hap_pop_pair=False,
-):
-    configuration_file = conf_file
 
-    # Read configuration file and load properties
-    with open(configuration_file) as f:
-        json_conf = json.load(f)
+def build_impute_config(json_conf, project_dir_graph="", project_dir_in_file=""):
+    """
+        Builds the grim imputation config dict from a parsed JSON configuration.
+
+        The input and output frequency file paths are left empty, they are set per request by
+        ImputationEngine.request_config.
 
+        Parameters:
+        json_conf (dict): The parsed JSON configuration file.
+        project_dir_graph (str): Prefix for the graph files paths.
+        project_dir_in_file (str): Prefix for the input files paths.
+
+        Returns:
+        dict: The config dict expected by grim.
+        """
     graph_files_path = json_conf.get("graph_files_path")
     if graph_files_path[-1] != '/':
         graph_files_path += '/'
@@ -44,12 +60,12 @@ def run_impute(
         "top_links_file": project_dir_graph + graph_files_path + json_conf.get("top_links_csv_file"),
         "edges_file": project_dir_graph + graph_files_path +json_conf.get("edges_csv_file"),
 
-        # We changed this line - input file path 
-        "imputation_input_file": input_path,
-        
-        # We changed this line - output files paths
-        "imputation_out_umug_freq_file": output_genotype_path,
-        "imputation_out_hap_freq_file": output_haplotype_path,
+        # Set per request - input file path
+        "imputation_input_file": "",
+
+        # Set per request - output files paths
+        "imputation_out_umug_freq_file": "",
+        "imputation_out_hap_freq_file": "",
 
         "imputation_out_umug_pops_file": output_dir + json_conf.get("imputation_out_umug_pops_filename"),
         "imputation_out_hap_pops_file": output_dir + json_conf.get("imputation_out_hap_pops_filename"),
@@ -81,12 +97,401 @@ def run_impute(
         all_loci_set.add(str(val))
 
     config["full_loci"] = ''.join(sorted(all_loci_set))
-    
-    # Perform imputation
-    imputation = grim.impute_instance(config, graph)
+    return config
+
+
+class PlanCountingImputation(Imputation):
+    """The grim imputation instance, counting the subjects it imputes by the plan that imputed them."""
+
+    __slots__ = ("plans",)
+
+    def __init__(self, net=None, config=None, count_by_prob=None, verbose=False):
+        super().__init__(net, config, count_by_prob, verbose)
+        self.plans = collections.Counter()
+
+    def impute_one(self, *args, **kwargs):
+        # impute_file imputes each subject with impute_one, which leaves the plan that imputed it in plan
+        result = super().impute_one(*args, **kwargs)
+        self.plans[self.plan] += 1
+        return result
+
+
+class ImputationEngine:
+    """
+        A resident imputation engine.
+
+        The configuration is parsed and the grim imputation instance (priority matrix, Plan A/B matrices and
+        population ratios) is built once, and then reused for every request. Per request values such as the
+        input/output paths are passed as overrides of the base config.
+        """
+
+    def __init__(self, conf_file, graph, project_dir_graph="", project_dir_in_file=""):
+        # Read configuration file and load properties
+        with open(conf_file) as f:
+            self.json_conf = json.load(f)
+
+        self.conf_file = conf_file
+        self.graph = graph
+        # the processes of the pool map a graph store themselves, see pool
+        self.graph_store = getattr(graph, "store_dir", None)
+        self.project_dirs = (project_dir_graph, project_dir_in_file)
+        self.config = build_impute_config(self.json_conf, project_dir_graph, project_dir_in_file)
+        self.output_dir = self.json_conf.get("imputation_out_path", "output")
+
+        # Create output directory if it doesn't exist
+        pathlib.Path(self.output_dir).mkdir(parents=False, exist_ok=True)
+
+        self.imputation = PlanCountingImputation(graph, self.config)
+        # the grim imputation instance keeps per subject state, so it imputes one request at a time
+        self.lock = threading.Lock()
+
+        # degree of parallelism for batch files, 0 for the cores of this process: its share of them under the pre-fork
+        # server (GRIMMARD_PROCESSES, see gunicorn.conf.py), or all of them
+        self.processes = self.json_conf.get("imputation_processes", 1) or \
+            int(os.environ.get("GRIMMARD_PROCESSES", 0)) or os.cpu_count()
+        self.chunk_size = self.json_conf.get("imputation_chunk_size", 1000)
+        self._pool = None
+        self._pool_pid = None
+
+    def request_config(self, **overrides):
+        """
+            Returns a copy of the base config with the given per request values.
+
+            Parameters:
+            overrides: grim config keys and their values for this request.
+
+            Returns:
+            dict: The config dict for the request.
+            """
+        config = dict(self.config)
+        for key, val in overrides.items():
+            if key not in config:
+                raise KeyError(f"Unknown imputation config key: {key}")
+            config[key] = val
+        return config
+
+    def impute_file(self, input_path, output_haplotype_path, output_genotype_path, hap_pop_pair=False,
+                    **overrides):
+        """
+            Imputes the subjects in the given input file and writes the results to the given output paths.
+
+            Parameters:
+            input_path (str): The path to the imputation input file.
+            output_haplotype_path (str): The path to the haplotypes output file.
+            output_genotype_path (str): The path to the genotypes output file.
+            hap_pop_pair (bool): True to write the haplotype pairs with their populations.
+            overrides: Other grim config keys to override for this request.
+
+            Returns:
+            dict: The config dict that was used.
+            """
+        with self.lock:
+            return self._impute_file(input_path, output_haplotype_path, output_genotype_path, hap_pop_pair,
+                                     **overrides)
+
+    def _impute_file(self, input_path, output_haplotype_path, output_genotype_path, hap_pop_pair=False,
+                     **overrides):
+        config = self.request_config(imputation_input_file=input_path,
+                                     imputation_out_hap_freq_file=output_haplotype_path,
+                                     imputation_out_umug_freq_file=output_genotype_path,
+                                     **overrides)
+
+        # Write out the results from imputation
+        self.imputation.impute_file(config, em_mr=hap_pop_pair)
+        return config
+
+    def pool(self):
+        """
+            Returns the pool of processes that impute the chunks of files. It is started on the first call, and reused
+            by the following ones.
+
+            The processes of an engine of a graph store are started by a fork server, a process of a single thread, as
+            a fork of this process could copy a lock that another thread holds (e.g. of the warm-up, the reload or the
+            requests). Each one maps the graph store and builds its own engine. The processes of an engine of another
+            graph (e.g. unpickled) are forked from this process, so they share the loaded graph.
+
+            The pre-fork server starts it as each worker is forked (see gunicorn.conf.py). The processes are stopped
+            with the engine, e.g. when a new version of the artifacts is active.
+
+            Returns:
+            multiprocessing.pool.Pool: The pool.
+            """
+        with _pool_lock:
+            # a pool of the process this one was forked from is not of this process
+            if self._pool is None or self._pool_pid != os.getpid():
+                if self.graph_store:
+                    context = multiprocessing.get_context("forkserver")
+                    # the fork server imports the modules of the engine once, not the main module (e.g. app.py)
+                    context.set_forkserver_preload(["runfile"])
+                    initializer = _load_pool_engine
+                    initargs = (self.conf_file, self.graph_store) + self.project_dirs
+                else:
+                    context = multiprocessing.get_context("fork")
+                    # the workers are given a weak reference, so the pool does not keep the engine alive
+                    initializer, initargs = _init_pool_worker, (weakref.ref(self),)
+                self._pool = context.Pool(self.processes, initializer=initializer, initargs=initargs)
+                self._pool_pid = os.getpid()
+                weakref.finalize(self, _stop_pool, self._pool, self._pool_pid)
+            return self._pool
+
+    def impute_file_parallel(self, input_path, output_haplotype_path, output_genotype_path, hap_pop_pair=False,
+                             chunk_size=None, progress=None, **overrides):
+        """
+            Imputes the subjects in the given input file in chunks across a pool of processes, and writes the
+            merged results to the given output paths, in the order of the input file.
+
+            The chunks are imputed in the pool of the engine (see pool), even a file of a single chunk, so files do not
+            hold the lock of the grim imputation instance of this process, that impute_one uses.
+
+            Parameters:
+            input_path (str): The path to the imputation input file.
+            output_haplotype_path (str): The path to the haplotypes output file.
+            output_genotype_path (str): The path to the genotypes output file.
+            hap_pop_pair (bool): True to write the haplotype pairs with their populations.
+            chunk_size (int): The number of subjects in a chunk, defaults to the imputation_chunk_size configuration.
+            progress (Callable[[int, int], None]): Called with the number of imputed subjects and the total number
+            of subjects after each chunk.
+            overrides: Other grim config keys to override for this request.
+
+            Returns:
+            dict: The config dict of the merged outputs.
+            """
+        chunk_size = chunk_size or self.chunk_size
+        config = self.request_config(imputation_input_file=input_path,
+                                     imputation_out_hap_freq_file=output_haplotype_path,
+                                     imputation_out_umug_freq_file=output_genotype_path,
+                                     **overrides)
+
+        with tempfile.TemporaryDirectory() as chunks_dir:
+            chunks = split_to_chunks(input_path, chunks_dir, chunk_size)
+            if not chunks:
+                # nothing to impute, grim writes the outputs of the empty file
+                return self.impute_file(input_path, output_haplotype_path, output_genotype_path,
+                                        hap_pop_pair=hap_pop_pair, **overrides)
+
+            tasks = [(chunk_path, hap_pop_pair, overrides) for chunk_path, _, _ in chunks]
+            chunk_configs = self._impute_chunks(self.pool().imap(_impute_chunk, tasks), chunks, progress)
+
+            # merge the chunks in the order of the input file
+            for key in CHUNK_OUTPUT_KEYS:
+                offsets = [start for _, start, _ in chunks] if key in INDEXED_OUTPUT_KEYS else None
+                merge_chunks([chunk_config[key] for chunk_config in chunk_configs], config[key], offsets)
+        return config
 
-    # Create output directory if it doesn't exist
-    pathlib.Path(output_dir).mkdir(parents=False, exist_ok=True)
+    def impute_chunks(self, chunk_paths, hap_pop_pair=False, **overrides):
+        """
+            Imputes chunk files, as they are produced, in the pool of the engine (see pool), and yields the config of each
+            imputed chunk in order, as soon as it and the chunks before it are done.
 
-    # Write out the results from imputation
-    imputation.impute_file(config, em_mr=hap_pop_pair)
+            The outputs of each chunk are written next to it, see chunk_outputs.
+
+            Parameters:
+            chunk_paths (Iterable[str]): The paths of the chunks, e.g. a generator that writes them.
+            hap_pop_pair (bool): True to write the haplotype pairs with their populations.
+            overrides: Other grim config keys to override for this request.
+
+            Returns:
+            Iterator[dict]: The config of each chunk, with the paths of its outputs.
+            """
+        pool = self.pool()
+        # at most two chunks per process are queued ahead of the one that is yielded next
+        pending = collections.deque()
+        for chunk_path in chunk_paths:
+            pending.append(pool.apply_async(_impute_chunk, ((chunk_path, hap_pop_pair, overrides),)))
+            while pending and (pending[0].ready() or len(pending) >= 2 * self.processes):
+                yield _count_plans(*pending.popleft().get())
+        while pending:
+            yield _count_plans(*pending.popleft().get())
+
+    @staticmethod
+    def _impute_chunks(results, chunks, progress):
+        # collect the configs of the imputed chunks in order, reporting the progress after each one
+        chunk_configs = []
+        done = 0
+        total = sum(size for _, _, size in chunks)
+        for (chunk_config, plans), (_, _, size) in zip(results, chunks):
+            chunk_configs.append(_count_plans(chunk_config, plans))
+            done += size
+            if progress:
+                progress(done, total)
+        return chunk_configs
+
+    def impute_one(self, subject_id, gl, race1=None, race2=None, **overrides):
+        """
+            Imputes a single subject in memory, without any input or output files.
+
+            Parameters:
+            subject_id (str): The id of the subject.
+            gl (str): The GL string of the subject.
+            race1 (str): The race of the first haplotype.
+            race2 (str): The race of the second haplotype.
+            overrides: Other grim config keys to override for this request.
+
+            Returns:
+            tuple[dict, dict]: The genotypes and haplotypes results of grim, or (None, None) if the subject
+            could not be imputed.
+            """
+        config = self.request_config(**overrides)
+        subject_bin = [1] * (len(config["full_loci"]) - 1)
+
+        with self.lock:
+            self.imputation.plan = "a"
+            self.imputation.option_1 = 0
+            self.imputation.option_2 = 0
+            try:
+                _, res_muugs, res_haps = self.imputation.impute_one(
+                    subject_id, gl, subject_bin, race1, race2, config["priority"], config["epsilon"], 1000,
+                    config["output_MUUG"], config["output_haplotypes"], config["planb"], False)
+            except Exception:
+                print(f"Subject: {subject_id} - Exception")
+                return None, None
+            IMPUTATION_PLANS.inc(plan=self.imputation.plan)
+        return res_muugs, res_haps
+
+
+# the outputs of each chunk, and those of them whose lines start with the index of the subject in the input file
+CHUNK_OUTPUT_KEYS = ("imputation_out_umug_freq_file", "imputation_out_hap_freq_file", "imputation_out_umug_pops_file",
+                     "imputation_out_hap_pops_file", "imputation_out_miss_file", "imputation_out_problem_file")
+INDEXED_OUTPUT_KEYS = ("imputation_out_miss_file", "imputation_out_problem_file")
+
+# the engine of the pool workers, and the lock of the starts of the pools
+_pool_engine = None
+_pool_lock = threading.Lock()
+
+
+def side_outputs(input_path):
+    """
+        Returns the config overrides that write the populations, missing and problem outputs of grim next to the
+        given input file, instead of to the shared imputation_out_path, so concurrent requests do not overwrite
+        each other's.
+
+        Parameters:
+        input_path (str): The path to the imputation input file.
+
+        Returns:
+        dict: The grim config keys of the outputs and their paths.
+        """
+    prefix = os.path.splitext(input_path)[0]
+    return {key: f"{prefix}.{key}" for key in CHUNK_OUTPUT_KEYS[2:]}
+
+
+def chunk_outputs(chunk_path, overrides):
+    # the haplotypes, genotypes and the other outputs of a chunk are written next to it, they are merged to the
+    # outputs of the request (see merge_chunks)
+    prefix = os.path.splitext(chunk_path)[0]
+    return f"{prefix}.hap", f"{prefix}.geno", dict(overrides, **side_outputs(chunk_path))
+
+
+def _init_pool_worker(engine_ref):
+    global _pool_engine
+    _pool_engine = engine_ref()
+
+
+def _load_pool_engine(conf_file, graph_store, project_dir_graph, project_dir_in_file):
+    global _pool_engine
+    _pool_engine = ImputationEngine(conf_file, load_graph(graph_store), project_dir_graph, project_dir_in_file)
+
+
+def _stop_pool(pool, pid):
+    # only the process that started the pool stops it, not a process forked from it
+    if os.getpid() == pid:
+        pool.terminate()
+
+
+def _impute_chunk(task):
+    chunk_path, hap_pop_pair, overrides = task
+    hap_path, geno_path, chunk_overrides = chunk_outputs(chunk_path, overrides)
+    # This process is the only user of its engine, so the chunk is imputed without the engine lock (that a forked
+    # copy of the engine may have been given held by another thread). The plans of the subjects are returned, the
+    # metrics of this process are not those the server exposes.
+    plans = _pool_engine.imputation.plans
+    plans.clear()
+    config = _pool_engine._impute_file(chunk_path, hap_path, geno_path, hap_pop_pair=hap_pop_pair, **chunk_overrides)
+    return config, dict(plans)
+
+
+def _count_plans(chunk_config, plans):
+    # the plans of the subjects of a chunk imputed in the pool, counted in this process
+    for plan, count in plans.items():
+        IMPUTATION_PLANS.inc(count, plan=plan)
+    return chunk_config
+
+
+def split_to_chunks(input_path, chunks_dir, chunk_size):
+    """
+        Splits an imputation input file to files of chunk_size lines.
+
+        Parameters:
+        input_path (str): The path to the imputation input file.
+        chunks_dir (str): The directory to write the chunks to.
+        chunk_size (int): The number of lines in a chunk.
+
+        Returns:
+        List[Tuple[str, int, int]]: The path of each chunk, the index of its first line in the input file and its
+        number of lines.
+        """
+    chunks = []
+    f_out = None
+    with open(input_path) as f:
+        for i, line in enumerate(f):
+            if i % chunk_size == 0:
+                if f_out:
+                    f_out.close()
+                chunk_path = os.path.join(chunks_dir, f"chunk{len(chunks)}.csv")
+                chunks.append([chunk_path, i, 0])
+                f_out = open(chunk_path, "w")
+            f_out.write(line)
+            chunks[-1][2] += 1
+    if f_out:
+        f_out.close()
+    return [tuple(chunk) for chunk in chunks]
+
+
+def merge_chunks(chunk_paths, output_path, offsets=None):
+    """
+        Concatenates the outputs of the chunks to one file.
+
+        Parameters:
+        chunk_paths (List[str]): The output paths of the chunks, in order.
+        output_path (str): The merged output path.
+        offsets (List[int]): If given, the index of the first subject of each chunk, that is added to the
+        subject index at the start of the lines ('index,subject_id').
+
+        Returns:
+        None
+        """
+    chunk_paths = [(i, path) for i, path in enumerate(chunk_paths) if os.path.exists(path)]
+    if not chunk_paths:
+        return
+    with open(output_path, "w") as f_out:
+        for i, path in chunk_paths:
+            with open(path) as f:
+                if offsets is None:
+                    shutil.copyfileobj(f, f_out)
+                    continue
+                for line in f:
+                    index, sep, rest = line.partition(",")
+                    if index.isdigit() and rest.count(",") == 0:
+                        line = f"{int(index) + offsets[i]}{sep}{rest}"
+                    f_out.write(line)
+
+
+def run_impute(
+        conf_file,
+        graph,
+        input_path,
+        output_haplotype_path,
+        output_genotype_path,
+        project_dir_graph="",
+        project_dir_in_file="",
+        hap_pop_pair=False,
+        output_format="csv",
+):
+    check_format(output_format)
+    if output_format == "npz" and hap_pop_pair:
+        raise ValueError("The haplotype pairs with their populations have no columnar format")
+    engine = ImputationEngine(conf_file, graph, project_dir_graph, project_dir_in_file)
+    engine.impute_file(input_path, output_haplotype_path, output_genotype_path, hap_pop_pair=hap_pop_pair)
+    if output_format == "npz":
+        # written next to the CSV outputs, as .npz files
+        to_columnar(output_genotype_path, output_haplotype_path)
@@ -0,0 +1,56 @@
+"""
+The warm-up of the application: the phases that load what the requests need, timed, in the foreground or in the
+background while the server already answers the health checks.
+"""
+import threading
+import time
+import traceback
+
+
+class WarmUp:
+    """
+        Runs the warm-up phases in order, and reports whether they are all done.
+
+        Parameters:
+        phases (List[tuple[str, Callable[[], None]]]): The name and the function of each phase.
+        """
+
+    def __init__(self, phases):
+        self.phases = phases
+        self.ready = threading.Event()
+        self.phase = None
+        self.timings = {}
+        self.error = None
+        self.started_at = None
+
+    def start(self, background=False):
+        """Runs the phases, in a background thread if background, and returns at once."""
+        if background:
+            threading.Thread(target=self.run, name="warm-up", daemon=True).start()
+        else:
+            self.run()
+        return self
+
+    def run(self):
+        self.started_at = time.time()
+        start = time.perf_counter()
+        for name, phase in self.phases:
+            self.phase = name
+            phase_start = time.perf_counter()
+            try:
+                phase()
+            except (Exception, SystemExit) as e:
+                # (py-ard exits when it cannot download its data, that would end the background thread silently)
+                traceback.print_exc()
+                self.error = f"{name}: {e}"
+                print(f"Warm-up failed in {name} after {time.perf_counter() - phase_start:.2f}s")
+                return
+            self.timings[name] = time.perf_counter() - phase_start
+            print(f"Warm-up: {name} took {self.timings[name]:.2f}s")
+        self.phase = None
+        print(f"Warm-up done in {time.perf_counter() - start:.2f}s, ready")
+        self.ready.set()
+
+    def status(self):
+        return dict(ready=self.ready.is_set(), phase=self.phase, timings=dict(self.timings), error=self.error,
+                    started_at=self.started_at)
@@ -0,0 +1,154 @@
+"""
+Generates synthetic donors, with realistic typings, from the haplotype frequencies of the populations.
+
+Each donor is a pair of haplotypes drawn by their frequency in the populations of data/freq_9loci, from one population
+or, for a multi-race donor, one haplotype from each of two populations ('AFA;CAU'). The typing is then degraded as
+typings come in: some alleles are given as their first field only (':XX'), some loci are not typed, and the DRB3/4/5
+locus is typed only when both haplotypes carry the same gene.
+
+The donors are written in the upload file format (id,GL string,race1,race2) or as the fields of /impute-form. From the
+app directory:
+    python3 synthetic_donors.py --donors 1000 --output donors.csv [--seed 1] [--multi-race 0.1]
+"""
+import argparse
+import os
+import random
+
+from build_freqs import read_freq_file
+
+FREQ_DATA_DIR = "data/freq_9loci"
+# the loci that are always typed
+REQUIRED_LOCI = ["A", "B", "DRB1"]
+# the /impute-form fields of each locus
+FORM_FIELDS = {
+    "A": ("A1", "A2"),
+    "B": ("B1", "B2"),
+    "C": ("C1", "C2"),
+    "DRB1": ("DRB1_1", "DRB1_2"),
+    "DQB1": ("DQB1_1", "DQB1_2"),
+    "DQA1": ("DQA1_1", "DQA1_2"),
+    "DPA1": ("DPA1_1", "DPA1_2"),
+    "DPB1": ("DPB1_1", "DPB1_2"),
+    "DRB3": ("DRB3_1", "DRB3_2"),
+    "DRB4": ("DRB4_1", "DRB4_2"),
+    "DRB5": ("DRB5_1", "DRB5_2"),
+}
+
+
+def load_haplotypes(populations, freq_data_dir=FREQ_DATA_DIR):
+    """
+        Loads the haplotypes of the populations with their frequencies.
+
+        Parameters:
+        populations (List[str]): The populations.
+        freq_data_dir (str): The directory of the frequency files, <pop>.freqs.gz.
+
+        Returns:
+        dict: The haplotypes (lists of alleles) and their frequencies, by population.
+        """
+    haplotypes = {}
+    for pop in populations:
+        rows = [(haplotype.split("~"), freq)
+                for haplotype, _, freq in read_freq_file(os.path.join(freq_data_dir, f"{pop}.freqs.gz")) if freq > 0]
+        haplotypes[pop] = ([haplotype for haplotype, _ in rows], [freq for _, freq in rows])
+    return haplotypes
+
+
+def degrade_allele(allele, rng, low_resolution=0.0):
+    """Returns the allele as typed, its first field only (e.g. A*02:XX) with probability low_resolution."""
+    locus, name = allele.split("*")
+    if rng.random() < low_resolution:
+        return f"{locus}*{name.split(':')[0]}:XX"
+    return allele
+
+
+def generate_donors(n, haplotypes, seed=1, multi_race=0.0, low_resolution=0.0, missing_locus=0.0):
+    """
+        Generates synthetic donors.
+
+        Parameters:
+        n (int): The number of donors.
+        haplotypes (dict): The haplotypes of the populations, see load_haplotypes.
+        seed (int): The random seed, the same seed generates the same donors.
+        multi_race (float): The fraction of donors whose haplotypes come from two populations.
+        low_resolution (float): The fraction of alleles typed by their first field only.
+        missing_locus (float): The probability that a locus other than A, B and DRB1 is not typed.
+
+        Returns:
+        Iterator[dict]: The id, races and typing of each donor. The typing is a list of (locus, allele1, allele2),
+        in the order of the frequency files.
+        """
+    rng = random.Random(seed)
+    populations = list(haplotypes)
+    for i in range(n):
+        pop1 = rng.choice(populations)
+        pop2 = rng.choice([pop for pop in populations if pop != pop1] or populations) \
+            if rng.random() < multi_race else pop1
+        hap1 = rng.choices(haplotypes[pop1][0], weights=haplotypes[pop1][1])[0]
+        hap2 = rng.choices(haplotypes[pop2][0], weights=haplotypes[pop2][1])[0]
+
+        typing = []
+        for allele1, allele2 in zip(hap1, hap2):
+            locus = allele1.split("*")[0]
+            # the DRB3/4/5 position holds different genes in different haplotypes
+            if locus != allele2.split("*")[0] or "NNNN" in allele1 + allele2:
+                continue
+            if locus not in REQUIRED_LOCI and rng.random() < missing_locus:
+                continue
+            typing.append((locus, degrade_allele(allele1, rng, low_resolution),
+                           degrade_allele(allele2, rng, low_resolution)))
+
+        race = pop1 if pop1 == pop2 else f"{pop1};{pop2}"
+        yield {"id": f"D{i + 1}", "race1": race, "race2": race, "typing": typing}
+
+
+def to_glstring(donor):
+    """Returns the GL string of a donor."""
+    return "^".join(f"{allele1}+{allele2}" for _, allele1, allele2 in donor["typing"])
+
+
+def to_csv_line(donor):
+    """Returns the line of a donor in the upload file format."""
+    return f"{donor['id']},{to_glstring(donor)},{donor['race1']},{donor['race2']}"
+
+
+def to_form(donor, glstring=True):
+    """
+        Returns the /impute-form fields of a donor.
+
+        Parameters:
+        donor (dict): The donor, see generate_donors.
+        glstring (bool): True to send the GL string, False to send the allele of each field.
+
+        Returns:
+        dict: The form fields.
+        """
+    form = {"race": f"{donor['race1']};", "luci": ";".join(locus for locus, _, _ in donor["typing"]) + ";"}
+    if glstring:
+        form["glstring"] = to_glstring(donor)
+    else:
+        for locus, allele1, allele2 in donor["typing"]:
+            if locus in FORM_FIELDS:
+                form[FORM_FIELDS[locus][0]], form[FORM_FIELDS[locus][1]] = allele1, allele2
+    return form
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic donors from the haplotype frequencies.")
+    parser.add_argument("-n", "--donors", default=1000, help="Number of donors", type=int)
+    parser.add_argument("-o", "--output", default="donors.csv", help="Output file, in the upload file format",
+                        type=str)
+    parser.add_argument("-p", "--populations", default="AFA,CAU", help="Comma separated populations", type=str)
+    parser.add_argument("-d", "--freq-data-dir", default=FREQ_DATA_DIR, help="Frequency files directory", type=str)
+    parser.add_argument("-s", "--seed", default=1, help="Random seed", type=int)
+    parser.add_argument("--multi-race", default=0.1, help="Fraction of multi-race donors", type=float)
+    parser.add_argument("--low-resolution", default=0.1, help="Fraction of alleles typed as :XX", type=float)
+    parser.add_argument("--missing-locus", default=0.2, help="Probability of a locus not being typed", type=float)
+    args = parser.parse_args()
+
+    haps = load_haplotypes(args.populations.split(","), args.freq_data_dir)
+    with open(args.output, "w") as f:
+        for synthetic_donor in generate_donors(args.donors, haps, args.seed, args.multi_race, args.low_resolution,
+                                               args.missing_locus):
+            f.write(to_csv_line(synthetic_donor) + "\n")
+    print(f"Saved {args.donors} donors to {args.output}")
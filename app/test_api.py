@@ -0,0 +1,72 @@
+"""
+Tests of the JSON batch imputation API, /api/v1/impute.
+"""
+import gzip
+import json
+
+import imputation
+
+GL = "A*02:05+A*29:01^B*15:03+B*40:06^DRB1*08:04+DRB1*15:01"
+
+
+def post(client, subjects, **kwargs):
+    return client.post("/api/v1/impute", json=subjects, **kwargs)
+
+
+def test_batch(client):
+    response = post(client, [
+        {"id": "donor1", "glstring": GL, "race": ["CAU"], "loci": ["A", "B"], "num_results": 3},
+        {"glstring": GL, "race": "CAU", "loci": "A;B;DRB1"},
+        {"race": "CAU"},
+        "A*02:05+A*29:01",
+    ])
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["version"] == response.headers["X-Grimmard-Version"]
+    first, second, missing, not_an_object = body["results"]
+
+    # the results of each subject are those of the imputation of its GL string, the most probable first
+    reduced_genos, reduced_haps = imputation.impute_ard_rows(GL, "CAU", ["A", "B"], num_res=3)
+    assert first["id"] == "donor1"
+    assert (first["glstring"], first["ard_string"]) == (GL, GL)
+    assert first["genotypes"] == [[genotype, prob] for _, genotype, prob, _ in reduced_genos]
+    assert first["haplotype_pairs"] == [haps.split("+") + [prob] for _, haps, prob, _ in reduced_haps]
+    assert 0 < len(first["genotypes"]) <= 3
+    assert all(genotype.count("^") == 1 for genotype, _ in first["genotypes"])
+
+    assert second["id"] == "2"
+    assert all(genotype.count("^") == 2 for genotype, _ in second["genotypes"])
+    probs = [prob for _, prob in second["genotypes"]]
+    assert probs == sorted(probs, reverse=True)
+
+    assert missing == {"id": "3", "error": "Expected a glstring or alleles"}
+    assert not_an_object == {"id": "4", "error": "Expected a JSON object"}
+
+
+def test_gzip(client):
+    body = gzip.compress(json.dumps([{"glstring": GL, "race": "CAU"}] * 5).encode())
+    response = client.post("/api/v1/impute", data=body, content_type="application/json",
+                           headers={"Content-Encoding": "gzip", "Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    results = json.loads(gzip.decompress(response.get_data()))["results"]
+    assert [result["id"] for result in results] == ["1", "2", "3", "4", "5"]
+    assert all(result["genotypes"] == results[0]["genotypes"] for result in results)
+
+    # not compressed for a client that does not accept it
+    response = post(client, [{"glstring": GL, "race": "CAU"}])
+    assert "Content-Encoding" not in response.headers
+
+
+def test_bad_requests(client, monkeypatch):
+    response = client.post("/api/v1/impute", data="[{", content_type="application/json")
+    assert response.status_code == 400
+    assert response.get_json()["error"].startswith("Invalid JSON body")
+
+    response = post(client, {"glstring": GL})
+    assert (response.status_code, response.get_json()) == (400, {"error": "Expected a JSON array of subjects"})
+
+    monkeypatch.setitem(imputation.get_artifacts().engine.json_conf, "api_max_subjects", 2)
+    response = post(client, [{"glstring": GL}] * 3)
+    assert (response.status_code, response.get_json()) == (413, {"error": "At most 2 subjects per request, got 3"})
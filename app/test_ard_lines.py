@@ -0,0 +1,65 @@
+"""
+Tests of the reduction of uploaded files, see write_ard_lines in imputation.py: the lines are reduced one at a time,
+and the malformed ones are skipped and reported.
+"""
+import pytest
+
+import imputation
+from ard_table import ReductionTable
+from test_ard_table import TwoFieldARD
+
+LINES = [
+    "D1,A*02:01:01+A*01:01:01^B*07:02:01+B*08:01:01,CAU,CAU\n",
+    "\n",
+    "D2,A*02:01:01+A*01:01:01,CAU\n",
+    "D3,A*02:01:01+A*01:01:01^B*07:02:01+B*08:01:01,AFA,CAU,extra\n",
+    "D4,garbage,CAU,CAU\n",
+    "D5,A*03:01:01+A*03:01:02,AFA,AFA\r\n",
+]
+
+
+@pytest.fixture(autouse=True)
+def ard_table(monkeypatch):
+    table = ReductionTable(TwoFieldARD())
+    monkeypatch.setattr(imputation, "get_ard_table", lambda: table)
+    return table
+
+
+def test_malformed_lines_are_skipped_and_reported(tmp_path):
+    output_path, errors_path = tmp_path / "input.csv", tmp_path / "errors.csv"
+    assert imputation.write_ard_lines(iter(LINES), str(output_path), str(errors_path)) == 3
+
+    assert output_path.read_text() == ("D1,A*01:01+A*02:01^B*07:02+B*08:01,CAU,CAU\n"
+                                       "D5,A*03:01+A*03:01,AFA,AFA\n")
+    errors = [line.split(",", 1) for line in errors_path.read_text().splitlines()]
+    assert [line_number for line_number, _ in errors] == ["3", "4", "5"]
+    assert errors[0][1] == "Expected 4 fields (id,glstring,race1,race2), found 3"
+    assert errors[1][1] == "Expected 4 fields (id,glstring,race1,race2), found 5"
+
+
+def test_no_errors_file_without_malformed_lines(tmp_path):
+    output_path, errors_path = tmp_path / "input.csv", tmp_path / "errors.csv"
+    assert imputation.write_ard_lines([LINES[0], LINES[-1]], str(output_path), str(errors_path)) == 0
+    assert len(output_path.read_text().splitlines()) == 2
+    assert not errors_path.exists()
+
+
+def test_lines_are_reduced_as_they_are_read():
+    read = []
+
+    def lines():
+        for line in LINES:
+            read.append(line)
+            yield line
+
+    reduced = imputation.apply_ard_on_lines(lines(), on_error=lambda *args: None)
+    assert next(reduced) == "D1,A*01:01+A*02:01^B*07:02+B*08:01,CAU,CAU\n"
+    assert read == LINES[:1]
+
+
+def test_apply_ard_on_file_replaces_the_file(tmp_path):
+    path = tmp_path / "input.csv"
+    path.write_text("".join(LINES))
+    assert imputation.apply_ard_on_file(str(path)) == 3
+    assert path.read_text().splitlines() == ["D1,A*01:01+A*02:01^B*07:02+B*08:01,CAU,CAU", "D5,A*03:01+A*03:01,AFA,AFA"]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["input.csv"]
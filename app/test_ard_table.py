@@ -0,0 +1,62 @@
+"""
+Tests of the allele reduction table, see ard_table.py.
+"""
+import os
+
+import pytest
+
+from ard_table import ReductionTable
+from build_freqs import read_freq_file
+
+
+@pytest.fixture(scope="module")
+def ard():
+    pyard = pytest.importorskip("pyard")
+    try:
+        return pyard.init()
+    except (Exception, SystemExit) as e:
+        # py-ard exits when it cannot download its data
+        pytest.skip(f"py-ard data is not available: {e}")
+
+
+def test_reduction_table_matches_ard(ard, example_graph):
+    _, conf, _ = example_graph
+    haplotypes = [haplotype.split("~") for haplotype, _, _ in
+                  read_freq_file(os.path.join(conf["freq_data_dir"], f"{conf['populations'][0]}.freqs.gz"))][:40]
+    glstrings = []
+    for hap1, hap2, hap3 in zip(haplotypes, haplotypes[1:], haplotypes[2:]):
+        # genotypes of two haplotypes, with an ambiguity of a third one at the first locus
+        loci = ["+".join(sorted(alleles)) for alleles in zip(hap1, hap2) if "NNNN" not in "".join(alleles)]
+        loci[0] += f"/{hap3[0]}"
+        glstrings.append("^".join(loci))
+
+    table = ReductionTable(ard)
+    table.build({allele for haplotype in haplotypes[:20] for allele in haplotype})
+    for glstring in glstrings:
+        assert table.reduce(glstring) == ard.redux(glstring, "lgx"), glstring
+
+
+
+class TwoFieldARD:
+    """Reduces the alleles to their first two fields, and records the alleles it was asked to."""
+
+    def __init__(self):
+        self.calls = []
+
+    def redux(self, allele, redux_type):
+        self.calls.append(allele)
+        name, fields = allele.split("*")
+        return f"{name}*{':'.join(fields.split(':')[:2])}"
+
+
+def test_reduction_table_reduces_each_allele_once():
+    ard = TwoFieldARD()
+    table = ReductionTable(ard)
+    assert table.build(["A*02:01:01", "A*02:01:02", "B*07:02:01"]) == 3
+
+    # the alleles of an ambiguity that reduce to the same allele are merged, the genotypes sorted
+    assert table.reduce("A*02:01:01/A*02:01:02+A*01:01:01^B*07:02:01+B*07:02:01") == \
+        "A*01:01+A*02:01^B*07:02+B*07:02"
+    assert table.reduce("A*01:01:01+A*03:01:01") == "A*01:01+A*03:01"
+    # only the alleles that are not in the table are reduced by py-ard, once
+    assert ard.calls == ["A*02:01:01", "A*02:01:02", "B*07:02:01", "A*01:01:01", "A*03:01:01"]
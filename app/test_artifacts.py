@@ -0,0 +1,134 @@
+"""
+Tests of the hot reload of the artifacts, see artifacts.py, and of the pinning of a version to a request, see
+pin_artifacts in imputation.py.
+"""
+import threading
+import time
+
+import pytest
+
+import imputation
+from artifacts import Artifacts, ArtifactManager
+
+
+class Files:
+    """The version of the files on disk, and the loads of the manager."""
+
+    def __init__(self):
+        self.version = "v1"
+        self.loads = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def load(self, version):
+        self.loads.append(version)
+        self.release.wait(10)
+        if version.startswith("bad"):
+            raise ValueError("the graph does not match the configuration")
+        return Artifacts(version, engine=f"engine {version}")
+
+
+def wait_loaded(manager, timeout=10):
+    end = time.time() + timeout
+    while manager.status()["loading"]:
+        if time.time() > end:
+            pytest.fail("still loading")
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def files():
+    return Files()
+
+
+@pytest.fixture
+def manager(files):
+    return ArtifactManager(files.load, lambda: files.version, poll_interval=lambda artifacts: 0)
+
+
+def test_loaded_once(manager, files):
+    assert manager.active.version == "v1"
+    assert manager.active is manager.active
+    assert files.loads == ["v1"]
+    assert manager.reload() is False
+    assert files.loads == ["v1"]
+
+
+def test_reload_swaps_the_version(manager, files):
+    old = manager.active
+    files.version = "v2"
+    files.release.clear()
+    assert manager.reload() is True
+    # the active version keeps serving while the new one loads
+    assert manager.active is old
+    assert manager.status()["loading"]
+    assert manager.reload() is True
+
+    files.release.set()
+    wait_loaded(manager)
+    assert manager.active.version == "v2"
+    assert files.loads == ["v1", "v2"]
+
+
+def test_failed_reload_keeps_the_version(manager, files):
+    old = manager.active
+    files.version = "bad1"
+    manager.reload()
+    wait_loaded(manager)
+    assert manager.active is old
+    assert "bad1" in manager.status()["last_error"]
+
+    # not tried again until the files change
+    assert manager.reload() is False
+    files.version = "v2"
+    manager.reload()
+    wait_loaded(manager)
+    assert manager.active.version == "v2"
+    assert manager.status()["last_error"] is None
+    assert files.loads == ["v1", "bad1", "v2"]
+
+
+def test_check_for_update_polls_at_most_every_interval(files):
+    intervals = {"v1": 3600}
+    manager = ArtifactManager(files.load, lambda: files.version,
+                              poll_interval=lambda artifacts: intervals.get(artifacts.version, 0))
+    manager.active
+    files.version = "v2"
+    assert manager.check_for_update() is False
+    assert manager.active.version == "v1"
+
+    intervals["v1"] = 0.01
+    time.sleep(0.02)
+    assert manager.check_for_update() is True
+    wait_loaded(manager)
+    assert manager.active.version == "v2"
+
+
+def test_a_pinned_request_keeps_its_version(manager, files, monkeypatch):
+    monkeypatch.setattr(imputation, "artifact_manager", manager)
+    pinned, reloaded, done = threading.Event(), threading.Event(), threading.Event()
+    seen = []
+
+    def request():
+        imputation.pin_artifacts()
+        try:
+            pinned.set()
+            reloaded.wait(10)
+            seen.append(imputation.get_artifacts().version)
+        finally:
+            imputation.unpin_artifacts()
+        seen.append(imputation.get_artifacts().version)
+        done.set()
+
+    threading.Thread(target=request).start()
+    assert pinned.wait(10)
+    files.version = "v2"
+    manager.reload()
+    wait_loaded(manager)
+    # a new request, in another thread, gets the new version
+    assert imputation.pin_artifacts().version == "v2"
+    imputation.unpin_artifacts()
+    reloaded.set()
+
+    assert done.wait(10)
+    assert seen == ["v1", "v2"]
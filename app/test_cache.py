@@ -0,0 +1,76 @@
+"""
+Tests of the result cache, see cache.py.
+"""
+import pickle
+
+from cache import ResultCache, artifacts_version
+
+GL = "A*02:01+A*03:01^B*07:02+B*08:01"
+
+
+def test_key():
+    cache = ResultCache("v1")
+    key = cache.key(GL, "AFA;CAU", ["A", "B"], 10)
+
+    # the same query
+    assert cache.key(f" {GL}\n", "CAU;AFA;", ["B", "A", "A"], 10) == key
+    # other queries
+    assert cache.key(GL, "AFA", ["A", "B"], 10) != key
+    assert cache.key(GL, "AFA;CAU", ["A"], 10) != key
+    assert cache.key(GL, "AFA;CAU", ["A", "B"], 20) != key
+    assert cache.key(GL, "AFA;CAU", ["A", "B"], 10, kind="json") != key
+    assert ResultCache("v2").key(GL, "AFA;CAU", ["A", "B"], 10) != key
+
+
+def test_memory_tier_evicts_the_least_recently_used():
+    value_size = len(pickle.dumps("x" * 100, protocol=pickle.HIGHEST_PROTOCOL))
+    cache = ResultCache("v1", max_bytes=2 * value_size)
+    cache.put("a", "x" * 100)
+    cache.put("b", "y" * 100)
+    assert cache.get("a") == "x" * 100
+    cache.put("c", "z" * 100)
+
+    # b was used the least recently
+    assert cache.get("b") is None
+    assert cache.get("a") == "x" * 100
+    assert cache.get("c") == "z" * 100
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["misses"], stats["evictions"]) == (3, 1, 1)
+    assert stats["memory_bytes"] == 2 * value_size
+
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    db_path = str(tmp_path / "results.sqlite")
+    cache = ResultCache("v1", db_path=db_path)
+    cache.put("a", {"genotypes": [("A*02:01+A*03:01", 0.5)]})
+
+    restarted = ResultCache("v1", db_path=db_path)
+    assert restarted.get("a") == {"genotypes": [("A*02:01+A*03:01", 0.5)]}
+    assert restarted.get("a") == {"genotypes": [("A*02:01+A*03:01", 0.5)]}
+    stats = restarted.stats()
+    assert (stats["disk_hits"], stats["memory_hits"]) == (1, 1)
+
+
+def test_disk_tier_is_trimmed(tmp_path, monkeypatch):
+    monkeypatch.setattr("cache.DISK_TRIM_INTERVAL", 1)
+    value_size = len(pickle.dumps("x" * 1000, protocol=pickle.HIGHEST_PROTOCOL))
+    cache = ResultCache("v1", max_bytes=0, db_path=str(tmp_path / "results.sqlite"), max_disk_bytes=2 * value_size)
+    for key in "abc":
+        cache.put(key, key * 1000)
+
+    assert cache.get("a") is None
+    assert cache.get("b") == "b" * 1000
+    assert cache.get("c") == "c" * 1000
+
+
+def test_artifacts_version(tmp_path):
+    conf = tmp_path / "conf.json"
+    conf.write_text("{}")
+    store = tmp_path / "graph_store"
+    store.mkdir()
+    (store / "meta.json").write_text("{}")
+    version = artifacts_version([str(conf), str(store)])
+
+    assert artifacts_version([str(conf), str(store)]) == version
+    (store / "meta.json").write_text('{"format_version": 1}')
+    assert artifacts_version([str(conf), str(store)]) != version
@@ -0,0 +1,112 @@
+"""
+Tests of the columnar format of the results, see columnar.py, and of /impute-file?format=npz.
+"""
+import io
+import os
+import sys
+from zipfile import ZipFile
+
+import pytest
+
+import columnar
+from test_stream import upload
+
+GENOTYPES = ["D1,A*01:01+A*02:01^B*07:02+B*08:01,0.6000000000000001,0",
+             "D1,A*01:01+A*03:01^B*07:02+B*08:01,0.3,1",
+             "D2,A*01:01+A*02:01^B*07:02+B*08:01,1e-12,0"]
+HAPLOTYPES = ["D1,A*01:01~B*07:02+A*02:01~B*08:01,0.5,0",
+              "D2,A*01:01~B*07:02+A*02:01~B*08:01,0.25,0",
+              "D2,A*01:01~B*08:01+A*02:01~B*07:02,0.125,1"]
+
+
+@pytest.fixture
+def results(tmp_path):
+    genotype_path, haplotype_path = str(tmp_path / "genotype.csv"), str(tmp_path / "haplotype.csv")
+    for path, lines in ((genotype_path, GENOTYPES), (haplotype_path, HAPLOTYPES)):
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    return genotype_path, haplotype_path
+
+
+def genotype_lines(genotypes):
+    return [f"{genotypes['ids'][subject]},{genotypes['genotypes'][genotype]},{float(prob)!r},{rank}" for
+            subject, genotype, prob, rank in
+            zip(genotypes["subject"], genotypes["genotype"], genotypes["prob"], genotypes["rank"])]
+
+
+def haplotype_lines(haplotypes):
+    return [f"{haplotypes['ids'][subject]},{haplotypes['haplotypes'][hap1]}+{haplotypes['haplotypes'][hap2]},"
+            f"{float(prob)!r},{rank}" for subject, hap1, hap2, prob, rank in
+            zip(haplotypes["subject"], haplotypes["hap1"], haplotypes["hap2"], haplotypes["prob"],
+                haplotypes["rank"])]
+
+
+def test_round_trip(results):
+    genotype_path, haplotype_path = columnar.to_columnar(*results)
+    assert not any(os.path.exists(path) for path in results)
+
+    genotypes = columnar.load(genotype_path)
+    assert genotype_lines(genotypes) == GENOTYPES
+    assert len(genotypes["ids"]) == 2 and len(genotypes["genotypes"]) == 2
+    assert genotypes["subject"].dtype.name == "int32" and genotypes["prob"].dtype.name == "float64"
+    haplotypes = columnar.load(haplotype_path)
+    assert haplotype_lines(haplotypes) == HAPLOTYPES
+    assert len(haplotypes["haplotypes"]) == 4
+
+
+def test_no_results(tmp_path):
+    genotype_path, haplotype_path = columnar.to_columnar(str(tmp_path / "genotype.csv"),
+                                                         str(tmp_path / "haplotype.csv"))
+    assert genotype_lines(columnar.load(genotype_path)) == []
+    assert haplotype_lines(columnar.load(haplotype_path)) == []
+
+
+def test_zstd(results):
+    pytest.importorskip("zstandard")
+    genotype_path, haplotype_path = columnar.to_columnar(*results, compressed=False)
+    compressed_path = columnar.compress(genotype_path, "zstd")
+    assert compressed_path == genotype_path + ".zst"
+    assert not os.path.exists(genotype_path)
+    assert genotype_lines(columnar.load(compressed_path)) == GENOTYPES
+    assert columnar.compress(haplotype_path, "none") == haplotype_path
+
+
+def test_unknown_or_unavailable(monkeypatch):
+    with pytest.raises(ValueError, match="Unknown output format parquet"):
+        columnar.check_format("parquet")
+    with pytest.raises(ValueError, match="Unknown compression gzip"):
+        columnar.check_compression("gzip")
+    monkeypatch.setitem(sys.modules, "zstandard", None)
+    with pytest.raises(ValueError, match="needs the zstandard package"):
+        columnar.check_compression("zstd")
+
+
+def parse(lines):
+    return [(subject_id, result, float(prob), int(rank)) for subject_id, result, prob, rank in
+            (line.rsplit(",", 3) for line in lines)]
+
+
+def test_impute_file_npz(client, tmp_path):
+    csv_response = client.post("/impute-file", data=upload(), content_type="multipart/form-data")
+    response = client.post("/impute-file?format=npz", data=upload(), content_type="multipart/form-data")
+    assert response.status_code == 200
+
+    with ZipFile(io.BytesIO(response.get_data())) as zf:
+        assert sorted(zf.namelist()) == ["errors.csv", "genotype.npz", "haplotype.npz"]
+        zf.extractall(tmp_path)
+    with ZipFile(io.BytesIO(csv_response.get_data())) as zf:
+        genotypes, haplotypes = (zf.read(name).decode().splitlines() for name in ("genotype.csv", "haplotype.csv"))
+    assert genotypes and haplotypes
+    assert parse(genotype_lines(columnar.load(str(tmp_path / "genotype.npz")))) == parse(genotypes)
+    assert parse(haplotype_lines(columnar.load(str(tmp_path / "haplotype.npz")))) == parse(haplotypes)
+
+
+def test_impute_file_bad_format(client, monkeypatch):
+    for query in ("format=parquet", "compression=gzip"):
+        response = client.post(f"/impute-file?{query}", data=upload(), content_type="multipart/form-data")
+        assert response.status_code == 400
+    monkeypatch.setitem(sys.modules, "zstandard", None)
+    response = client.post("/impute-file?format=npz&compression=zstd", data=upload(),
+                           content_type="multipart/form-data")
+    assert response.status_code == 400
+    assert "zstandard" in response.get_data(as_text=True)
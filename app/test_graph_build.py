@@ -0,0 +1,35 @@
+"""
+Tests of the incremental graph update, see graph_build.py.
+"""
+import gzip
+import os
+
+from build_freqs import read_freq_file
+from conftest import build_example_graph
+from graph_build import update_graph, verify_graph
+from loci_graphs import FREQ_HEADER
+
+
+def test_update_graph_matches_full_build(tmp_path):
+    conf_file, conf, store_dir = build_example_graph(str(tmp_path))
+
+    # swap the frequencies of the two most frequent haplotypes of a population, so its file changes but the
+    # haplotypes of the graph do not
+    freq_path = os.path.join(conf["freq_data_dir"], f"{conf['populations'][0]}.freqs.gz")
+    rows = list(read_freq_file(freq_path))
+    first, second = sorted(range(len(rows)), key=lambda i: -rows[i][2])[:2]
+    rows[first], rows[second] = rows[first][:1] + rows[second][1:], rows[second][:1] + rows[first][1:]
+    with gzip.open(freq_path, "wt") as f:
+        f.write(FREQ_HEADER)
+        for haplotype, count, freq in rows:
+            f.write(f"{haplotype},{count},{freq}\n")
+
+    assert update_graph(conf_file, store_dir, pickle_path=None, freqs_dir=None) == "patched"
+    assert verify_graph(conf_file, store_dir) == []
+    assert update_graph(conf_file, store_dir, pickle_path=None, freqs_dir=None) == "unchanged"
+
+
+def test_unchanged_graph(example_graph):
+    conf_file, _, store_dir = example_graph
+
+    assert update_graph(conf_file, store_dir, pickle_path=None, freqs_dir=None) == "unchanged"
@@ -0,0 +1,139 @@
+"""
+Tests of the asynchronous imputation jobs, see jobs.py.
+"""
+import io
+import os
+import subprocess
+import sys
+import threading
+import time
+from zipfile import ZipFile
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from jobs import CLAIM_FILE, DONE, FAILED, QUEUED, RUNNING, JobQueue
+
+INPUT = "D1,A*01:01+A*02:01,CAU,CAU\nD2,A*01:01+A*03:01,CAU,CAU\nD3,A*02:01+A*03:01,CAU,CAU\n"
+
+
+def upload(text=INPUT):
+    return FileStorage(io.BytesIO(text.encode()), filename="donors.csv")
+
+
+def wait_for(queue, job_id, states, timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        status = queue.status(job_id)
+        if status["state"] in states:
+            return status
+        time.sleep(0.01)
+    pytest.fail(f"job {job_id} is still {status['state']}")
+
+
+def copy_job(job_dir, progress):
+    # the results are the input, imputed one subject at a time
+    with open(os.path.join(job_dir, "input.csv")) as f:
+        lines = f.readlines()
+    for done in range(1, len(lines) + 1):
+        progress(done, len(lines))
+    result_path = os.path.join(job_dir, "genotype.csv")
+    with open(result_path, "w") as f:
+        f.writelines(lines)
+    return [result_path]
+
+
+def test_job(tmp_path):
+    started, finish = threading.Event(), threading.Event()
+
+    def run_job(job_dir, progress):
+        progress(1, 3)
+        started.set()
+        finish.wait(10)
+        return copy_job(job_dir, progress)
+
+    queue = JobQueue(str(tmp_path), run_job, poll_interval=0.01)
+    status = queue.submit(upload())
+    assert (status["state"], status["done"], status["total"]) == (QUEUED, 0, 3)
+    job_id = status["job_id"]
+
+    assert started.wait(10)
+    status = queue.status(job_id)
+    assert (status["state"], status["done"], status["total"]) == (RUNNING, 1, 3)
+    assert queue.result_path(job_id) is None
+
+    finish.set()
+    status = wait_for(queue, job_id, (DONE,))
+    assert (status["done"], status["error"]) == (3, None)
+    assert status["created"] <= status["started"] <= status["finished"]
+    with ZipFile(queue.result_path(job_id)) as zf:
+        assert zf.read("genotype.csv").decode() == INPUT
+    assert not os.path.exists(os.path.join(tmp_path, job_id, "genotype.csv"))
+
+
+def test_failed_job(tmp_path):
+    def run_job(job_dir, progress):
+        raise ValueError("no graph")
+
+    queue = JobQueue(str(tmp_path), run_job, poll_interval=0.01)
+    job_id = queue.submit(upload())["job_id"]
+    status = wait_for(queue, job_id, (DONE, FAILED))
+    assert (status["state"], status["error"]) == (FAILED, "no graph")
+    assert queue.result_path(job_id) is None
+
+
+def test_unknown_jobs(tmp_path):
+    queue = JobQueue(str(tmp_path), copy_job)
+    for job_id in ("0" * 32, "../../etc", ".hidden"):
+        with pytest.raises(KeyError):
+            queue.status(job_id)
+        with pytest.raises(KeyError):
+            queue.result_path(job_id)
+
+
+def test_a_job_is_claimed_once(tmp_path, monkeypatch):
+    # two processes share the jobs directory, their runner threads are not started
+    monkeypatch.setattr(JobQueue, "start", lambda self: None)
+    queues = [JobQueue(str(tmp_path), copy_job) for _ in range(2)]
+    first = queues[0].submit(upload())["job_id"]
+    time.sleep(0.01)
+    second = queues[1].submit(upload())["job_id"]
+
+    assert queues[1]._claim_next() == first
+    assert queues[0]._claim_next() == second
+    assert queues[0]._claim_next() is None
+    assert queues[1]._claim_next() is None
+
+
+def test_interrupted_job_is_run_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(JobQueue, "start", lambda self: None)
+    queue = JobQueue(str(tmp_path), copy_job, poll_interval=0.01)
+    job_id = queue.submit(upload())["job_id"]
+
+    # claimed by a process that died while running it
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    with open(os.path.join(tmp_path, job_id, CLAIM_FILE), "w") as f:
+        f.write(str(dead.pid))
+
+    assert queue._claim_next() == job_id
+    queue._execute(job_id)
+    assert queue.status(job_id)["state"] == DONE
+
+
+def test_expired_jobs_are_removed(tmp_path):
+    queue = JobQueue(str(tmp_path), copy_job, expire_seconds=60, poll_interval=0.01)
+    job_id = queue.submit(upload())["job_id"]
+    wait_for(queue, job_id, (DONE,))
+    abandoned = tmp_path / ".abandoned"
+    abandoned.mkdir()
+
+    queue.remove_expired()
+    assert queue.status(job_id)["state"] == DONE
+    assert abandoned.exists()
+
+    queue.expire_seconds = 0
+    queue.remove_expired()
+    with pytest.raises(KeyError):
+        queue.status(job_id)
+    assert not abandoned.exists()
@@ -0,0 +1,100 @@
+"""
+Tests of the loci graphs, see loci_graphs.py: the routing, and the results of the subjects routed to a loci graph.
+"""
+import os
+import types
+
+import numpy as np
+import pytest
+
+import imputation
+from build_freqs import read_freq_file
+from graph_store import load_graph
+from hap_index import HaplotypeFrequencyIndex
+from loci_graphs import LociGraph, build_loci_graph, load_loci_graphs, route
+from runfile import ImputationEngine
+
+LOCI = ["A", "B", "C", "DRB1"]
+
+
+def test_route():
+    small = LociGraph("A-B-DRB1", frozenset(["A", "B", "DRB1"]), None)
+    large = LociGraph("A-C-B-DRB1-DQB1", frozenset(["A", "B", "C", "DRB1", "DQB1"]), None)
+    loci_graphs = [small, large]
+
+    assert route(loci_graphs, ["A", "B"]) is small
+    assert route(loci_graphs, {"A", "B", "DRB1"}) is small
+    assert route(loci_graphs, ["A", "C"]) is large
+    assert route(loci_graphs, ["A", "B", "C", "DRB1", "DQB1"]) is large
+    assert route(loci_graphs, ["A", "DPB1"]) is None
+    assert route([], ["A"]) is None
+
+
+@pytest.fixture(scope="module")
+def engines(example_graph, tmp_path_factory):
+    """The engine of the full example graph, and the graph of LOCI built from it."""
+    conf_file, conf, store_dir = example_graph
+    graphs_dir = str(tmp_path_factory.mktemp("loci_graphs"))
+    graph_dir = build_loci_graph(conf_file, LOCI, graphs_dir)
+    [loci_graph] = load_loci_graphs(dict(conf, loci_graphs=[LOCI]), graphs_dir)
+    return ImputationEngine(conf_file, load_graph(store_dir)), loci_graph, graph_dir
+
+
+def impute(monkeypatch, engine, loci_graphs, ard_string, race, loci):
+    monkeypatch.setattr(imputation, "get_artifacts",
+                        lambda: types.SimpleNamespace(engine=engine, loci_graphs=loci_graphs))
+    return imputation.impute_ard_rows(ard_string, race, loci, num_res=100)
+
+
+def test_routed_results_are_the_full_graph_marginals(engines, monkeypatch):
+    engine, loci_graph, graph_dir = engines
+    race = engine.config["pops"][0]
+
+    # a genotype with two phases in the graph: two frequent haplotypes of the loci that differ at the first locus
+    # and at one other, whose recombinants are haplotypes of the graph too
+    haplotypes = [tuple(haplotype.split("~")) for haplotype, _, freq in
+                  sorted(read_freq_file(os.path.join(graph_dir, "freqs", f"{race}.freqs.gz")), key=lambda row: -row[2])
+                  if freq > 0]
+    known = set(haplotypes)
+    hap1, hap2 = next((hap1, hap2) for hap1 in haplotypes[:100] for hap2 in haplotypes[:100]
+                      if hap1[0] != hap2[0] and sum(map(str.__ne__, hap1, hap2)) == 2 and
+                      (hap2[0],) + hap1[1:] in known and (hap1[0],) + hap2[1:] in known)
+    ard_string = "^".join(f"{allele1}+{allele2}" for allele1, allele2 in zip(hap1, hap2))
+
+    routed_calls = []
+    impute_one = loci_graph.engine.impute_one
+    monkeypatch.setattr(loci_graph.engine, "impute_one", lambda *args: routed_calls.append(args) or impute_one(*args))
+    _, haps = impute(monkeypatch, engine, [loci_graph], ard_string, race, LOCI)
+    assert len(routed_calls) == 1
+    assert len(haps) == 2
+
+    # the probabilities of the phases are in the ratio of the products of the marginal frequencies of the full graph
+    index = HaplotypeFrequencyIndex.from_graph(engine.graph, engine.config["pops"])
+    freqs, found = index.frequencies([haplotype for _, pair, _, _ in haps for haplotype in pair.split("+")])
+    assert found.all()
+    marginals = freqs[0::2, index.columns[race]] * freqs[1::2, index.columns[race]]
+    probs = np.array([prob for _, _, prob, _ in haps])
+    np.testing.assert_allclose(probs / probs.sum(), marginals / marginals.sum(), rtol=1e-9)
+
+
+def test_routed_plan_b(engines, monkeypatch):
+    engine, loci_graph, _ = engines
+    monkeypatch.setattr(engine, "impute_one", lambda *args: pytest.fail("imputed on the full graph"))
+
+    # a subject with no haplotype pair of the population, imputed by plan B on the loci graph
+    genos, haps = impute(monkeypatch, engine, [loci_graph], "A*02:01+A*32:01^B*15:52+B*44:03^DRB1*09:01+DRB1*04:04",
+                         "AFA", ["A", "B", "DRB1"])
+    assert loci_graph.engine.imputation.plan == "b"
+    assert [geno for _, geno, _, _ in genos] == ["A*02:01+A*32:01^B*15:52+B*44:03^DRB1*04:04+DRB1*09:01"]
+    assert haps
+
+
+def test_failed_routed_imputation_falls_back_to_the_full_graph(engines, monkeypatch):
+    engine, loci_graph, _ = engines
+    failing = LociGraph(loci_graph.name, loci_graph.loci,
+                        types.SimpleNamespace(impute_one=lambda *args: (None, None)))
+    ard_string = "A*02:05+A*29:01^B*15:03+B*40:06^DRB1*08:04+DRB1*15:01"
+
+    results = impute(monkeypatch, engine, [failing], ard_string, "CAU", ["A", "B", "DRB1"])
+    assert results[0]
+    assert results == impute(monkeypatch, engine, [], ard_string, "CAU", ["A", "B", "DRB1"])
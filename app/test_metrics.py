@@ -0,0 +1,58 @@
+"""
+Tests of the metrics, see metrics.py, and of the /metrics endpoint.
+"""
+from metrics import Counter, Histogram, REGISTRY
+
+GL = "A*02:05+A*29:01^B*15:03+B*40:06^DRB1*08:04+DRB1*15:01"
+
+
+def samples(client):
+    """The samples of /metrics, by name and labels."""
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    values = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            values[name] = float(value)
+    return values
+
+
+def test_counter_and_histogram():
+    counter = Counter("subjects_total", "Subjects.", ("endpoint",))
+    counter.inc(endpoint="api")
+    counter.inc(3, endpoint="api")
+    counter.inc(endpoint="impute-form")
+    assert list(counter.samples()) == ['subjects_total{endpoint="api"} 4', 'subjects_total{endpoint="impute-form"} 1']
+
+    histogram = Histogram("seconds", "Seconds.", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    assert list(histogram.samples()) == ['seconds_bucket{le="0.1"} 2', 'seconds_bucket{le="1.0"} 3',
+                                         'seconds_bucket{le="+Inf"} 4', "seconds_sum 2.65", "seconds_count 4"]
+
+
+def test_metrics_endpoint(client):
+    before = samples(client)
+    # (a number of results no other test asks for, so the subject is not in the result cache)
+    response = client.post("/api/v1/impute", json=[{"glstring": GL, "race": "CAU", "loci": ["A", "B"],
+                                                     "num_results": 17}])
+    assert response.status_code == 200
+    client.get("/no-such-page")
+    after = samples(client)
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    assert delta('grimmard_request_seconds_count{endpoint="/api/v1/impute",status="200"}') == 1
+    assert delta('grimmard_request_seconds_count{endpoint="unmatched",status="404"}') == 1
+    assert delta('grimmard_subjects_total{endpoint="api"}') == 1
+    assert delta('grimmard_loci_graph_total{graph="full"}') == 1
+    for stage in ("ard", "impute", "reduce_loci"):
+        assert delta(f'grimmard_stage_seconds_count{{stage="{stage}"}}') == 1
+    assert after[f'grimmard_artifacts_info{{version="{response.headers["X-Grimmard-Version"]}"}}'] == 1
+
+    text = client.get("/metrics").get_data(as_text=True)
+    for metric in REGISTRY:
+        assert f"# TYPE {metric.name} {metric.kind}\n" in text
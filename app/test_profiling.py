@@ -0,0 +1,51 @@
+"""
+Tests of the profiling of requests, see profiling.py.
+"""
+import json
+import os
+import pstats
+import time
+
+import profiling
+from profiling import RequestProfiler, profile_reason
+
+
+def test_profile_reason(monkeypatch):
+    conf = {"profiling_token": "s3cret", "profiling_sample_every": 0}
+    assert profile_reason(conf, "s3cret") == "requested"
+    assert profile_reason(conf, "s3cre") is None
+    assert profile_reason(conf, "") is None
+    assert profile_reason(conf, None) is None
+    # no token configured, nothing is profiled on request
+    assert profile_reason(dict(conf, profiling_token=""), "") is None
+
+    monkeypatch.setattr(profiling, "_request_counter", iter(range(1, 100)))
+    conf["profiling_sample_every"] = 3
+    assert [profile_reason(conf, None) for _ in range(6)] == [None, None, "sampled", None, None, "sampled"]
+
+
+def _busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_save(tmp_path):
+    profiler = RequestProfiler(interval=0.001).start()
+    _busy(0.1)
+    path = profiler.save(str(tmp_path), "/impute-form", "A*02:01+A*03:01", "requested")
+
+    assert os.path.dirname(path) == str(tmp_path)
+    assert "_impute-form_" in os.path.basename(path)
+    functions = {function for _, _, function in pstats.Stats(path + ".prof").stats}
+    assert "_busy" in functions
+    with open(path + ".folded") as f:
+        stacks = [line.rsplit(" ", 1) for line in f]
+    assert stacks and all(count.strip().isdigit() for _, count in stacks)
+    assert any("_busy (test_profiling.py" in stack for stack, _ in stacks)
+    with open(path + ".json") as f:
+        meta = json.load(f)
+    assert (meta["endpoint"], meta["tag"], meta["reason"], meta["cprofile"]) == \
+           ("/impute-form", "A*02:01+A*03:01", "requested", True)
+    assert meta["samples"] == sum(int(count) for _, count in stacks)
+    assert meta["elapsed_seconds"] >= 0.1
@@ -0,0 +1,75 @@
+"""
+Tests of the reduction of the results to the requested loci, see reduce_loci.py.
+"""
+import random
+
+import pytest
+
+from reduce_loci import best_prob_genotypes, reduce_haps_rows, reduce_loci, reduce_muug_rows
+
+LOCI = ["A", "B"]
+
+
+def sorted_top(res, num_res):
+    # the full sort that the top-k replaced
+    sorted_by_value = sorted(res.items(), key=lambda kv: kv[1], reverse=True)
+    return [(key, prob, k) for k, (key, prob) in enumerate(sorted_by_value[:num_res])]
+
+
+def random_rows(rng, n_subjects):
+    # genotype rows of the subjects, grouped by subject, with many equal probabilities
+    rows = []
+    for subject in range(n_subjects):
+        for _ in range(rng.randint(1, 60)):
+            alleles = [f"{locus}*{rng.randint(1, 4):02d}:01" for locus in ("A", "A", "B", "B", "C", "C")]
+            gl = "^".join(f"{alleles[i]}+{alleles[i + 1]}" for i in range(0, 6, 2))
+            rows.append((f"D{subject}", gl, rng.choice([0.5, 0.25, 0.125, rng.random()])))
+    return rows
+
+
+@pytest.mark.parametrize("num_res", [1, 3, 20, 1000])
+def test_top_k_is_the_sorted_top(num_res):
+    rng = random.Random(num_res)
+    for _ in range(20):
+        res = {f"G{i}": rng.choice([0.5, 0.25, rng.random()]) for i in range(rng.randint(0, 50))}
+        assert best_prob_genotypes(res, num_res) == sorted_top(res, num_res)
+
+
+@pytest.mark.parametrize("num_res", [1, 5, 20])
+def test_reduce_rows(num_res):
+    rows = random_rows(random.Random(num_res), 30)
+
+    expected = []
+    for subject in dict.fromkeys(id for id, _, _ in rows):
+        res = {}
+        for id, gl, prob in rows:
+            if id == subject:
+                reduced = "^".join(sorted(locus for locus in gl.split("^") if locus.split("*")[0] in LOCI))
+                res[reduced] = res.get(reduced, 0) + prob
+        expected.extend((subject, gl, prob, k) for gl, prob, k in sorted_top(res, num_res))
+    assert list(reduce_muug_rows(rows, LOCI, num_res)) == expected
+
+    # the haplotype pairs of the same rows, the first and the second allele of each locus
+    haps_rows = [(id, *("~".join(pair.split("+")[i] for pair in gl.split("^")) for i in (0, 1)), prob)
+                 for id, gl, prob in rows]
+    reduced = list(reduce_haps_rows(haps_rows, LOCI, num_res))
+    assert all(k < num_res for _, _, _, k in reduced)
+    assert all("C*" not in haps for _, haps, _, _ in reduced)
+
+
+def test_reduce_loci_files(tmp_path):
+    rows = random_rows(random.Random(0), 10)
+    genotype_path, haplotype_path = tmp_path / "genotype.csv", tmp_path / "haplotype.csv"
+    with open(genotype_path, "w") as f:
+        f.writelines(f"{id},{gl},{prob},0\n" for id, gl, prob in rows)
+    with open(haplotype_path, "w") as f:
+        f.writelines(f"{id},A*01:01~B*01:01,A*02:01~B*02:01,{prob},0\n" for id, _, prob in rows)
+
+    haps_out, genos_out = reduce_loci(LOCI, str(genotype_path), str(haplotype_path), num_res=2)
+    with open(genos_out) as f:
+        lines = [line.rstrip("\n").split(",") for line in f]
+    assert [(id, gl, float(prob), int(k)) for id, gl, prob, k in lines] == list(reduce_muug_rows(rows, LOCI, 2))
+    with open(haps_out) as f:
+        lines = [line.rstrip("\n").split(",") for line in f]
+    assert {id for id, _, _ in rows} == {id for id, _, _, _ in lines}
+    assert all(haps == "A*01:01~B*01:01+A*02:01~B*02:01" and k == "0" for _, haps, _, k in lines)
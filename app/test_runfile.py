@@ -0,0 +1,59 @@
+"""
+Tests of the imputation engine and its pool of processes, see runfile.py.
+"""
+import os
+
+from graph_store import load_graph
+from metrics import IMPUTATION_PLANS
+from runfile import ImputationEngine, side_outputs
+
+# subjects of the example frequencies, as the reduced input of grim
+SUBJECTS = [
+    "A*33:03+A*02:05^C*02:10+C*04:01^B*15:03+B*15:03^DRB1*04:04+DRB1*08:04^DQB1*03:02+DQB1*03:01,AFA,AFA",
+    "A*02:05+A*29:01^B*15:03+B*40:06^DRB1*08:04+DRB1*15:01,CAU,CAU",
+    "A*02:01+A*32:01^B*15:52+B*44:03^DRB1*09:01+DRB1*04:04,AFA,CAU",
+]
+
+
+def write_input(directory, n_subjects):
+    input_path = str(directory / "input.csv")
+    with open(input_path, "w") as f:
+        for i in range(n_subjects):
+            f.write(f"D{i},{SUBJECTS[i % len(SUBJECTS)]}\n")
+    return input_path
+
+
+def test_parallel_output_equals_serial(example_graph, tmp_path):
+    conf_file, _, store_dir = example_graph
+    engine = ImputationEngine(conf_file, load_graph(store_dir))
+    engine.processes = 2
+    input_path = write_input(tmp_path, 12)
+
+    serial_dir, parallel_dir = tmp_path / "serial", tmp_path / "parallel"
+    serial_dir.mkdir()
+    parallel_dir.mkdir()
+    engine.impute_file(input_path, str(serial_dir / "haps.csv"), str(serial_dir / "genos.csv"),
+                       **side_outputs(str(serial_dir / "input.csv")))
+    # chunks of 5 subjects, the last one shorter
+    engine.impute_file_parallel(input_path, str(parallel_dir / "haps.csv"), str(parallel_dir / "genos.csv"),
+                                chunk_size=5, **side_outputs(str(parallel_dir / "input.csv")))
+
+    for name in ("haps.csv", "genos.csv"):
+        assert (parallel_dir / name).read_text() == (serial_dir / name).read_text()
+        assert (serial_dir / name).read_text()
+
+
+def test_pool_counts_the_plans_in_this_process(example_graph, tmp_path):
+    conf_file, _, store_dir = example_graph
+    engine = ImputationEngine(conf_file, load_graph(store_dir))
+    engine.processes = 2
+    input_path = write_input(tmp_path, 12)
+
+    # the processes of an engine of a graph store are not forked from this process, that runs threads
+    assert engine.pool().apply(os.getppid) != os.getpid()
+
+    counted = sum(IMPUTATION_PLANS._values.values())
+    engine.impute_file_parallel(input_path, str(tmp_path / "haps.csv"), str(tmp_path / "genos.csv"), chunk_size=5,
+                                **side_outputs(input_path))
+    # the plans of the subjects imputed in the pool are counted in this process
+    assert sum(IMPUTATION_PLANS._values.values()) - counted == 12
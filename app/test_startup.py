@@ -0,0 +1,34 @@
+"""
+Tests of the warm-up, see startup.py.
+"""
+import sys
+
+from startup import WarmUp
+
+
+def test_warm_up_phases():
+    done = []
+    warm_up = WarmUp([("first", lambda: done.append("first")), ("second", lambda: done.append("second"))])
+    warm_up.start()
+
+    assert done == ["first", "second"]
+    status = warm_up.status()
+    assert status["ready"] and status["phase"] is None and status["error"] is None
+    assert list(status["timings"]) == ["first", "second"]
+
+
+def test_warm_up_records_an_exit_in_the_background():
+    done = []
+    warm_up = WarmUp([("pyard", lambda: sys.exit("Could not download the data")), ("artifacts", lambda: done.append(1))])
+    warm_up.start(background=True)
+
+    # the thread ends without the ready event, with the error of the phase it stopped at
+    for _ in range(100):
+        if warm_up.error:
+            break
+        warm_up.ready.wait(0.05)
+    status = warm_up.status()
+    assert not status["ready"]
+    assert status["phase"] == "pyard"
+    assert status["error"] == "pyard: Could not download the data"
+    assert not done
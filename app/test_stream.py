@@ -0,0 +1,75 @@
+"""
+Tests of the streamed results of an uploaded file, /impute-file?format=ndjson.
+"""
+import io
+import json
+import os
+from zipfile import ZipFile
+
+import imputation
+from test_runfile import SUBJECTS
+
+N_SUBJECTS = 7
+# the subjects of the upload, with a malformed line
+LINES = [f"D{i},{SUBJECTS[i % len(SUBJECTS)]}\n" for i in range(N_SUBJECTS)]
+LINES.insert(3, "D-bad,A*02:01+A*03:01,CAU\n")
+
+
+def upload():
+    return {"genofile": (io.BytesIO("".join(LINES).encode()), "donors.csv")}
+
+
+def read_zip_results(data, name):
+    # the [result, probability] rows of a results file of the zip, by subject id
+    rows = {}
+    with ZipFile(io.BytesIO(data)) as zf:
+        for line in zf.read(name).decode().splitlines():
+            subject_id, result, prob, _ = line.split(",")
+            rows.setdefault(subject_id, []).append([result, float(prob)])
+    return rows
+
+
+def test_stream_equals_the_zip(client, monkeypatch):
+    # chunks of 2 subjects, the last one shorter
+    monkeypatch.setitem(imputation.get_engine().json_conf, "stream_chunk_size", 2)
+    workspaces = set(os.listdir(imputation.OUTPUT_DIR))
+
+    response = client.post("/impute-file?format=ndjson", data=upload(), content_type="multipart/form-data")
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    assert response.is_streamed
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    response.close()
+
+    error, = [line for line in lines if "error" in line]
+    assert error["line"] == 4
+    assert lines[-1] == {"done": True, "subjects": N_SUBJECTS, "errors": 1}
+    results = [line for line in lines if "id" in line]
+    assert [result["id"] for result in results] == [f"D{i}" for i in range(N_SUBJECTS)]
+    # the workspace of the request is removed when the response is closed
+    assert set(os.listdir(imputation.OUTPUT_DIR)) == workspaces
+
+    response = client.post("/impute-file", data=upload(), content_type="multipart/form-data")
+    genotypes = read_zip_results(response.get_data(), "genotype.csv")
+    haplotypes = read_zip_results(response.get_data(), "haplotype.csv")
+    for result in results:
+        assert result["genotypes"] == genotypes.get(result["id"], [])
+        assert [["+".join(pair[:2]), pair[2]] for pair in result["haplotype_pairs"]] == \
+            haplotypes.get(result["id"], [])
+    assert any(result["genotypes"] for result in results)
+
+
+def test_results_are_yielded_as_their_chunk_is_imputed(client, monkeypatch):
+    monkeypatch.setitem(imputation.get_engine().json_conf, "stream_chunk_size", 2)
+    lines = [f"D{i},{SUBJECTS[i % len(SUBJECTS)]}\n" for i in range(20)]
+    read = []
+
+    def upload_lines():
+        for line in lines:
+            read.append(line)
+            yield line
+
+    results = imputation.impute_stream(upload_lines())
+    assert next(results)["id"] == "D0"
+    assert len(read) < len(lines)
+    assert [result.get("id") for result in results][-2:] == ["D19", None]
@@ -0,0 +1,73 @@
+"""
+Tests of the workspaces of the requests, see request_workspace in imputation.py: concurrent requests never share a
+file, and nothing is left behind.
+"""
+import io
+import os
+import threading
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import imputation
+
+
+@pytest.fixture
+def output_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(imputation, "OUTPUT_DIR", str(tmp_path))
+    return tmp_path
+
+
+def test_workspace_is_removed(output_dir):
+    with imputation.request_workspace() as workspace:
+        with open(os.path.join(workspace, "input.csv"), "w") as f:
+            f.write("D1,A*01:01+A*02:01,CAU,CAU")
+    assert not os.path.exists(workspace)
+
+    with pytest.raises(RuntimeError):
+        with imputation.request_workspace() as workspace:
+            open(os.path.join(workspace, "input.csv"), "w").close()
+            raise RuntimeError
+    assert not os.path.exists(workspace)
+    assert not os.listdir(output_dir)
+
+
+def test_concurrent_files_are_kept_apart(output_dir, monkeypatch):
+    # each request writes its lines as its results, after all of the requests have written their input
+    barrier = threading.Barrier(4)
+
+    def impute_batch_lines(lines, genotype_path, haplotype_path, errors_path=None, **kwargs):
+        text = "".join(lines)
+        with open(os.path.join(os.path.dirname(genotype_path), "input.csv"), "w") as f:
+            f.write(text)
+        barrier.wait(timeout=10)
+        with open(os.path.join(os.path.dirname(genotype_path), "input.csv")) as f:
+            text = f.read()
+        for path in (genotype_path, haplotype_path):
+            with open(path, "w") as f:
+                f.write(text)
+        return 0
+
+    monkeypatch.setattr(imputation, "impute_batch_lines", impute_batch_lines)
+    results = {}
+
+    def request(n):
+        file = FileStorage(io.BytesIO(f"D{n},A*01:01+A*02:01,CAU,CAU\n".encode()), filename=f"donors{n}.csv")
+        with imputation.request_workspace() as workspace:
+            paths = imputation.apply_grim_file(file, workspace)
+            results[n] = [(os.path.basename(path), open(path).read()) if path else None for path in paths]
+
+    threads = [threading.Thread(target=request, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == {n: [("genotype.csv", f"D{n},A*01:01+A*02:01,CAU,CAU\n"),
+                           ("haplotype.csv", f"D{n},A*01:01+A*02:01,CAU,CAU\n"), None] for n in range(4)}
+    assert not os.listdir(output_dir)
+
+
+def test_string_files_are_unique(tmp_path):
+    paths = {imputation.string_to_file("A*01:01+A*02:01", directory=str(tmp_path)) for _ in range(100)}
+    assert len(paths) == 100